@@ -0,0 +1,95 @@
+class NotAuthorized(Exception):
+    """
+    Raised by :meth:`restfulgrok.view.GrokRestViewMixin.authorize` when the
+    :class:`AuthorizationBackend` denies a request.
+    """
+
+
+class AuthorizationBackend(object):
+    """
+    Superclass for authorization backends used by
+    :meth:`restfulgrok.view.GrokRestViewMixin.authorize`.
+
+    This class denies everything, so subclasses must at least override
+    :meth:`check_permission`.
+    """
+    def check_permission(self, permission, view):
+        """
+        Return ``True`` if the current user has ``permission`` on ``view``.
+        """
+        return False
+
+    def get_userid(self, view):
+        """
+        Return the id of the current user, or ``None`` for anonymous users.
+        """
+        return None
+
+    def get_unauthorized_exceptions(self):
+        """
+        Return a tuple of the exceptions that
+        :meth:`restfulgrok.view.GrokRestViewMixin.render` responds to with
+        *401 Unauthorized*.
+        """
+        return (NotAuthorized,)
+
+
+class ZopeAuthorizationBackend(AuthorizationBackend):
+    """
+    Authorizes using the Zope ``AccessControl`` security manager. This is the
+    default for :class:`restfulgrok.view.GrokRestViewMixin`.
+    """
+    def check_permission(self, permission, view):
+        from AccessControl import getSecurityManager
+        return getSecurityManager().checkPermission(permission, view)
+
+    def get_userid(self, view):
+        from AccessControl import getSecurityManager
+        return getSecurityManager().getUser().getId()
+
+    def get_unauthorized_exceptions(self):
+        try:
+            from AccessControl.unauthorized import Unauthorized
+        except ImportError:
+            return (NotAuthorized,)
+        return (NotAuthorized, Unauthorized)
+
+
+class AllowAllAuthorizationBackend(AuthorizationBackend):
+    """
+    Grants every permission to everyone. Only use this for public, read-only
+    APIs, or in tests.
+    """
+    def check_permission(self, permission, view):
+        return True
+
+
+class CallbackAuthorizationBackend(AuthorizationBackend):
+    """
+    Authorizes using callables. Example::
+
+        def check_permission(permission, view):
+            return view.request.environ.get('REMOTE_USER') is not None
+
+        class MyView(WsgiRestView):
+            authorization_backend = CallbackAuthorizationBackend(check_permission)
+    """
+    def __init__(self, check_permission, get_userid=None):
+        """
+        :param check_permission:
+            Callable taking ``(permission, view)`` as arguments, and returning
+            ``True`` if the current user has the permission.
+        :param get_userid:
+            Optional callable taking ``view`` as argument, and returning the
+            id of the current user.
+        """
+        self._check_permission = check_permission
+        self._get_userid = get_userid
+
+    def check_permission(self, permission, view):
+        return self._check_permission(permission, view)
+
+    def get_userid(self, view):
+        if self._get_userid:
+            return self._get_userid(view)
+        return None
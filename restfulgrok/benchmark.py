@@ -0,0 +1,467 @@
+"""
+Benchmarks for restfulgrok. Run them with::
+
+    $ python -m restfulgrok.benchmark <benchmark>
+
+Use ``--help`` to list the available benchmarks.
+"""
+import os
+import sys
+import random
+import timeit
+import threading
+import subprocess
+import multiprocessing
+from argparse import ArgumentParser
+
+
+#: The public modules of restfulgrok.
+PUBLIC_MODULES = ['restfulgrok',
+                  'restfulgrok.contenttype',
+                  'restfulgrok.view',
+                  'restfulgrok.fancyhtmlview',
+                  'restfulgrok.authorization',
+                  'restfulgrok.spool',
+                  'restfulgrok.jobs',
+                  'restfulgrok.offload',
+                  'restfulgrok.schema',
+                  'restfulgrok.typeadapters',
+                  'restfulgrok.throttle',
+                  'restfulgrok.singleflight',
+                  'restfulgrok.changefeed',
+                  'restfulgrok.patch',
+                  'restfulgrok.streaming',
+                  'restfulgrok.columnar',
+                  'restfulgrok.responsecache',
+                  'restfulgrok.memprofile',
+                  'restfulgrok.wsgi',
+                  'restfulgrok.mock']
+
+#: Third party modules that should only be imported when they are used.
+LAZY_MODULES = ['yaml', 'negotiator', 'jinja2', 'AccessControl', 'pyarrow', 'tracemalloc']
+
+_importtime_script = """
+import sys, time
+start = time.time()
+import {module}
+elapsed = time.time() - start
+print elapsed
+print ' '.join(name for name in {lazy_modules!r} if name in sys.modules)
+"""
+
+
+def benchmark_importtime(modules=PUBLIC_MODULES, repeat=5):
+    """
+    Time importing each of the given ``modules`` in a fresh interpreter.
+
+    :return:
+        List of ``(module, seconds, imported_lazy_modules)`` tuples, where
+        ``seconds`` is the fastest of ``repeat`` imports, and
+        ``imported_lazy_modules`` is a list of the :obj:`LAZY_MODULES`
+        imported as a side effect of importing the module.
+    """
+    env = dict(os.environ)
+    packagedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [packagedir, env.get('PYTHONPATH')]))
+    results = []
+    for module in modules:
+        script = _importtime_script.format(module=module, lazy_modules=LAZY_MODULES)
+        timings = []
+        for index in xrange(repeat):
+            output = subprocess.check_output([sys.executable, '-c', script], env=env)
+            elapsed, imported = output.split('\n')[:2]
+            timings.append(float(elapsed))
+        results.append((module, min(timings), imported.split()))
+    return results
+
+
+def print_importtime(args):
+    for module, seconds, imported in benchmark_importtime(repeat=args.repeat):
+        print '{0:<30} {1:>8.2f} ms   {2}'.format(module, seconds*1000,
+                                                  ', '.join(imported))
+
+
+#: Accept headers used by the request benchmarks.
+ACCEPT_HEADERS = ['application/json',
+                  'application/x-yaml;q=0.8,application/json',
+                  'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8']
+
+
+_benchmark_view_class = None
+
+def _create_benchmark_view(acceptheader, method='GET'):
+    global _benchmark_view_class
+    from restfulgrok.mock import MockRestView, MockRequest, MockResponse
+    if _benchmark_view_class is None:
+        from restfulgrok.authorization import AllowAllAuthorizationBackend
+        class BenchmarkView(MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            def handle_get(self):
+                return {'hello': 'world'}
+        _benchmark_view_class = BenchmarkView
+    return _benchmark_view_class(request=MockRequest(method, headers={'Accept': acceptheader}),
+                                 response=MockResponse())
+
+
+def _negotiate_without_cache(registry, acceptheader):
+    # How negotiate_accept_header() worked before the negotiator was cached.
+    import negotiator
+    acceptable = [negotiator.AcceptParameters(negotiator.ContentType(content_type.mimetype))
+                  for content_type in registry]
+    result = negotiator.ContentNegotiator(acceptable=acceptable).negotiate(acceptheader)
+    return result and result.content_type.mimetype()
+
+
+def benchmark_request(number=2000):
+    """
+    Time the per-request overhead of the :class:`restfulgrok.view.GrokRestViewMixin`
+    request path, comparing the precomputed response profiles and negotiator
+    with computing them for each request.
+
+    :return: List of ``(name, acceptheader, microseconds_per_call)`` tuples.
+    """
+    results = []
+    for acceptheader in ACCEPT_HEADERS:
+        view = _create_benchmark_view(acceptheader)
+        registry = view.content_types
+        mimetype = view.get_content_type().mimetype
+        if view.error_cache is not None and view.get_content_type().error_cacheable:
+            errorname = 'render 405 (cached error)'
+        else:
+            errorname = 'render 405'
+        cases = [
+            ('negotiate (cached negotiator)',
+             lambda: registry.negotiate_accept_header(acceptheader)),
+            ('negotiate (new negotiator)',
+             lambda: _negotiate_without_cache(registry, acceptheader)),
+            ('content-type header (profile)',
+             lambda: registry.get_profile(mimetype).contenttype_header),
+            ('content-type header (formatted)',
+             lambda: '{0}; charset=UTF-8'.format(mimetype)),
+            ('render',
+             lambda: _create_benchmark_view(acceptheader).render()),
+            (errorname,
+             lambda: _create_benchmark_view(acceptheader, 'POST').render()),
+        ]
+        for name, func in cases:
+            seconds = min(timeit.repeat(func, number=number, repeat=3))
+            results.append((name, acceptheader, seconds / number * 1000000))
+    return results
+
+
+def print_request(args):
+    for name, acceptheader, microseconds in benchmark_request(number=args.number):
+        print '{0:<34} {1:>9.2f} us   {2}'.format(name, microseconds, acceptheader)
+
+
+#: Accept headers used by the negotiation benchmarks. Headers sent by real
+#: clients, and worst-case headers.
+NEGOTIATION_HEADERS = [
+    ('browser', 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8'),
+    ('32 entries', ','.join(['application/vnd.example.v{0}+json;q=0.{1}'.format(index, index % 9 + 1)
+                             for index in xrange(31)] + ['application/json'])),
+    ('64 KiB', ','.join(['text/x-example-{0}'.format(index) for index in xrange(4000)])),
+    ('10000 entries', ','.join(['a/b'] * 10000)),
+    ('malformed', ';q=,' * 5000),
+]
+
+_fuzz_mediaranges = ['application/json', 'application/x-yaml', 'text/html', 'text/*',
+                     '*/*', 'application/*', 'image/png', 'APPLICATION/JSON', 'text/HTML',
+                     '*', '/', 'application', 'application/', '/json', 'a/b/c', u'\xe6/\xf8',
+                     '', ' ', '\x00', 'x' * 300 + '/' + 'y' * 300]
+_fuzz_params = ['q=1', 'q=0.8', 'q=0.001', 'q=0', 'q=0.0', 'q=1.000', 'q=2', 'q=', 'q=x',
+                'q=-1', 'q=0.5.5', 'Q=0.5', ' q = 0.7 ', 'charset=utf-8', 'level=1', '',
+                '=', 'q']
+
+def generate_accept_headers(count, seed=0, max_entries=40):
+    """
+    Generate a fuzz corpus of random Accept headers, with valid and
+    malformed media ranges, parameters and q-values.
+
+    :param seed: Seed for the random generator, so the corpus is reproducible.
+    :return: List of ``count`` headers.
+    """
+    rand = random.Random(seed)
+    headers = []
+    for index in xrange(count):
+        entries = []
+        for entryindex in xrange(rand.randint(0, max_entries)):
+            entry = rand.choice(_fuzz_mediaranges)
+            for paramindex in xrange(rand.choice([0, 0, 1, 1, 2, 3])):
+                entry += ';' + rand.choice(_fuzz_params)
+            entries.append(entry)
+        headers.append(rand.choice([',', ', ', ' ,', ',,']).join(entries))
+    return headers
+
+
+def _time(func, number):
+    try:
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+    except Exception:
+        return None
+    return seconds / number * 1000000
+
+
+def benchmark_negotiate(number=200, corpus_size=1000):
+    """
+    Time :meth:`restfulgrok.contenttype.ContentTypesRegistry.negotiate_accept_header`
+    for each of the :obj:`NEGOTIATION_HEADERS`, with and without
+    normalization and caching, the ``?mimetype=`` querystring path of
+    :meth:`restfulgrok.view.GrokRestViewMixin.get_content_type`, and
+    uncached negotiation over a fuzz corpus (see :func:`generate_accept_headers`).
+
+    :return:
+        List of ``(name, headername, microseconds_per_call)`` tuples.
+        ``microseconds_per_call`` is ``None`` if the call raises an exception.
+    """
+    from restfulgrok.contenttype import normalize_accept_header
+    from restfulgrok.mock import MockRequest, MockResponse
+    registry = _create_benchmark_view('*/*').content_types
+
+    def negotiate_uncached(acceptheader):
+        registry._negotiation_cache.clear()
+        return registry.negotiate_accept_header(acceptheader)
+
+    results = []
+    for headername, acceptheader in NEGOTIATION_HEADERS:
+        cases = [
+            ('negotiator (not normalized)',
+             lambda: _negotiate_without_cache(registry, acceptheader)),
+            ('normalize',
+             lambda: normalize_accept_header(acceptheader)),
+            ('negotiate (uncached)',
+             lambda: negotiate_uncached(acceptheader)),
+            ('negotiate (cached)',
+             lambda: registry.negotiate_accept_header(acceptheader)),
+        ]
+        for name, func in cases:
+            results.append((name, headername, _time(func, number)))
+
+    def querystring_content_type():
+        view = _benchmark_view_class(request=MockRequest('GET', getdata={'mimetype': 'application/json'},
+                                                         headers={'Accept': NEGOTIATION_HEADERS[-1][1]}),
+                                     response=MockResponse())
+        return view.get_content_type()
+    results.append(('get_content_type', '?mimetype=', _time(querystring_content_type, number)))
+
+    corpus = generate_accept_headers(corpus_size)
+    def negotiate_corpus():
+        for acceptheader in corpus:
+            negotiate_uncached(acceptheader)
+    seconds = _time(negotiate_corpus, 1)
+    results.append(('negotiate (uncached)', 'fuzz corpus',
+                    seconds if seconds is None else seconds / corpus_size))
+    return results
+
+
+def print_negotiate(args):
+    for name, headername, microseconds in benchmark_negotiate(number=args.number):
+        if microseconds is None:
+            timing = '{0:>12}'.format('error')
+        else:
+            timing = '{0:>9.2f} us'.format(microseconds)
+        print '{0:<30} {1}   {2}'.format(name, timing, headername)
+
+
+#: ``(Accept header, expected mimetype)`` pairs used by the load harness. The
+#: requests alternate between them, so concurrent requests share the
+#: negotiation cache, the response profiles and the Jinja environment.
+LOAD_ACCEPT_HEADERS = [('application/json', 'application/json'),
+                       ('application/x-yaml', 'application/x-yaml'),
+                       ('text/html', 'text/html')]
+
+_load_view_class = None
+
+def _get_load_view_class():
+    global _load_view_class
+    if _load_view_class is None:
+        from restfulgrok.mock import MockRestViewWithFancyHtml
+        from restfulgrok.authorization import AllowAllAuthorizationBackend
+        class LoadView(MockRestViewWithFancyHtml):
+            authorization_backend = AllowAllAuthorizationBackend()
+            def handle_get(self):
+                requestid = self.request.get('requestid')
+                self.response.setHeader('X-Request-Id', requestid)
+                return {'requestid': requestid, 'items': range(20)}
+        _load_view_class = LoadView
+    return _load_view_class
+
+
+def check_load_response(view, requestid, output, mimetype):
+    """
+    Check that a response from the load harness only contains data from its
+    own request.
+
+    :return: List of problems. Empty if the response is correct.
+    """
+    problems = []
+    status = view.response.status
+    if status != (200, 'OK'):
+        problems.append('{0}: status {1!r}'.format(requestid, status))
+    requestids = [value for header, value in view.response.headers if header == 'X-Request-Id']
+    if requestids != [requestid]:
+        problems.append('{0}: X-Request-Id headers {1!r}'.format(requestid, requestids))
+    contenttypes = [value for header, value in view.response.headers if header == 'Content-Type']
+    if len(contenttypes) != 1 or contenttypes[0].split(';')[0] != mimetype:
+        problems.append('{0}: Content-Type headers {1!r}, expected {2}'.format(requestid, contenttypes,
+                                                                              mimetype))
+    if requestid not in output:
+        problems.append('{0}: request id not in the {1} response'.format(requestid, mimetype))
+    return problems
+
+
+def run_load_threads(threads, requests_per_thread, prefix='p'):
+    """
+    Render ``requests_per_thread`` requests in each of ``threads`` threads
+    concurrently. The views are created without a ``response`` argument,
+    so state shared through default arguments is detected.
+
+    :return: ``(latencies, problems, seconds)`` tuple, where ``latencies``
+        is a list with the seconds used by each request, ``problems`` is a
+        list of problems found by :func:`check_load_response`, and
+        ``seconds`` is the wall time of the run.
+    """
+    from restfulgrok.mock import MockRequest
+    view_class = _get_load_view_class()
+    latencies = []
+    problems = []
+    start = threading.Event()
+
+    def worker(threadindex):
+        start.wait()
+        for index in xrange(requests_per_thread):
+            # The "x" suffix makes sure no request id is a prefix of another
+            requestid = '{0}t{1}n{2}x'.format(prefix, threadindex, index)
+            acceptheader, mimetype = LOAD_ACCEPT_HEADERS[index % len(LOAD_ACCEPT_HEADERS)]
+            begin = timeit.default_timer()
+            view = view_class(request=MockRequest('GET', getdata={'requestid': requestid},
+                                                  headers={'Accept': acceptheader}))
+            output = view.render()
+            latencies.append(timeit.default_timer() - begin)
+            problems.extend(check_load_response(view, requestid, output, mimetype))
+
+    workers = [threading.Thread(target=worker, args=(threadindex,))
+               for threadindex in xrange(threads)]
+    for thread in workers:
+        thread.start()
+    begin = timeit.default_timer()
+    start.set()
+    for thread in workers:
+        thread.join()
+    return latencies, problems, timeit.default_timer() - begin
+
+
+def _run_load_process(args):
+    latencies, problems, seconds = run_load_threads(*args)
+    return latencies, problems
+
+
+def _percentile(values, percent):
+    return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+
+def benchmark_load(threadcounts=(1, 2, 4, 8, 16, 32, 64), processcounts=(1,),
+                   requests_per_thread=100):
+    """
+    Drive the mock views with each combination of ``processcounts`` worker
+    processes and ``threadcounts`` threads per process, and check every
+    response for data leaked from other requests (see
+    :func:`check_load_response`).
+
+    :return:
+        List of dicts with ``processes``, ``threads``, ``requests``,
+        ``throughput`` (requests per second), ``scaling`` (throughput
+        relative to the first combination), the ``p50``, ``p99`` and ``max``
+        latency in milliseconds, and the ``problems`` found.
+    """
+    # Warm up the caches, so the first run is not penalized
+    run_load_threads(1, len(LOAD_ACCEPT_HEADERS))
+    results = []
+    for processes in processcounts:
+        for threads in threadcounts:
+            if processes == 1:
+                latencies, problems, seconds = run_load_threads(threads, requests_per_thread)
+            else:
+                pool = multiprocessing.Pool(processes)
+                try:
+                    begin = timeit.default_timer()
+                    outputs = pool.map(_run_load_process,
+                                       [(threads, requests_per_thread, 'p{0}'.format(index))
+                                        for index in xrange(processes)])
+                    seconds = timeit.default_timer() - begin
+                finally:
+                    pool.terminate()
+                latencies = [latency for output in outputs for latency in output[0]]
+                problems = [problem for output in outputs for problem in output[1]]
+            latencies.sort()
+            throughput = len(latencies) / seconds
+            results.append({'processes': processes,
+                            'threads': threads,
+                            'requests': len(latencies),
+                            'throughput': throughput,
+                            'scaling': throughput / (results[0]['throughput'] if results else throughput),
+                            'p50': _percentile(latencies, 50) * 1000,
+                            'p99': _percentile(latencies, 99) * 1000,
+                            'max': latencies[-1] * 1000,
+                            'problems': problems})
+    return results
+
+
+def print_load(args):
+    results = benchmark_load(threadcounts=args.threads, processcounts=args.processes,
+                             requests_per_thread=args.requests)
+    print '{0:>9} {1:>7} {2:>8} {3:>10} {4:>7} {5:>9} {6:>9} {7:>9}  {8}'.format(
+        'processes', 'threads', 'requests', 'req/s', 'scaling', 'p50 ms', 'p99 ms', 'max ms', 'leaks')
+    for result in results:
+        print ('{processes:>9} {threads:>7} {requests:>8} {throughput:>10.0f} {scaling:>7.2f} '
+               '{p50:>9.2f} {p99:>9.2f} {max:>9.2f}  {leaks}').format(leaks=len(result['problems']),
+                                                                      **result)
+    problems = [problem for result in results for problem in result['problems']]
+    if problems:
+        print
+        print 'Cross-request state leakage detected:'
+        for problem in problems[:20]:
+            print '   ', problem
+        sys.exit(1)
+
+
+def _intlist(value):
+    return [int(item) for item in value.split(',')]
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Run restfulgrok benchmarks.')
+    subparsers = parser.add_subparsers()
+
+    importtime = subparsers.add_parser('importtime',
+                                       help='Time importing each public module.')
+    importtime.add_argument('--repeat', type=int, default=5)
+    importtime.set_defaults(func=print_importtime)
+
+    request = subparsers.add_parser('request',
+                                    help='Time the per-request overhead of the view.')
+    request.add_argument('--number', type=int, default=2000)
+    request.set_defaults(func=print_request)
+
+    negotiate = subparsers.add_parser('negotiate',
+                                      help='Time content type negotiation, including worst-case Accept headers.')
+    negotiate.add_argument('--number', type=int, default=200)
+    negotiate.set_defaults(func=print_negotiate)
+
+    load = subparsers.add_parser('load',
+                                 help='Render requests concurrently, and report throughput, '
+                                      'tail latency and cross-request state leakage.')
+    load.add_argument('--threads', type=_intlist, default=[1, 2, 4, 8, 16, 32, 64],
+                      help='Comma separated thread counts. Defaults to 1,2,4,8,16,32,64.')
+    load.add_argument('--processes', type=_intlist, default=[1],
+                      help='Comma separated process counts. Defaults to 1.')
+    load.add_argument('--requests', type=int, default=100,
+                      help='Requests per thread.')
+    load.set_defaults(func=print_load)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+"""
+Change feeds for collections, so clients can keep a copy of a collection in
+sync without fetching all of it. Example::
+
+    from restfulgrok.changefeed import ChangeFeedViewMixin
+
+    class ItemsView(ChangeFeedViewMixin, grok.View):
+        def handle_get(self):
+            return [item.asdict() for item in self.context.values()]
+
+        def handle_post(self):
+            item = self.context.add(self.get_requestdata_dict())
+            self.record_change(item.id, 'created')
+            return self.response_201_created(item.asdict())
+
+        def get_sync_items(self, itemids):
+            return dict((itemid, self.context[itemid].asdict())
+                        for itemid in itemids)
+
+GET responses include the sync token in the ``X-Sync-Token`` header. Use
+it as ``?since=<token>`` to get the changes after the token (see
+:meth:`ChangeFeedViewMixin.handle_changes`).
+"""
+import os
+import sqlite3
+import threading
+from collections import deque
+
+from view import GrokRestViewMixin
+
+
+#: The kinds of changes recorded in a :class:`ChangeLogStore`.
+CHANGES = ('created', 'modified', 'deleted')
+
+
+class InvalidSyncToken(ValueError):
+    """
+    Raised by :meth:`ChangeLogStore.get_changes` when the token is malformed.
+    """
+
+class SyncTokenExpired(InvalidSyncToken):
+    """
+    Raised by :meth:`ChangeLogStore.get_changes` when the changes after the
+    token are no longer in the change log, so the client has to fetch the
+    entire collection again.
+    """
+
+
+def coalesce_changes(entries):
+    """
+    Coalesce a list of ``(itemid, change)`` tuples, in the order the changes
+    were made, into one change per item:
+
+    - ``created`` followed by ``modified`` is ``created``.
+    - ``created`` followed by ``deleted`` is removed, since the client has
+      never seen the item.
+    - ``deleted`` followed by ``created`` is ``modified``.
+
+    :return: List of ``(itemid, change)`` tuples, ordered by the last change.
+    """
+    coalesced = {}
+    order = {}
+    for index, (itemid, change) in enumerate(entries):
+        previous = coalesced.get(itemid)
+        if previous == 'created':
+            if change == 'deleted':
+                del coalesced[itemid]
+                continue
+            change = 'created'
+        elif previous == 'deleted' and change == 'created':
+            change = 'modified'
+        coalesced[itemid] = change
+        order[itemid] = index
+    return sorted(coalesced.iteritems(), key=lambda item: order[item[0]])
+
+
+class ChangeLogStore(object):
+    """
+    Superclass for the change log used by :class:`ChangeFeedViewMixin`.
+
+    This class does not keep a log, so every token expires, and clients
+    always fetch the entire collection. Subclasses must override
+    :meth:`record`, :meth:`get_token` and :meth:`get_changes` to keep a log.
+
+    Sync tokens are strings containing the generation of the store and a
+    sequence number. The generation changes when the log is lost (for
+    example when a :class:`MemoryChangeLogStore` is created), so older tokens
+    expire.
+    """
+    #: Max number of changes kept for each collection. Tokens older than
+    #: the oldest kept change expire.
+    max_entries = 10000
+
+    #: The generation of the store (see the class docs).
+    generation = '0'
+
+    def record(self, collection, itemid, change):
+        """
+        Record a change.
+
+        :param collection: String identifying the collection.
+        :param itemid: String identifying the item within the collection.
+        :param change: One of :obj:`CHANGES`.
+        :return: The sync token after the change.
+        """
+        self._check_change(change)
+        return self.get_token(collection)
+
+    def get_token(self, collection):
+        """
+        Get the current sync token for ``collection``.
+        """
+        return self.format_token(self.generation, 0)
+
+    def get_changes(self, collection, token):
+        """
+        Get the changes to ``collection`` after ``token``.
+
+        :return:
+            ``(changes, token)`` tuple, where ``changes`` is a list of
+            ``(itemid, change)`` tuples (see :func:`coalesce_changes`), and
+            ``token`` is the current sync token.
+        :raise InvalidSyncToken: If ``token`` is malformed.
+        :raise SyncTokenExpired: If the changes after ``token`` are not in the log.
+        """
+        self.parse_token(token, self.generation)
+        raise SyncTokenExpired('Sync token expired: {0}'.format(token))
+
+    def format_token(self, generation, sequence):
+        return '{0}.{1}'.format(generation, sequence)
+
+    def parse_token(self, token, generation):
+        """
+        Get the sequence number from ``token``.
+
+        :raise InvalidSyncToken: If ``token`` is malformed.
+        :raise SyncTokenExpired: If ``token`` is from another generation.
+        """
+        try:
+            tokengeneration, sequence = token.split('.')
+            sequence = int(sequence)
+        except (AttributeError, ValueError):
+            raise InvalidSyncToken('Invalid sync token: {0!r}'.format(token))
+        if tokengeneration != generation:
+            raise SyncTokenExpired('Sync token expired: {0}'.format(token))
+        return sequence
+
+    def _check_change(self, change):
+        if change not in CHANGES:
+            raise ValueError('change must be one of {0!r}, not {1!r}'.format(CHANGES, change))
+
+
+class MemoryChangeLogStore(ChangeLogStore):
+    """
+    Thread-safe in-memory :class:`ChangeLogStore`. The log is local to the
+    process, and lost on restart (all tokens expire). Use
+    :class:`SqliteChangeLogStore` with multiple worker processes.
+    """
+    def __init__(self, max_entries=None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        self.generation = os.urandom(8).encode('hex')
+        self._sequence = 0
+        self._logs = {}
+        self._expired = {}
+        self._lock = threading.Lock()
+
+    def record(self, collection, itemid, change):
+        self._check_change(change)
+        with self._lock:
+            self._sequence += 1
+            log = self._logs.setdefault(collection, deque())
+            log.append((self._sequence, itemid, change))
+            while len(log) > self.max_entries:
+                self._expired[collection] = log.popleft()[0]
+            return self.format_token(self.generation, self._sequence)
+
+    def get_token(self, collection):
+        return self.format_token(self.generation, self._sequence)
+
+    def get_changes(self, collection, token):
+        since = self.parse_token(token, self.generation)
+        with self._lock:
+            if since < self._expired.get(collection, 0) or since > self._sequence:
+                raise SyncTokenExpired('Sync token expired: {0}'.format(token))
+            entries = [(itemid, change)
+                       for sequence, itemid, change in self._logs.get(collection, ())
+                       if sequence > since]
+            token = self.format_token(self.generation, self._sequence)
+        return coalesce_changes(entries), token
+
+
+class SqliteChangeLogStore(ChangeLogStore):
+    """
+    :class:`ChangeLogStore` in a SQLite database, shared by all processes
+    using the same database file. Each thread uses its own connection, and
+    the database uses write-ahead logging, so reads do not block writes.
+
+    Item ids are stored as strings.
+    """
+    def __init__(self, path, max_entries=None, timeout=30):
+        """
+        :param path: Path to the database file. Created if it does not exist.
+        :param timeout: Seconds to wait for a locked database.
+        """
+        if max_entries is not None:
+            self.max_entries = max_entries
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self.generation = self._setup()
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def _setup(self):
+        connection = self._connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('CREATE TABLE IF NOT EXISTS changelog ('
+                               'sequence INTEGER PRIMARY KEY AUTOINCREMENT, '
+                               'collection TEXT NOT NULL, itemid TEXT NOT NULL, '
+                               'change TEXT NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS changelog_collection '
+                               'ON changelog (collection, sequence)')
+            connection.execute('CREATE TABLE IF NOT EXISTS changelog_expired ('
+                               'collection TEXT PRIMARY KEY, sequence INTEGER NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS changelog_meta ('
+                               'key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            connection.execute('INSERT OR IGNORE INTO changelog_meta VALUES (?, ?)',
+                               ('generation', os.urandom(8).encode('hex')))
+            row = connection.execute('SELECT value FROM changelog_meta WHERE key = ?',
+                                     ('generation',)).fetchone()
+        return str(row[0])
+
+    def _get_sequence(self, connection):
+        row = connection.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changelog'").fetchone()
+        return row[0] if row else 0
+
+    def record(self, collection, itemid, change):
+        self._check_change(change)
+        connection = self._connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            cursor = connection.execute('INSERT INTO changelog (collection, itemid, change) '
+                                        'VALUES (?, ?, ?)',
+                                        (collection, unicode(itemid), change))
+            sequence = cursor.lastrowid
+            row = connection.execute('SELECT sequence FROM changelog WHERE collection = ? '
+                                     'ORDER BY sequence DESC LIMIT 1 OFFSET ?',
+                                     (collection, self.max_entries)).fetchone()
+            if row:
+                connection.execute('DELETE FROM changelog WHERE collection = ? AND sequence <= ?',
+                                   (collection, row[0]))
+                connection.execute('INSERT OR REPLACE INTO changelog_expired VALUES (?, ?)',
+                                   (collection, row[0]))
+        return self.format_token(self.generation, sequence)
+
+    def get_token(self, collection):
+        return self.format_token(self.generation, self._get_sequence(self._connect()))
+
+    def get_changes(self, collection, token):
+        since = self.parse_token(token, self.generation)
+        connection = self._connect()
+        with connection:
+            # A read transaction, so the changes and the token are consistent.
+            connection.execute('BEGIN')
+            sequence = self._get_sequence(connection)
+            row = connection.execute('SELECT sequence FROM changelog_expired WHERE collection = ?',
+                                     (collection,)).fetchone()
+            if since < (row[0] if row else 0) or since > sequence:
+                raise SyncTokenExpired('Sync token expired: {0}'.format(token))
+            entries = connection.execute('SELECT itemid, change FROM changelog '
+                                         'WHERE collection = ? AND sequence > ? AND sequence <= ? '
+                                         'ORDER BY sequence',
+                                         (collection, since, sequence)).fetchall()
+        return coalesce_changes(entries), self.format_token(self.generation, sequence)
+
+
+class ChangeFeedViewMixin(GrokRestViewMixin):
+    """
+    Mix-in that adds a change feed to a collection view. GET responses get
+    a sync token in the :obj:`sync_token_header` header, and
+    ``GET ?since=<token>`` responds with the changes after the token (see
+    :meth:`handle_changes`). Record changes with :meth:`record_change`.
+
+    Expired tokens are responded to with *410 Gone*, and malformed tokens
+    with *400 Bad Request*. Clients should fetch the entire collection again
+    when they get a 410 response.
+    """
+    #: The :class:`ChangeLogStore`.
+    changelog_store = MemoryChangeLogStore()
+
+    #: Response header with the sync token.
+    sync_token_header = 'X-Sync-Token'
+
+    def get_changelog_key(self):
+        """
+        Get the key of the collection in the :obj:`changelog_store`. Defaults
+        to :meth:`get_context_key`.
+        """
+        return self.get_context_key()
+
+    def record_change(self, itemid, change):
+        """
+        Record a change to the item with the given ``itemid`` in the change
+        log of this collection.
+
+        :param change: ``'created'``, ``'modified'`` or ``'deleted'``.
+        :return: The sync token after the change.
+        """
+        return self.changelog_store.record(self.get_changelog_key(), itemid, change)
+
+    def get_sync_items(self, itemids):
+        """
+        Override this to include created and modified items in the
+        :meth:`handle_changes` response.
+
+        :param itemids: The ids of created and modified items.
+        :return: A dict mapping item ids to the response data of the items.
+        """
+        return {}
+
+    def get_since_token(self):
+        """
+        Get the ``since`` sync token from the querystring, or ``None``.
+        """
+        return self.request.get('since') or None
+
+    def handle(self):
+        if self.get_requestmethod() in ('get', 'head') and not self.get_since_token():
+            # Get the token before handling the request, so changes made
+            # while handling it are included the next time.
+            token = self.changelog_store.get_token(self.get_changelog_key())
+            self.response.setHeader(self.sync_token_header, token)
+        return super(ChangeFeedViewMixin, self).handle()
+
+    def get_handler(self, method):
+        if method == 'get' and self.get_since_token():
+            return self.handle_changes
+        return super(ChangeFeedViewMixin, self).get_handler(method)
+
+    def get_resource_metadata(self):
+        if self.get_since_token():
+            return None
+        return super(ChangeFeedViewMixin, self).get_resource_metadata()
+
+    def handle_changes(self):
+        """
+        Handle ``GET ?since=<token>``. Responds with::
+
+            {"sync_token": "<token>",
+             "changes": [{"id": "<itemid>", "change": "modified", "item": {...}},
+                         {"id": "<itemid>", "change": "deleted"}]}
+
+        ``item`` is included for created and modified items returned by
+        :meth:`get_sync_items`.
+        """
+        since = self.get_since_token()
+        try:
+            changes, token = self.changelog_store.get_changes(self.get_changelog_key(), since)
+        except SyncTokenExpired, e:
+            return self.response_410_gone(str(e))
+        except InvalidSyncToken, e:
+            return self.response_400_bad_request({'error': str(e)})
+        self.response.setHeader(self.sync_token_header, token)
+        items = self.get_sync_items([itemid for itemid, change in changes
+                                     if change != 'deleted'])
+        responsedata = []
+        for itemid, change in changes:
+            entry = {'id': itemid, 'change': change}
+            if itemid in items:
+                entry['item'] = items[itemid]
+            responsedata.append(entry)
+        return {'sync_token': token, 'changes': responsedata}
+
+    def response_410_gone(self, error='Gone'):
+        """
+        Respond with 410 Gone, and ``{'error': error}`` as body.
+        """
+        return self.create_response(410, 'Gone', {'error': error})
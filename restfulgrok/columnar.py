@@ -0,0 +1,214 @@
+"""
+Columnar content types for analytics clients: the `Apache Arrow
+<http://arrow.apache.org/>`_ IPC stream format, and Parquet as a download
+variant. They require ``pyarrow``, and are only added to
+:obj:`columnar_content_types` when ``pyarrow`` is installed. Example::
+
+    from restfulgrok.columnar import columnar_content_types
+
+    class RecordsView(GrokRestViewMixin, grok.View):
+        content_types = GrokRestViewMixin.content_types + columnar_content_types
+
+``pyarrow`` is not imported until a response is encoded or a request is
+decoded.
+"""
+import pkgutil
+from io import BytesIO
+from collections import OrderedDict
+
+from contenttype import ContentType
+from contenttype import ContentTypesRegistry
+from contenttype import ContentTypeDumpError
+from contenttype import ContentTypeLoadError
+from contenttype import get_input_limits
+
+
+def pyarrow_available():
+    """
+    Return ``True`` if ``pyarrow`` can be imported. Does not import it.
+    """
+    return pkgutil.find_loader('pyarrow') is not None
+
+
+def iter_column_batches(pydata, batch_size, columns=None):
+    """
+    Split response data into batches of columns.
+
+    :param pydata:
+        A dict of columns (a dict where all values are lists or tuples), or
+        an iterable of rows (dicts). Any other dict is handled as a single
+        row.
+    :param batch_size: Max number of rows in each batch.
+    :param columns:
+        The column names. Defaults to the keys of the dict of columns, or
+        the keys of the first row (sorted, unless the row is an
+        ``OrderedDict``).
+    :return: Iterator of ``(names, columns)`` tuples, where ``columns`` is a
+        list with a list of values for each of the ``names``.
+    :raise restfulgrok.contenttype.ContentTypeDumpError: If a row is not a dict.
+    """
+    if isinstance(pydata, dict):
+        if pydata and all(isinstance(value, (list, tuple)) for value in pydata.itervalues()):
+            names = list(columns) if columns is not None else sorted(pydata.keys())
+            length = max(len(pydata[name]) for name in names) if names else 0
+            for start in xrange(0, length, batch_size):
+                yield names, [list(pydata[name][start:start + batch_size]) for name in names]
+            return
+        pydata = [pydata]
+    names = columns
+    batch = []
+    for row in pydata:
+        if not isinstance(row, dict):
+            raise ContentTypeDumpError('Rows must be dicts, not {0}.'.format(type(row).__name__))
+        if names is None:
+            if isinstance(row, OrderedDict):
+                names = row.keys()
+            else:
+                names = sorted(row.keys())
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield names, [[item.get(name) for item in batch] for name in names]
+            batch = []
+    if batch:
+        yield names, [[item.get(name) for item in batch] for name in names]
+
+
+class ColumnarContentType(ContentType):
+    """
+    Base class for the ``pyarrow`` content types. Uses the Apache Arrow IPC
+    stream format unless :meth:`write_batches` and :meth:`read_table` are
+    overridden (see :class:`ParquetContentType`). Encodes the data in record
+    batches of at most :obj:`batch_size` rows, so only one batch of columns
+    is in memory at a time. The column types are inferred from the first
+    batch. The columns are taken from the ``columnar_columns`` attribute of
+    the view if it is set.
+    """
+    #: Binary content, so no charset in the Content-Type header.
+    charset = None
+
+    #: Max number of rows in each record batch.
+    batch_size = 65536
+
+    @classmethod
+    def iter_record_batches(cls, pydata, view=None):
+        """
+        Iterate over ``pyarrow.RecordBatch`` objects for ``pydata`` (see
+        :func:`iter_column_batches`).
+        """
+        import pyarrow
+        schema = None
+        columns = getattr(view, 'columnar_columns', None)
+        for names, columndata in iter_column_batches(pydata, cls.batch_size, columns):
+            if schema is None:
+                arrays = [pyarrow.array(values) for values in columndata]
+            else:
+                arrays = [pyarrow.array(values, type=field.type)
+                          for values, field in zip(columndata, schema)]
+            batch = pyarrow.RecordBatch.from_arrays(arrays, names)
+            schema = batch.schema
+            yield batch
+
+    @classmethod
+    def write_batches(cls, batches, fileobj):
+        """
+        Write the ``pyarrow.RecordBatch`` objects in ``batches`` to ``fileobj``.
+        Defaults to the Apache Arrow IPC stream format.
+        """
+        import pyarrow
+        writer = None
+        for batch in batches:
+            if writer is None:
+                writer = pyarrow.RecordBatchStreamWriter(fileobj, batch.schema)
+            writer.write_batch(batch)
+        if writer is None:
+            writer = pyarrow.RecordBatchStreamWriter(fileobj, pyarrow.schema([]))
+        writer.close()
+
+    @classmethod
+    def dump(cls, pydata, fileobj, view=None):
+        import pyarrow
+        try:
+            cls.write_batches(cls.iter_record_batches(pydata, view), fileobj)
+        except (pyarrow.ArrowException, TypeError, ValueError), e:
+            raise ContentTypeDumpError(str(e))
+
+    @classmethod
+    def dumps(cls, pydata, view=None):
+        fileobj = BytesIO()
+        cls.dump(pydata, fileobj, view)
+        return fileobj.getvalue()
+
+    @classmethod
+    def read_table(cls, rawdata):
+        """
+        Read ``rawdata`` into a ``pyarrow.Table``. Defaults to the Apache
+        Arrow IPC stream format.
+        """
+        import pyarrow
+        return pyarrow.RecordBatchStreamReader(pyarrow.BufferReader(rawdata)).read_all()
+
+    @classmethod
+    def loads(cls, rawdata, view=None):
+        """
+        Decode ``rawdata`` into a list of dicts (rows).
+        """
+        import pyarrow
+        limits = get_input_limits(view)
+        limits.check_body_size(rawdata)
+        try:
+            table = cls.read_table(rawdata)
+        except (pyarrow.ArrowException, TypeError, ValueError), e:
+            raise ContentTypeLoadError(str(e))
+        limits.check_elements(table.num_rows * table.num_columns)
+        columns = table.to_pydict()
+        names = table.schema.names
+        return [dict(zip(names, values))
+                for values in zip(*[columns[name] for name in names])]
+
+
+class ArrowStreamContentType(ColumnarContentType):
+    """
+    Apache Arrow IPC stream format.
+    """
+    mimetype = 'application/vnd.apache.arrow.stream'
+    extension = 'arrows'
+    description = ('Apache Arrow IPC stream. Columnar data that can be loaded '
+                   'directly into data frames.')
+
+
+class ParquetContentType(ColumnarContentType):
+    """
+    Apache Parquet file format. Mainly for downloads
+    (``?mimetype=application/vnd.apache.parquet&downloadfile=true``).
+    """
+    mimetype = 'application/vnd.apache.parquet'
+    extension = 'parquet'
+    description = 'Apache Parquet file. Columnar data for download and archiving.'
+
+    @classmethod
+    def write_batches(cls, batches, fileobj):
+        import pyarrow
+        import pyarrow.parquet
+        writer = None
+        for batch in batches:
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(fileobj, batch.schema)
+            writer.write_table(pyarrow.Table.from_batches([batch]))
+        if writer is None:
+            writer = pyarrow.parquet.ParquetWriter(fileobj, pyarrow.schema([]))
+        writer.close()
+
+    @classmethod
+    def read_table(cls, rawdata):
+        import pyarrow
+        import pyarrow.parquet
+        return pyarrow.parquet.read_table(pyarrow.BufferReader(rawdata))
+
+
+#: :class:`restfulgrok.contenttype.ContentTypesRegistry` with
+#: :class:`ArrowStreamContentType` and :class:`ParquetContentType` if
+#: ``pyarrow`` is installed, and empty otherwise.
+if pyarrow_available():
+    columnar_content_types = ContentTypesRegistry(ArrowStreamContentType, ParquetContentType)
+else:
+    columnar_content_types = ContentTypesRegistry()
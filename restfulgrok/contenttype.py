@@ -1,6 +1,12 @@
+import os
+import re
+import csv
 import json
-import yaml
-import negotiator
+from StringIO import StringIO
+from collections import namedtuple
+from collections import OrderedDict
+
+from typeadapters import default_type_adapters
 
 
 class ContentTypeError(Exception):
@@ -18,6 +24,75 @@ class ContentTypeDumpError(ContentTypeError):
     Raised when :meth:`ContentType.dumps` fails.
     """
 
+class UnsupportedMediaType(ContentTypeError):
+    """
+    Raised when the request body has a content type that is not supported.
+    """
+
+class InputLimitExceeded(ContentTypeLoadError):
+    """
+    Raised when :meth:`ContentType.loads` rejects input that exceeds the
+    :class:`InputLimits`.
+    """
+
+class RequestEntityTooLarge(InputLimitExceeded):
+    """
+    Raised when the input is larger than :attr:`InputLimits.max_body_bytes`.
+    """
+
+
+class InputLimits(object):
+    """
+    Limits enforced when decoding request bodies, to protect the server
+    from huge or adversarial input. Set as ``input_limits`` on a
+    :class:`restfulgrok.view.GrokRestViewMixin`. Use ``None`` for no limit.
+    """
+    def __init__(self, max_body_bytes=None, max_depth=100, max_elements=1000000,
+                 max_yaml_aliases=None):
+        """
+        :param max_body_bytes: Max size of the request body in bytes.
+        :param max_depth: Max nesting depth of lists and mappings.
+        :param max_elements:
+            Max number of elements (values, lists and mappings). YAML aliases
+            count as the number of elements in the node they refer to, so
+            alias expansion attacks are stopped by this limit.
+        :param max_yaml_aliases:
+            Max number of aliases in YAML documents. Use ``0`` to reject all
+            aliases.
+        """
+        self.max_body_bytes = max_body_bytes
+        self.max_depth = max_depth
+        self.max_elements = max_elements
+        self.max_yaml_aliases = max_yaml_aliases
+
+    def check_body_size(self, rawdata):
+        """
+        :raise RequestEntityTooLarge: If ``rawdata`` is larger than ``max_body_bytes``.
+        """
+        if self.max_body_bytes is not None and len(rawdata) > self.max_body_bytes:
+            raise RequestEntityTooLarge('Request body is larger than {0} bytes.'.format(self.max_body_bytes))
+
+    def check_depth(self, depth):
+        if self.max_depth is not None and depth > self.max_depth:
+            raise InputLimitExceeded('Input is nested deeper than {0} levels.'.format(self.max_depth))
+
+    def check_elements(self, elements):
+        if self.max_elements is not None and elements > self.max_elements:
+            raise InputLimitExceeded('Input has more than {0} elements.'.format(self.max_elements))
+
+    def check_yaml_aliases(self, aliases):
+        if self.max_yaml_aliases is not None and aliases > self.max_yaml_aliases:
+            raise InputLimitExceeded('Input has more than {0} YAML aliases.'.format(self.max_yaml_aliases))
+
+
+#: The :class:`InputLimits` used when ``loads()`` is called without a view.
+default_input_limits = InputLimits()
+
+def get_input_limits(view):
+    """
+    Get the :class:`InputLimits` of ``view``, or :obj:`default_input_limits`.
+    """
+    return getattr(view, 'input_limits', None) or default_input_limits
 
 
 class ContentType(object):
@@ -33,6 +108,26 @@ class ContentType(object):
     #: A short description for users of the content-type.
     description = ''
 
+    #: The charset added to the Content-Type header. Set this to ``None`` for
+    #: binary content types.
+    charset = 'UTF-8'
+
+    #: Set this to ``True`` if :meth:`dumps` does not use the ``view``
+    #: argument, which means it can be run in another process by
+    #: :class:`restfulgrok.offload.EncodingPool`.
+    offloadable = False
+
+    #: Set this to ``True`` if the output of :meth:`dumps` for an error
+    #: response only depends on the data, status and status message, which
+    #: means it can be cached in
+    #: :obj:`restfulgrok.view.GrokRestViewMixin.error_cache`.
+    error_cacheable = False
+
+    #: Set this to ``True`` if :meth:`iterdumps` encodes the data
+    #: incrementally, so the response can be sent while it is encoded (see
+    #: :obj:`restfulgrok.view.GrokRestViewMixin.stream_responses`).
+    streamable = False
+
     def __init__(self):
         raise Exception('You can not create instances of ContentType subclasses.')
 
@@ -46,6 +141,32 @@ class ContentType(object):
         """
         return pydata
 
+    @classmethod
+    def dump(cls, pydata, fileobj, view):
+        """
+        Dump ``pydata`` to the file-like object ``fileobj``. Defaults to
+        writing the output of :meth:`dumps`, so you only need to override this
+        if your content-type can be written incrementally.
+
+        :param pydata: The python data to encode.
+        :param fileobj: A file-like object with a ``write()`` method.
+        :param view: A :class:`GrokRestViewMixin` instance.
+        """
+        fileobj.write(cls.dumps(pydata, view))
+
+    @classmethod
+    def iterdumps(cls, pydata, view):
+        """
+        Dump ``pydata`` to an iterator of strings. Defaults to an iterator
+        with the output of :meth:`dumps`, so you only need to override this
+        (and set :obj:`streamable`) if your content-type can be encoded
+        incrementally.
+
+        :param pydata: The python data to encode.
+        :param view: A :class:`GrokRestViewMixin` instance.
+        """
+        return iter([cls.dumps(pydata, view)])
+
     @classmethod
     def loads(cls, rawdata, view):
         """
@@ -57,6 +178,70 @@ class ContentType(object):
         return rawdata
 
 
+class RawFragment(object):
+    """
+    Already encoded JSON that :class:`JsonContentType` writes to the output
+    as it is, without decoding and encoding it again. Use it to build
+    responses from cached JSON::
+
+        return {'items': [RawFragment(cache.get(itemid)) for itemid in itemids]}
+
+    The JSON is not validated, so it must come from a trusted encoder.
+    Other content types, and the YAML content type, decode the JSON using
+    :meth:`decode` (it is registered in
+    :obj:`restfulgrok.typeadapters.default_type_adapters`).
+    """
+    def __init__(self, json):
+        """
+        :param json: A JSON encoded string.
+        """
+        if isinstance(json, unicode):
+            json = json.encode('utf-8')
+        self.json = json
+
+    def decode(self):
+        """
+        Decode the JSON.
+        """
+        return json.loads(self.json)
+
+    def __repr__(self):
+        return 'RawFragment({0!r})'.format(self.json)
+
+default_type_adapters.register(RawFragment, RawFragment.decode)
+
+
+class _RawFragmentSplicer(object):
+    """
+    Used by :class:`JsonContentType` to encode :class:`RawFragment` objects
+    as unique placeholder strings, and replace the encoded placeholders with
+    the fragments.
+    """
+    def __init__(self, type_adapters):
+        self.type_adapters = type_adapters
+        self.fragments = []
+        self.prefix = None
+        self.placeholder_re = None
+
+    def default(self, obj):
+        if isinstance(obj, RawFragment):
+            if self.placeholder_re is None:
+                nonce = os.urandom(8).encode('hex')
+                self.prefix = u'\x00rawfragment-{0}-'.format(nonce)
+                self.placeholder_re = re.compile(r'"\\u0000rawfragment-{0}-(\d+)"'.format(nonce))
+            self.fragments.append(obj.json)
+            return self.prefix + unicode(len(self.fragments) - 1)
+        return self.type_adapters.adapt(obj)
+
+    def _replace(self, match):
+        return self.fragments[int(match.group(1))]
+
+    def splice(self, encoded):
+        if self.placeholder_re is None:
+            return encoded
+        return self.placeholder_re.sub(self._replace, encoded)
+
+
 json_description = """
 Javascript Object Notation, a lightweight data-interchange format with parsers
 available for most programming languages. The Python programming language has
@@ -77,11 +262,30 @@ class JsonContentType(ContentType):
     mimetype = 'application/json'
     extension = 'json'
     description = json_description
+    offloadable = True
+    error_cacheable = True
+
+    #: The :class:`restfulgrok.typeadapters.TypeAdapterRegistry` used to
+    #: encode objects that are not supported by ``json``.
+    type_adapters = default_type_adapters
 
     @classmethod
     def dumps(cls, pydata, view=None):
+        splicer = _RawFragmentSplicer(cls.type_adapters)
+        try:
+            return splicer.splice(json.dumps(pydata, indent=2, default=splicer.default))
+        except TypeError, e:
+            raise ContentTypeDumpError(str(e))
+        except ValueError, e:
+            raise ContentTypeDumpError(str(e))
+
+    @classmethod
+    def dump(cls, pydata, fileobj, view=None):
+        splicer = _RawFragmentSplicer(cls.type_adapters)
         try:
-            return json.dumps(pydata, indent=2)
+            # Placeholders are always encoded as a single chunk.
+            for chunk in json.JSONEncoder(indent=2, default=splicer.default).iterencode(pydata):
+                fileobj.write(splicer.splice(chunk))
         except TypeError, e:
             raise ContentTypeDumpError(str(e))
         except ValueError, e:
@@ -89,12 +293,60 @@ class JsonContentType(ContentType):
 
     @classmethod
     def loads(cls, rawdata, view=None):
+        limits = get_input_limits(view)
+        limits.check_body_size(rawdata)
+        if limits.max_depth is not None or limits.max_elements is not None:
+            _check_json_structure(rawdata, limits)
         try:
             return json.loads(rawdata)
         except TypeError, e:
             raise ContentTypeLoadError(str(e))
         except ValueError, e:
-            raise ContentTypeDumpError(str(e))
+            raise ContentTypeLoadError(str(e))
+
+
+# The tokens that open, close and separate elements, and the start of strings.
+_json_structure_re = re.compile(r'[\[\]{},"]')
+# The end of a string, or an escape within a string.
+_json_string_re = re.compile(r'["\\]')
+
+def _check_json_structure(rawdata, limits):
+    # Scan the JSON before parsing it, so we never build huge or deeply
+    # nested structures (json.loads fails with a RuntimeError when nesting
+    # exceeds the recursion limit). Each character is scanned at most once,
+    # so hostile input, like unterminated strings, can not make this slow.
+    search_structure = _json_structure_re.search
+    search_string = _json_string_re.search
+    depth = 0
+    elements = 1
+    position = 0
+    while True:
+        match = search_structure(rawdata, position)
+        if match is None:
+            return
+        token = match.group()
+        position = match.end()
+        if token == '"':
+            # Skip to the end of the string, so brackets and commas within
+            # strings are not counted.
+            while True:
+                match = search_string(rawdata, position)
+                if match is None:
+                    return # Unterminated string. Reported by json.loads.
+                position = match.end()
+                if match.group() == '"':
+                    break
+                position += 1 # Skip the escaped character
+        elif token == '[' or token == '{':
+            depth += 1
+            elements += 1
+            limits.check_depth(depth)
+            limits.check_elements(elements)
+        elif token == ']' or token == '}':
+            depth -= 1
+        else:
+            elements += 1
+            limits.check_elements(elements)
 
 class YamlContentType(ContentType):
     """
@@ -103,32 +355,453 @@ class YamlContentType(ContentType):
     mimetype = 'application/x-yaml'
     extension = 'yaml'
     description = yaml_description
+    offloadable = True
+    error_cacheable = True
+
+    #: The :class:`restfulgrok.typeadapters.TypeAdapterRegistry` used to
+    #: encode objects that are not supported by ``yaml.SafeDumper``.
+    type_adapters = default_type_adapters
 
     @classmethod
     def dumps(cls, pydata, view=None):
+        import yaml
+        try:
+            return yaml.dump(pydata, Dumper=cls.type_adapters.get_yaml_dumper(),
+                             default_flow_style=False)
+        except yaml.YAMLError, e:
+            raise ContentTypeDumpError(str(e))
+
+    @classmethod
+    def dump(cls, pydata, fileobj, view=None):
+        import yaml
         try:
-            return yaml.safe_dump(pydata, default_flow_style=False)
+            yaml.dump(pydata, fileobj, Dumper=cls.type_adapters.get_yaml_dumper(),
+                      default_flow_style=False)
         except yaml.YAMLError, e:
             raise ContentTypeDumpError(str(e))
 
     @classmethod
     def loads(cls, rawdata, view=None):
+        import yaml
+        limits = get_input_limits(view)
+        limits.check_body_size(rawdata)
+        loader = _get_limited_yaml_loader()(rawdata, limits)
         try:
-            return yaml.safe_load(rawdata)
+            return loader.get_single_data()
         except yaml.YAMLError, e:
             raise ContentTypeLoadError(str(e))
+        finally:
+            loader.dispose()
+
+
+_limited_yaml_loader = None
+
+def _get_limited_yaml_loader():
+    global _limited_yaml_loader
+    if _limited_yaml_loader is None:
+        import yaml
+
+        class LimitedSafeLoader(yaml.SafeLoader):
+            """
+            ``yaml.SafeLoader`` that enforces :class:`InputLimits` while
+            composing the document, before anything is constructed.
+            """
+            def __init__(self, stream, limits):
+                yaml.SafeLoader.__init__(self, stream)
+                self.limits = limits
+                self.depth = 0
+                self.elements = 0
+                self.aliases = 0
+                self.node_elements = {}
+
+            def compose_node(self, parent, index):
+                if self.check_event(yaml.AliasEvent):
+                    self.aliases += 1
+                    self.limits.check_yaml_aliases(self.aliases)
+                    node = self.anchors.get(self.peek_event().anchor)
+                    if node is not None:
+                        # Aliases expand to the full referenced node
+                        self.elements += self.node_elements.get(node, 1)
+                        self.limits.check_elements(self.elements)
+                    return yaml.SafeLoader.compose_node(self, parent, index)
+                is_collection = not self.check_event(yaml.ScalarEvent)
+                if is_collection:
+                    self.depth += 1
+                    self.limits.check_depth(self.depth)
+                elements_before = self.elements
+                self.elements += 1
+                self.limits.check_elements(self.elements)
+                node = yaml.SafeLoader.compose_node(self, parent, index)
+                self.node_elements[node] = self.elements - elements_before
+                if is_collection:
+                    self.depth -= 1
+                return node
+        _limited_yaml_loader = LimitedSafeLoader
+    return _limited_yaml_loader
+
+
+class CsvContentType(ContentType):
+    """
+    CSV content type for lists of flat records (dicts). Not in the default
+    ``content_types``, so add it to the views that return records::
+
+        csv_types = ContentTypesRegistry(CsvContentType, TsvContentType)
+        content_types = GrokRestViewMixin.content_types + csv_types
+
+    :meth:`dump` writes the rows one at a time, so the response data may
+    be any iterable, such as a generator. A dict is written as a single
+    row. The columns are taken from the ``csv_columns`` attribute of the
+    view, if it is set, and from the keys of the first row otherwise
+    (sorted, unless the row is an ``OrderedDict``). Keys that are not in
+    the columns are ignored. Rows may also be sequences of values, and
+    strings are written as rows with a single column. Lists and dicts in
+    values are written as JSON, and other values are adapted using
+    :obj:`type_adapters`. Strings that spreadsheets would run as formulas
+    are escaped (see :obj:`escape_formulas`).
+
+    :meth:`loads` returns a list of dicts with unicode values, using the
+    first row as header. Use :meth:`iterloads` to decode large request
+    bodies one row at a time.
+    """
+    mimetype = 'text/csv'
+    extension = 'csv'
+    description = 'Comma-separated values, with a header row. Suitable for spreadsheets.'
+    streamable = True
+
+    #: The field delimiter.
+    delimiter = ','
+
+    #: The :class:`restfulgrok.typeadapters.TypeAdapterRegistry` used to
+    #: encode values that are not strings, numbers, booleans, lists or dicts.
+    type_adapters = default_type_adapters
+
+    #: Prefix strings starting with one of the :obj:`formula_prefixes` with
+    #: ``'``, so spreadsheets show them as text instead of running them as
+    #: formulas (CSV injection). Numbers are not escaped. Set this to
+    #: ``False`` if the output is not opened in spreadsheets, and must
+    #: round-trip unchanged.
+    escape_formulas = True
+
+    #: The characters that start a formula in spreadsheets.
+    formula_prefixes = ('=', '+', '-', '@', '\t', '\r')
+
+    #: Approximate number of bytes in each chunk yielded by :meth:`iterdumps`.
+    chunk_size = 65536
+
+    @classmethod
+    def get_columns(cls, first_row, view=None):
+        """
+        Get the columns for rows starting with ``first_row``.
+
+        :return: A list of keys, or ``None`` if the rows are sequences.
+        """
+        columns = getattr(view, 'csv_columns', None)
+        if columns is not None:
+            return list(columns)
+        if isinstance(first_row, OrderedDict):
+            return first_row.keys()
+        elif isinstance(first_row, dict):
+            return sorted(first_row.keys())
+        return None
+
+    @classmethod
+    def escape_formula(cls, value):
+        """
+        Escape the encoded string ``value`` if it starts a formula, and
+        :obj:`escape_formulas` is ``True``.
+        """
+        if cls.escape_formulas and value.startswith(cls.formula_prefixes):
+            return "'" + value
+        return value
+
+    @classmethod
+    def encode_value(cls, value):
+        if value is None:
+            return ''
+        elif isinstance(value, unicode):
+            return cls.escape_formula(value.encode('utf-8'))
+        elif isinstance(value, str):
+            return cls.escape_formula(value)
+        elif isinstance(value, bool):
+            return 'true' if value else 'false'
+        elif isinstance(value, (int, long, float)):
+            return repr(value) if isinstance(value, float) else str(value)
+        elif isinstance(value, (list, tuple, dict)):
+            return json.dumps(value, default=cls.type_adapters.adapt)
+        return cls.encode_value(cls.type_adapters.adapt(value))
+
+    @classmethod
+    def iterrows(cls, pydata, view=None):
+        """
+        Iterate over the rows of ``pydata`` as lists of encoded values,
+        starting with the header row if the rows are dicts.
+        """
+        if isinstance(pydata, dict):
+            pydata = [pydata]
+        encode_value = cls.encode_value
+        columns = None
+        for index, row in enumerate(pydata):
+            if index == 0:
+                columns = cls.get_columns(row, view)
+                if columns is not None:
+                    yield [encode_value(column) for column in columns]
+            if isinstance(row, dict):
+                if columns is None:
+                    raise ContentTypeDumpError('Rows must be sequences when the first row is.')
+                yield [encode_value(row.get(column)) for column in columns]
+            elif isinstance(row, basestring):
+                yield [encode_value(row)]
+            else:
+                yield [encode_value(value) for value in row]
+
+    @classmethod
+    def dump(cls, pydata, fileobj, view=None):
+        writer = csv.writer(fileobj, delimiter=cls.delimiter, lineterminator='\r\n')
+        try:
+            for row in cls.iterrows(pydata, view):
+                writer.writerow(row)
+        except TypeError, e:
+            raise ContentTypeDumpError(str(e))
+        except csv.Error, e:
+            raise ContentTypeDumpError(str(e))
+
+    @classmethod
+    def iterdumps(cls, pydata, view=None):
+        """
+        Encode ``pydata`` as chunks of about :obj:`chunk_size` bytes, so the
+        rows are encoded while the response is sent.
+        """
+        fileobj = StringIO()
+        writer = csv.writer(fileobj, delimiter=cls.delimiter, lineterminator='\r\n')
+        try:
+            for row in cls.iterrows(pydata, view):
+                writer.writerow(row)
+                if fileobj.tell() >= cls.chunk_size:
+                    yield fileobj.getvalue()
+                    fileobj.seek(0)
+                    fileobj.truncate()
+        except TypeError, e:
+            raise ContentTypeDumpError(str(e))
+        except csv.Error, e:
+            raise ContentTypeDumpError(str(e))
+        if fileobj.tell():
+            yield fileobj.getvalue()
+
+    @classmethod
+    def dumps(cls, pydata, view=None):
+        return ''.join(cls.iterdumps(pydata, view))
+
+    @classmethod
+    def iterloads(cls, fileobj, view=None):
+        """
+        Decode the CSV in the file-like object ``fileobj`` one row at a time.
+        The ``max_body_bytes`` and ``max_elements`` input limits are checked
+        as the rows are read.
+
+        :return: Iterator of dicts with unicode values.
+        """
+        limits = get_input_limits(view)
+        reader = csv.reader(_limited_lines(fileobj, limits), delimiter=cls.delimiter)
+        elements = 0
+        try:
+            header = None
+            for row in reader:
+                elements += len(row)
+                limits.check_elements(elements)
+                row = [value.decode('utf-8') for value in row]
+                if header is None:
+                    header = row
+                elif row:
+                    if len(row) != len(header):
+                        raise ContentTypeLoadError('Row {0} has {1} fields, expected {2}.'.format(
+                            reader.line_num, len(row), len(header)))
+                    yield dict(zip(header, row))
+        except csv.Error, e:
+            raise ContentTypeLoadError(str(e))
+        except UnicodeDecodeError, e:
+            raise ContentTypeLoadError(str(e))
+
+    @classmethod
+    def loads(cls, rawdata, view=None):
+        get_input_limits(view).check_body_size(rawdata)
+        return list(cls.iterloads(StringIO(rawdata), view))
+
+
+class TsvContentType(CsvContentType):
+    """
+    Tab-separated values. Just like :class:`CsvContentType`, except for the
+    delimiter.
+    """
+    mimetype = 'text/tab-separated-values'
+    extension = 'tsv'
+    description = 'Tab-separated values, with a header row. Suitable for spreadsheets.'
+    delimiter = '\t'
+
+
+def _limited_lines(fileobj, limits, chunksize=65536):
+    # Iterate over the lines in fileobj. The file is read in chunks, and
+    # RequestEntityTooLarge is raised as soon as more than max_body_bytes are
+    # read, so a huge line is never read into memory.
+    size = 0
+    pending = ''
+    while True:
+        chunk = fileobj.read(chunksize)
+        if not chunk:
+            break
+        size += len(chunk)
+        if limits.max_body_bytes is not None and size > limits.max_body_bytes:
+            raise RequestEntityTooLarge('Request body is larger than {0} bytes.'.format(limits.max_body_bytes))
+        lines = (pending + chunk).splitlines(True)
+        # Keep the last line until we know it is complete (a line ending with
+        # "\r" may continue with "\n" in the next chunk).
+        pending = lines.pop()
+        if pending.endswith('\n'):
+            lines.append(pending)
+            pending = ''
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+class ResponseProfile(namedtuple('ResponseProfile',
+                                   'content_type mimetype contenttype_header dumps iterdumps')):
+    """
+    Immutable, precomputed settings for responding with a :class:`ContentType`.
+    Created once for each content type by :class:`ContentTypesRegistry`, and
+    picked by content negotiation (see :meth:`ContentTypesRegistry.negotiate_profile`),
+    so nothing here has to be computed for each request.
+
+    .. attribute:: contenttype_header
+
+        The value of the Content-Type header, including the charset.
+
+    .. attribute:: dumps
+
+        The encoder. The :meth:`ContentType.dumps` method of the content type.
+
+    .. attribute:: iterdumps
+
+        The streaming encoder. The :meth:`ContentType.iterdumps` method of the content type.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_content_type(cls, content_type):
+        """
+        Create a profile for the given ``content_type``.
+        """
+        if content_type.charset:
+            contenttype_header = '{0}; charset={1}'.format(content_type.mimetype,
+                                                           content_type.charset)
+        else:
+            contenttype_header = content_type.mimetype
+        return cls(content_type=content_type,
+                   mimetype=content_type.mimetype,
+                   contenttype_header=contenttype_header,
+                   dumps=content_type.dumps,
+                   iterdumps=content_type.iterdumps)
+
+
+_accept_mediarange_re = re.compile(r"^[a-z0-9!#$%&'*+.^_`|~-]+/[a-z0-9!#$%&'*+.^_`|~-]+$")
+_accept_qvalue_re = re.compile(r'^q\s*=\s*([0-9]{1,3}(?:\.[0-9]{0,3})?)$')
+
+def parse_accept_header(acceptheader, max_length=4096, max_entries=64):
+    """
+    Parse a HTTP Accept header into a list of ``(mediarange, qvalue)``
+    tuples. The media ranges are ``type/subtype`` in lowercase, and the
+    q-values are strings, or ``None`` if the entry has no q-value. Media
+    range parameters other than ``q`` are ignored, q-values above ``1`` are
+    changed to ``'1'``, and q-values of zero to ``'0'``. Invalid entries are
+    removed.
+
+    :param max_length:
+        Only the entries in the first ``max_length`` characters of the
+        header are used.
+    :param max_entries: Only the first ``max_entries`` entries are used.
+    """
+    if len(acceptheader) > max_length:
+        acceptheader = acceptheader[:max(0, acceptheader.rfind(',', 0, max_length + 1))]
+    entries = []
+    for entry in acceptheader.lower().split(',', max_entries)[:max_entries]:
+        components = entry.split(';')
+        mediarange = components[0].strip()
+        if not _accept_mediarange_re.match(mediarange):
+            continue
+        qvalue = None
+        for param in components[1:]:
+            if param.split('=', 1)[0].strip() == 'q':
+                match = _accept_qvalue_re.match(param.strip())
+                if not match:
+                    qvalue = False
+                    break
+                qvalue = match.group(1)
+        if qvalue is False:
+            continue
+        if qvalue is not None:
+            if float(qvalue) == 0:
+                qvalue = '0'
+            elif float(qvalue) > 1:
+                qvalue = '1'
+        entries.append((str(mediarange), qvalue))
+    return entries
+
+
+def normalize_accept_header(acceptheader, max_length=4096, max_entries=64):
+    """
+    Normalize a HTTP Accept header into a form ``negotiator`` can parse
+    safely. Each entry is reduced to ``type/subtype`` or
+    ``type/subtype;q=<qvalue>`` by :func:`parse_accept_header`. Entries with
+    ``q=0`` (which ``negotiator`` can not handle) are removed, so use
+    :func:`parse_accept_header` to find the excluded media ranges.
+
+    :return:
+        The normalized header, or ``None`` if the header contains no valid
+        entries with a q-value above zero.
+    """
+    return _format_accept_entries(parse_accept_header(acceptheader, max_length, max_entries))
+
+
+def _format_accept_entries(entries):
+    formatted = []
+    for mediarange, qvalue in entries:
+        if qvalue is None:
+            formatted.append(mediarange)
+        elif qvalue != '0':
+            formatted.append('{0};q={1}'.format(mediarange, qvalue))
+    return ','.join(formatted) or None
 
 
 class ContentTypesRegistry(object):
     """
     Registry of :class:`ContentType` objects.
     """
+    #: Max length of the Accept headers used by :meth:`negotiate_accept_header`
+    #: (see :func:`normalize_accept_header`).
+    max_acceptheader_length = 4096
+
+    #: Max number of entries used from Accept headers by
+    #: :meth:`negotiate_accept_header` (see :func:`normalize_accept_header`).
+    max_acceptheader_entries = 64
+
+    #: Max number of Accept headers :meth:`negotiate_accept_header` caches
+    #: the result for. The cache is cleared when it is full.
+    max_cached_acceptheaders = 512
+
     def __init__(self, *content_types):
         """
         :param content_types:
             List of content types. Added to the registry using :meth:`.add`.
         """
         self._registry = {}
+        self._mimetypelist = ()
+        self._profiles = {}
+        self._negotiator = None
+        self._negotiation_cache = {}
+
+        #: Incremented each time a content type is added. Include it in the
+        #: key when caching data derived from the registry.
+        self.version = 0
         self.addmany(*content_types)
 
     def add(self, content_type):
@@ -138,6 +811,11 @@ class ContentTypesRegistry(object):
         mimetype will only add the last one.
         """
         self._registry[content_type.mimetype] = content_type
+        self._mimetypelist = tuple(self._registry.keys())
+        self._profiles[content_type.mimetype] = ResponseProfile.from_content_type(content_type)
+        self._negotiator = None
+        self._negotiation_cache = {}
+        self.version += 1
 
     def addmany(self, *content_types):
         """
@@ -152,6 +830,24 @@ class ContentTypesRegistry(object):
         """
         return self._registry[mimetype]
 
+    def get_profile(self, mimetype):
+        """
+        Get the :class:`ResponseProfile` for a :class:`ContentType` by its mimetype.
+        """
+        return self._profiles[mimetype]
+
+    def negotiate_profile(self, acceptheader):
+        """
+        Like :meth:`negotiate_accept_header`, but returns the
+        :class:`ResponseProfile` of the negotiated content type.
+
+        :return: The profile, or ``None`` if no content type is acceptable.
+        """
+        mimetype = self.negotiate_accept_header(acceptheader)
+        if mimetype is None:
+            return None
+        return self._profiles[mimetype]
+
     def __contains__(self, mimetype):
         """
         Return ``True`` if a :class:`ContentType` with the given ``mimetype``
@@ -182,22 +878,95 @@ class ContentTypesRegistry(object):
         return self._registry.itervalues()
 
     def get_mimetypelist(self):
-        return self._registry.keys()
+        """
+        Get the mimetypes in the registry. The tuple is created when content
+        types are added, not for each call.
+
+        :rtype: tuple
+        """
+        return self._mimetypelist
 
     def negotiate_accept_header(self, acceptheader):
         """
         Parse the HTTP accept header and find any acceptable mimetypes from the
-        registry.
+        registry. The header is parsed with :func:`parse_accept_header` and
+        normalized like :func:`normalize_accept_header` before it is
+        negotiated, so malformed and very large headers are handled,
+        and the result is cached for the last :obj:`max_cached_acceptheaders`
+        headers. Mimetypes where the most specific matching media range has
+        ``q=0`` are not acceptable (see :meth:`get_excluded_mimetypes`).
 
         :return: An acceptable mimetype, or ``None`` if no acceptable mimetype is found.
         :rtype: str
         """
-        acceptable = []
-        for content_type in self._registry.itervalues():
-            acceptable.append(negotiator.AcceptParameters(negotiator.ContentType(content_type.mimetype)))
-        cn = negotiator.ContentNegotiator(acceptable=acceptable)
-        result = cn.negotiate(acceptheader)
-        if result:
-            return result.content_type.mimetype()
-        else:
+        try:
+            return self._negotiation_cache[acceptheader]
+        except KeyError:
+            pass
+        mimetype = None
+        entries = parse_accept_header(acceptheader,
+                                      self.max_acceptheader_length,
+                                      self.max_acceptheader_entries)
+        normalized = _format_accept_entries(entries)
+        if normalized:
+            excluded = None
+            if any(qvalue == '0' for mediarange, qvalue in entries):
+                excluded = self.get_excluded_mimetypes(entries)
+            negotiator = self._get_negotiator(excluded)
+            if negotiator is not None:
+                result = negotiator.negotiate(normalized)
+                if result:
+                    mimetype = result.content_type.mimetype()
+        if len(self._negotiation_cache) >= self.max_cached_acceptheaders:
+            self._negotiation_cache.clear()
+        self._negotiation_cache[acceptheader] = mimetype
+        return mimetype
+
+    def get_excluded_mimetypes(self, entries):
+        """
+        Get the mimetypes in the registry excluded by an Accept header, that
+        is, the mimetypes where the most specific matching media range
+        (``type/subtype``, then ``type/*``, then ``*/*``) has ``q=0``.
+
+        :param entries: The Accept header parsed by :func:`parse_accept_header`.
+        :rtype: set
+        """
+        excluded = set()
+        for mimetype in self._registry:
+            wildcard = mimetype.lower().split('/')[0] + '/*'
+            best = None
+            for mediarange, qvalue in entries:
+                if mediarange == mimetype.lower():
+                    specificity = 2
+                elif mediarange == wildcard:
+                    specificity = 1
+                elif mediarange == '*/*':
+                    specificity = 0
+                else:
+                    continue
+                if best is None or specificity > best[0]:
+                    best = (specificity, qvalue)
+            if best is not None and best[1] == '0':
+                excluded.add(mimetype)
+        return excluded
+
+    def _get_negotiator(self, excluded=None):
+        # The negotiator is stateless, so we create it once and reuse it for
+        # all requests (until the registry is changed). Headers excluding
+        # mimetypes are rare (and their results are cached), so they get a
+        # negotiator without the excluded mimetypes, or None if all of them
+        # are excluded.
+        if excluded:
+            return self._create_negotiator([mimetype for mimetype in self._registry
+                                            if mimetype not in excluded])
+        if self._negotiator is None:
+            self._negotiator = self._create_negotiator(self._registry.keys())
+        return self._negotiator
+
+    def _create_negotiator(self, mimetypes):
+        if not mimetypes:
             return None
+        import negotiator
+        acceptable = [negotiator.AcceptParameters(negotiator.ContentType(mimetype))
+                      for mimetype in mimetypes]
+        return negotiator.ContentNegotiator(acceptable=acceptable)
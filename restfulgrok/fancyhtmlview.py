@@ -1,7 +1,7 @@
 import json
-from jinja2 import Environment, PrefixLoader, PackageLoader
 
 from view import GrokRestViewMixin
+from view import LRUCache
 from contenttype import ContentType, ContentTypesRegistry
 from contenttype import JsonContentType
 
@@ -16,6 +16,13 @@ class HtmlContentType(ContentType):
     mimetype = 'text/html'
     extension = 'html'
     description = 'Formatted HTML view with help for the REST API.'
+    streamable = True
+
+    #: The default :meth:`errorview` only uses the error data, status and
+    #: status message, so error pages are cached for each view class and
+    #: status. Set this to ``False`` in subclasses where :meth:`errorview`
+    #: uses the view.
+    error_cacheable = True
 
     #: Variable forwarded to the template as ``title``.
     html_title = 'REST API'
@@ -32,11 +39,40 @@ class HtmlContentType(ContentType):
     #: jinja2 template name for the normal html view (not for errors)
     template_name = 'restfulgrok/fancyhtmlview.jinja.html'
 
-    #: The ``jinja2.Environment``
-    template_environment = Environment(loader = PrefixLoader({
-        'restfulgrok': PackageLoader('restfulgrok')
-    }))
+    #: The ``jinja2.Environment``. Defaults to ``None``, which means that
+    #: :meth:`get_template_environment` creates an environment that loads
+    #: templates from ``restfulgrok``.
+    template_environment = None
+
+    _default_template_environment = None
+
+    #: Cache the parts of the rendered template before and after the
+    #: ``previewdata`` block (see :meth:`get_static_html`)?
+    cache_static_html = True
 
+    #: LRU cache used by :meth:`get_static_html`, with an entry for each
+    #: view class and content types registry.
+    _static_html_cache = LRUCache(maxsize=100)
+
+    #: Rendered in place of the preview data when rendering the static parts
+    #: of the template.
+    _previewdata_placeholder = u'\x00restfulgrok-previewdata\x00'
+
+    @classmethod
+    def get_template_environment(cls):
+        """
+        Get the ``jinja2.Environment``. Jinja2 is not imported, and the
+        default environment is not created, until the first time this is
+        called.
+        """
+        if cls.template_environment is not None:
+            return cls.template_environment
+        if HtmlContentType._default_template_environment is None:
+            from jinja2 import Environment, PrefixLoader, PackageLoader
+            HtmlContentType._default_template_environment = Environment(loader = PrefixLoader({
+                'restfulgrok': PackageLoader('restfulgrok')
+            }))
+        return HtmlContentType._default_template_environment
 
     @classmethod
     def get_previewdata(cls, pydata):
@@ -48,22 +84,119 @@ class HtmlContentType(ContentType):
         return JsonContentType.dumps(pydata)
 
     @classmethod
-    def get_template_data(cls, pydata, view):
+    def get_static_template_data(cls, view):
         """
-        Get the template data.
+        Get the template data that does not depend on the response data.
 
         :return: Template data.
         :rtype: dict
         """
-        return dict(previewdata=cls.get_previewdata(pydata),
-                    content_types=view.content_types,
+        return dict(content_types=view.content_types,
                     title=cls.html_title,
                     brandingtitle=cls.html_brandingtitle,
                     heading=cls.html_heading)
 
+    @classmethod
+    def get_template_data(cls, pydata, view):
+        """
+        Get the template data.
+
+        :return: Template data.
+        :rtype: dict
+        """
+        templatedata = cls.get_static_template_data(view)
+        templatedata['previewdata'] = cls.get_previewdata(pydata)
+        return templatedata
+
+    @classmethod
+    def get_static_html_key(cls, view):
+        """
+        Get the key for the static HTML of ``view`` in the cache used by
+        :meth:`get_static_html`.
+        """
+        registry = view.content_types
+        return (cls, view.__class__, registry, registry.version,
+                cls.html_title, cls.html_brandingtitle, cls.html_heading)
+
+    @classmethod
+    def get_static_html(cls, view):
+        """
+        Get the encoded template output before and after the ``previewdata``
+        block. The result is cached for each :meth:`get_static_html_key`, so
+        the template is only rendered once for each view class.
+
+        :return:
+            A ``(prefix, suffix, blocks)`` tuple, where ``blocks`` are the
+            block render functions used by :meth:`render_previewdata`, or
+            ``None`` if the template can not be split at the preview data
+            (if :obj:`cache_static_html` is ``False``, if
+            :meth:`get_template_data` is overridden, or if the template does
+            not output the ``previewdata`` block exactly once).
+        """
+        if not cls.cache_static_html or \
+                cls.get_template_data.im_func is not HtmlContentType.get_template_data.im_func:
+            return None
+        key = cls.get_static_html_key(view)
+        static_html = cls._static_html_cache.get(key)
+        if static_html is not None:
+            return static_html or None
+        templatedata = cls.get_static_template_data(view)
+        templatedata['previewdata'] = cls._previewdata_placeholder
+        template = cls.get_template_environment().get_template(cls.template_name)
+        context = template.new_context(templatedata)
+        html = u''.join(template.root_render_func(context))
+        static_html = False # Cached as "can not be split"
+        if 'previewdata' in context.blocks:
+            block = u''.join(context.blocks['previewdata'][0](context))
+            parts = html.split(block)
+            if block and len(parts) == 2:
+                blocks = dict((name, list(functions))
+                              for name, functions in context.blocks.iteritems())
+                static_html = (parts[0].encode('utf-8'), parts[1].encode('utf-8'), blocks)
+        cls._static_html_cache.set(key, static_html)
+        return static_html or None
+
+    @classmethod
+    def render_previewdata(cls, pydata, view, blocks):
+        """
+        Render the ``previewdata`` block of the template for ``pydata``,
+        using the ``blocks`` from :meth:`get_static_html`, so overridden
+        blocks and custom filters are used just like when the whole template
+        is rendered.
+
+        :return: The encoded block output.
+        """
+        template = cls.get_template_environment().get_template(cls.template_name)
+        context = template.new_context(cls.get_template_data(pydata, view))
+        context.blocks = dict((name, list(functions))
+                              for name, functions in blocks.iteritems())
+        return u''.join(context.blocks['previewdata'][0](context)).encode('utf-8')
+
+    @classmethod
+    def generate(cls, pydata, view):
+        """
+        Generate the HTML view of ``pydata`` as encoded chunks. The cached
+        static HTML before the preview data is yielded before the preview
+        data is encoded. Falls back to streaming the template with
+        ``jinja2.Template.generate()`` if the static HTML is not cached (see
+        :meth:`get_static_html`).
+
+        Only for successful responses; use :meth:`errorview` for errors.
+        """
+        static_html = cls.get_static_html(view)
+        if static_html is None:
+            template = cls.get_template_environment().get_template(cls.template_name)
+            for chunk in template.generate(**cls.get_template_data(pydata, view)):
+                yield chunk.encode('utf-8')
+        else:
+            prefix, suffix, blocks = static_html
+            yield prefix
+            yield cls.render_previewdata(pydata, view, blocks)
+            yield suffix
+
     @classmethod
     def errorview(cls, errordata, view):
-        template = cls.template_environment.get_template(cls.error_template_name)
+        template = cls.get_template_environment().get_template(cls.error_template_name)
         try:
             errordata = json.dumps(errordata)
         except TypeError:
@@ -73,12 +206,20 @@ class HtmlContentType(ContentType):
                                statusmessage=view.response.errmsg).encode('utf-8')
 
     @classmethod
-    def dumps(cls, pydata, view):
+    def iterdumps(cls, pydata, view):
         if view.response.getStatus() < 300:
-            template = cls.template_environment.get_template(cls.template_name)
-            return template.render(**cls.get_template_data(pydata, view)).encode('utf-8')
+            return cls.generate(pydata, view)
         else:
-            return cls.errorview(pydata, view)
+            return iter([cls.errorview(pydata, view)])
+
+    @classmethod
+    def dumps(cls, pydata, view):
+        return ''.join(cls.iterdumps(pydata, view))
+
+    @classmethod
+    def dump(cls, pydata, fileobj, view):
+        for chunk in cls.iterdumps(pydata, view):
+            fileobj.write(chunk)
 
 
 
@@ -0,0 +1,313 @@
+import os
+import time
+import logging
+import threading
+from Queue import Queue, Full
+from urllib import urlencode
+
+from view import GrokRestViewMixin
+from view import EncodedResponse
+
+
+log = logging.getLogger(__name__)
+
+
+class Job(object):
+    """
+    A background job in a :class:`JobResultStore`.
+    """
+    #: The error message of failed jobs. The exception is only logged, so
+    #: internal details are not sent to clients.
+    failed_message = 'The background job failed.'
+
+    def __init__(self, jobid, owner=None):
+        self.jobid = jobid
+        self.owner = owner
+        self.status = 'pending'
+        self.created = time.time()
+        self.finished = None
+        self.data = None
+        self.error = None
+        self._bodies = {}
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    def run(self, func):
+        """
+        Call ``func`` without arguments, and :meth:`finish` the job with the
+        data it returns, or :meth:`fail` the job if it raises an exception.
+        """
+        try:
+            data = func()
+        except Exception:
+            log.exception('Background job %s failed.', self.jobid)
+            self.fail(self.failed_message)
+        else:
+            self.finish(data)
+
+    def finish(self, data):
+        """
+        Mark the job as done.
+
+        :param data: The response data (not encoded).
+        """
+        self.data = data
+        self.status = 'done'
+        self.finished = time.time()
+        self._done.set()
+
+    def fail(self, error):
+        """
+        Mark the job as failed with the given ``error`` message.
+        """
+        self.error = error
+        self.status = 'failed'
+        self.finished = time.time()
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the job is done or failed.
+
+        :return: ``True`` if the job finished within ``timeout`` seconds.
+        """
+        return self._done.wait(timeout)
+
+    def get_body(self, mimetype, encode):
+        """
+        Get the :obj:`data` of a done job encoded as ``mimetype``. The data is
+        encoded with ``encode(data)`` the first time, and encoded bodies that
+        are strings are stored in the job, so each mimetype is only encoded
+        once.
+        """
+        with self._lock:
+            body = self._bodies.get(mimetype)
+            if body is None:
+                body = encode(self.data)
+                if isinstance(body, basestring):
+                    self._bodies[mimetype] = body
+            return body
+
+    def asdict(self, url=None):
+        return dict(job=self.jobid,
+                    status=self.status,
+                    url=url,
+                    error=self.error)
+
+
+class JobResultStore(object):
+    """
+    Thread-safe in-memory store of :class:`Job` objects. Finished jobs are
+    removed ``ttl`` seconds after they finish, and jobs that are still
+    pending are removed ``pending_ttl`` seconds after they were created.
+    """
+    def __init__(self, ttl=3600, pending_ttl=3600):
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, owner=None):
+        """
+        Create and store a new :class:`Job`.
+
+        :param owner: Identifies the resource and user the job belongs to.
+            :meth:`get` only finds the job for the same ``owner``.
+        """
+        job = Job(os.urandom(16).encode('hex'), owner)
+        with self._lock:
+            self._expire()
+            self._jobs[job.jobid] = job
+        return job
+
+    def get(self, jobid, owner=None):
+        """
+        Get a job by its id, or ``None`` if no such job exists, or if it was
+        created with another ``owner``.
+        """
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(jobid)
+        if job is None or job.owner != owner:
+            return None
+        return job
+
+    def remove(self, jobid):
+        with self._lock:
+            self._jobs.pop(jobid, None)
+
+    def _expire(self):
+        now = time.time()
+        for jobid, job in self._jobs.items():
+            if job.finished is None:
+                if job.created < now - self.pending_ttl:
+                    del self._jobs[jobid]
+            elif job.finished < now - self.ttl:
+                del self._jobs[jobid]
+
+
+class JobPool(object):
+    """
+    Bounded pool of daemon worker threads. The threads are started on the
+    first :meth:`submit`.
+    """
+    def __init__(self, workers=4, queue_size=100):
+        """
+        :param workers: Number of worker threads.
+        :param queue_size: Max number of jobs waiting for a worker.
+        """
+        self.workers = workers
+        self._queue = Queue(queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            func = self._queue.get()
+            try:
+                func()
+            except Exception:
+                log.exception('Background job failed.')
+            finally:
+                self._queue.task_done()
+
+    def submit(self, func):
+        """
+        Queue ``func`` for execution in a worker thread.
+
+        :return: ``False`` if the queue is full, ``True`` otherwise.
+        """
+        if len(self._threads) < self.workers:
+            self._start()
+        try:
+            self._queue.put_nowait(func)
+        except Full:
+            return False
+        return True
+
+
+class BackgroundJobViewMixin(GrokRestViewMixin):
+    """
+    Mix-in that runs expensive requests as background jobs. Example::
+
+        class ReportView(BackgroundJobViewMixin, grok.View):
+            def get_background_job(self):
+                # Copy what the job needs while the request is running
+                rows = [row.asdict() for row in self.context.rows()]
+                return lambda: build_report(rows)
+
+    A request for one of the :obj:`background_methods` with
+    ``background=true`` in the querystring, or ``respond-async`` in the
+    ``Prefer`` header, is responded to with *202 Accepted* and a job URL in
+    the Location header if :meth:`get_background_job` returns a callable.
+    The callable runs in :obj:`job_pool` after the request has ended, and
+    the data it returns is stored in :obj:`job_store`. Requesting the job URL
+    responds with *202 Accepted* until the job is done, and with the data,
+    encoded using the negotiated content type, after that.
+    """
+    #: Request methods that can run as background jobs.
+    background_methods = ['get']
+
+    #: The :class:`JobPool` running the jobs.
+    job_pool = JobPool()
+
+    #: The :class:`JobResultStore` storing the jobs. The store may be shared
+    #: by many views, so jobs are stored with :meth:`get_job_owner` as owner,
+    #: and can only be polled by the user that started them, through the
+    #: view class and context that started them.
+    job_store = JobResultStore()
+
+    def is_background_request(self):
+        """
+        Return ``True`` if the request should run as a background job.
+        """
+        if self.get_requestmethod() not in self.background_methods:
+            return False
+        prefer = self.request.getHeader('Prefer') or ''
+        return self.request.get('background') == 'true' or 'respond-async' in prefer
+
+    def get_background_job(self):
+        """
+        Get the work of a background request as a callable taking no
+        arguments, and returning the response data. Called while the request
+        is running, but the callable is called in another thread after the
+        request has ended, when the context, the request and (under Zope) the
+        database connection of the view are closed. So it must not use the
+        view or any persistent objects; copy the data it needs here instead.
+
+        Defaults to ``None``, which handles background requests like other
+        requests.
+        """
+        return None
+
+    def get_job_owner(self):
+        """
+        Get the key identifying the resource and the user jobs started by
+        this view belong to. Defaults to the view class, :meth:`get_context_key`
+        and the user id from :obj:`authorization_backend`.
+        """
+        cls = self.__class__
+        return (cls.__module__, cls.__name__, self.get_context_key(),
+                self.authorization_backend.get_userid(self))
+
+    def get_job_url(self, jobid):
+        """
+        Get the URL for polling the job with the given ``jobid``.
+        """
+        querystring = urlencode([('mimetype', self.get_content_type().mimetype),
+                                 ('job', jobid)])
+        return '{0}?{1}'.format(self.request.getURL(), querystring)
+
+    def handle(self):
+        jobid = self.request.get('job')
+        if jobid and self.get_requestmethod() == 'get':
+            return self.handle_job(jobid)
+        if self.is_background_request():
+            work = self.get_background_job()
+            if work is not None:
+                return self.start_background_job(work)
+        return super(BackgroundJobViewMixin, self).handle()
+
+    def start_background_job(self, work):
+        """
+        Start a background job running ``work`` (see
+        :meth:`get_background_job`), and respond with *202 Accepted*, or with
+        *503 Service Unavailable* if the :obj:`job_pool` queue is full.
+        """
+        self.set_contenttype_header()
+        job = self.job_store.create(self.get_job_owner())
+        url = self.get_job_url(job.jobid)
+        responsedata = job.asdict(url)
+        if not self.job_pool.submit(lambda: job.run(work)):
+            self.job_store.remove(job.jobid)
+            return self.create_response(503, 'Service Unavailable',
+                                        {'error': 'Too many background jobs. Try again later.'})
+        self.response.setHeader('Location', url)
+        return self.create_response(202, 'Accepted', responsedata)
+
+    def handle_job(self, jobid):
+        """
+        Respond with the status of the job with the given ``jobid``, or with
+        its data if it is done.
+        """
+        job = self.job_store.get(jobid, self.get_job_owner())
+        self.set_contenttype_header()
+        if job is None:
+            return self.create_response(404, 'Not Found',
+                                        {'error': 'No such job: {0}'.format(jobid)})
+        elif job.status == 'done':
+            self.response.setStatus(200, 'OK')
+            return EncodedResponse(job.get_body(self.get_content_type().mimetype,
+                                                self.encode_output_data))
+        elif job.status == 'failed':
+            return self.create_response(500, 'Internal Server Error', job.asdict())
+        else:
+            return self.create_response(202, 'Accepted', job.asdict(self.get_job_url(jobid)))
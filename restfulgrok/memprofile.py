@@ -0,0 +1,302 @@
+"""
+Opt-in per-request memory accounting, for finding the handlers and
+encoders that make workers grow. Example::
+
+    from restfulgrok.memprofile import MemoryProfilingViewMixin
+
+    class ReportView(MemoryProfilingViewMixin, grok.View):
+        memory_profile_rate = 0.01 # Profile 1% of the requests
+        memory_profile_threshold = 50 * 1024 * 1024
+
+Allocations are traced with :mod:`tracemalloc` when it is available (Python
+3.4+, or Python 2.7 with the ``pytracemalloc`` backport). Otherwise, the
+resident set size of the process is used where ``/proc`` is available,
+which only gives a rough estimate of the net memory use, and no peaks or
+allocation sites. Peaks also require Python 3.9+, where :mod:`tracemalloc`
+can reset the peak.
+"""
+import os
+import mmap
+import random
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from view import GrokRestViewMixin
+
+
+log = logging.getLogger(__name__)
+
+
+class TracemallocTracer(object):
+    """
+    Memory tracer using :mod:`tracemalloc`. Tracing is started when the
+    first request using the tracer starts, and stopped when the last one
+    ends, unless it was already started by someone else.
+    """
+    _lock = threading.Lock()
+    _users = 0
+    _started = False
+
+    def __init__(self, frames=1):
+        """
+        :param frames: Number of frames stored for each allocation.
+        """
+        import tracemalloc
+        self.tracemalloc = tracemalloc
+        self.frames = frames
+
+        #: ``True`` if :mod:`tracemalloc` can reset the peak (Python 3.9+).
+        self.can_reset_peak = hasattr(tracemalloc, 'reset_peak')
+
+    def start(self):
+        cls = TracemallocTracer
+        with cls._lock:
+            if cls._users == 0 and not self.tracemalloc.is_tracing():
+                self.tracemalloc.start(self.frames)
+                cls._started = True
+            cls._users += 1
+
+    def stop(self):
+        cls = TracemallocTracer
+        with cls._lock:
+            cls._users -= 1
+            if cls._users == 0 and cls._started:
+                self.tracemalloc.stop()
+                cls._started = False
+
+    def get_memory(self):
+        """
+        Get ``(current, peak)`` memory use in bytes. The peak is ``None``
+        unless :obj:`can_reset_peak` is ``True``, since the peak would be the
+        peak since tracing started, which may be long before the request
+        (tracing may have been started by someone else).
+        """
+        current, peak = self.tracemalloc.get_traced_memory()
+        if not self.can_reset_peak:
+            return current, None
+        return current, peak
+
+    def reset_peak(self):
+        """
+        Reset the peak to the current memory use, if :obj:`can_reset_peak`.
+        """
+        if self.can_reset_peak:
+            self.tracemalloc.reset_peak()
+
+    def get_top_sites(self, limit):
+        """
+        Get the ``limit`` source lines with the most memory allocated as
+        list of ``(site, size, count)`` tuples.
+        """
+        tracemalloc = self.tracemalloc
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<unknown>')])
+        return [(str(statistic.traceback), statistic.size, statistic.count)
+                for statistic in snapshot.statistics('lineno')[:limit]]
+
+
+class RssTracer(object):
+    """
+    Fallback memory tracer using the current resident set size of the
+    process (``/proc/self/statm``). Includes memory that is not allocated by
+    Python, and memory that is freed is often not returned to the operating
+    system. The peak is not available (the only peak the operating system
+    reports is the high-water mark for the lifetime of the process), so
+    :meth:`get_memory` returns ``None`` as the peak.
+    """
+    statm_path = '/proc/self/statm'
+
+    @classmethod
+    def is_available(cls):
+        """
+        Return ``True`` if the resident set size can be read.
+        """
+        return os.path.exists(cls.statm_path)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def get_memory(self):
+        with open(self.statm_path) as statm:
+            current = int(statm.read().split()[1]) * mmap.PAGESIZE
+        return current, None
+
+    def reset_peak(self):
+        pass
+
+    def get_top_sites(self, limit):
+        return []
+
+
+_tracemalloc_available = None
+
+def get_memory_tracer(frames=1):
+    """
+    Get a :class:`TracemallocTracer` if :mod:`tracemalloc` can be imported,
+    a :class:`RssTracer` if it is available, and ``None`` otherwise.
+    """
+    global _tracemalloc_available
+    if _tracemalloc_available is not False:
+        try:
+            tracer = TracemallocTracer(frames)
+        except ImportError:
+            _tracemalloc_available = False
+        else:
+            _tracemalloc_available = True
+            return tracer
+    if RssTracer.is_available():
+        return RssTracer()
+    return None
+
+
+class MemoryProfilingViewMixin(GrokRestViewMixin):
+    """
+    Mix-in that records the memory allocated while rendering a sample of
+    the requests. For each sampled request, :obj:`memory_profile` maps each
+    phase to a dict with the ``net`` bytes allocated (still allocated when
+    the phase ended) and the ``peak`` bytes allocated during the phase. The
+    phases are:
+
+    - ``decode``: :meth:`get_requestdata`.
+    - ``handler``: The handler, including ``decode`` if the handler decodes
+      the request.
+    - ``encode``: :meth:`encode_output_data`.
+    - ``total``: The entire :meth:`render`.
+
+    The memory is traced for the entire process, so allocations made by
+    concurrent requests in other threads are included. The ``peak`` is only
+    measured by tracers that can reset the peak (``tracemalloc`` on Python
+    3.9+). Otherwise, the ``peak`` is ``None``.
+
+    The profile is passed to :meth:`report_memory_profile`, which logs the
+    top allocation sites when the ``total`` peak reaches
+    :obj:`memory_profile_threshold`.
+    """
+    #: Fraction of the requests that are profiled. ``0`` disables profiling.
+    memory_profile_rate = 0
+
+    #: Log the top allocation sites of requests with a total peak (or net
+    #: memory use, if the peak is not available) of at least this many
+    #: bytes.
+    memory_profile_threshold = 10 * 1024 * 1024
+
+    #: Number of allocation sites logged.
+    memory_profile_top_sites = 10
+
+    #: Number of frames stored for each allocation by ``tracemalloc``.
+    memory_profile_frames = 1
+
+    #: The profile of the request, or ``None`` if the request was not sampled.
+    memory_profile = None
+
+    _memory_tracer = None
+
+    def should_profile_memory(self):
+        """
+        Return ``True`` if the memory of this request should be profiled.
+        Samples :obj:`memory_profile_rate` of the requests.
+        """
+        return bool(self.memory_profile_rate) and random.random() < self.memory_profile_rate
+
+    @contextmanager
+    def memory_phase(self, phase):
+        """
+        Context manager recording the memory allocated in ``phase`` in
+        :obj:`memory_profile`. Does nothing if the request is not profiled.
+        """
+        tracer = self._memory_tracer
+        if tracer is None:
+            yield
+            return
+        current, peak = tracer.get_memory()
+        if peak is not None:
+            for frame in self._memory_frames:
+                frame[1] = max(frame[1], peak)
+        tracer.reset_peak()
+        frame = [current, current]
+        self._memory_frames.append(frame)
+        try:
+            yield
+        finally:
+            self._memory_frames.pop()
+            current, peak = tracer.get_memory()
+            stats = self.memory_profile.setdefault(phase, {'net': 0, 'peak': 0})
+            stats['net'] += current - frame[0]
+            if peak is None:
+                stats['peak'] = None
+            else:
+                peak = max(frame[1], peak)
+                for outer in self._memory_frames:
+                    outer[1] = max(outer[1], peak)
+                stats['peak'] = max(stats['peak'], peak - frame[0])
+
+    def render(self):
+        if not self.should_profile_memory():
+            return super(MemoryProfilingViewMixin, self).render()
+        tracer = get_memory_tracer(self.memory_profile_frames)
+        if tracer is None:
+            return super(MemoryProfilingViewMixin, self).render()
+        tracer.start()
+        self._memory_tracer = tracer
+        self._memory_frames = []
+        self.memory_profile = OrderedDict()
+        try:
+            with self.memory_phase('total'):
+                body = super(MemoryProfilingViewMixin, self).render()
+            top_sites = []
+            total = self.memory_profile['total']
+            if total['peak'] is None:
+                size = total['net']
+            else:
+                size = total['peak']
+            if size >= self.memory_profile_threshold:
+                top_sites = tracer.get_top_sites(self.memory_profile_top_sites)
+        finally:
+            self._memory_tracer = None
+            tracer.stop()
+        self.report_memory_profile(self.memory_profile, top_sites)
+        return body
+
+    def report_memory_profile(self, profile, top_sites):
+        """
+        Called with the :obj:`memory_profile` of profiled requests, and the
+        top allocation sites as list of ``(site, size, count)`` tuples (empty
+        if the total peak is below :obj:`memory_profile_threshold`). Logs the
+        profile at debug level, or at warning level with the sites if there
+        are any. Override this to send the profile somewhere else.
+        """
+        summary = ', '.join('{0}: net={1[net]} peak={1[peak]}'.format(phase, stats)
+                            for phase, stats in profile.iteritems())
+        cls = self.__class__
+        viewname = '{0}.{1}'.format(cls.__module__, cls.__name__)
+        if top_sites:
+            sites = ''.join('\n    {0}: {1} bytes in {2} blocks'.format(*site)
+                            for site in top_sites)
+            log.warning('Memory profile of %s %s: %s. Top allocation sites:%s',
+                        self.get_requestmethod().upper(), viewname, summary, sites)
+        else:
+            log.debug('Memory profile of %s %s: %s',
+                      self.get_requestmethod().upper(), viewname, summary)
+
+    def get_requestdata(self):
+        with self.memory_phase('decode'):
+            return super(MemoryProfilingViewMixin, self).get_requestdata()
+
+    def get_handler(self, method):
+        handler = super(MemoryProfilingViewMixin, self).get_handler(method)
+        if handler is None or self._memory_tracer is None:
+            return handler
+        def profiled_handler():
+            with self.memory_phase('handler'):
+                return handler()
+        return profiled_handler
+
+    def encode_output_data(self, pydata):
+        with self.memory_phase('encode'):
+            return super(MemoryProfilingViewMixin, self).encode_output_data(pydata)
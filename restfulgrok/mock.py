@@ -6,7 +6,8 @@ from StringIO import StringIO
 class MockResponse(object):
     def __init__(self):
         self.headers = []
-        self.status = None
+        self.status = (200, 'OK')
+        self.errmsg = 'OK'
 
     def setHeader(self, header, value):
         self.headers.append((header, value))
@@ -21,8 +22,11 @@ class MockResponse(object):
 
 class MockRequest(object):
     def __init__(self, method='GET', body='', getdata={},
-                 headers={'Accept': 'application/json'}):
+                 headers={'Accept': 'application/json'},
+                 url='http://localhost/', client_addr='127.0.0.1'):
         self.method = method
+        self.url = url
+        self.client_addr = client_addr
         self.body = body
         self.getdata = {} #'BODY': self.body}
         self.getdata.update(getdata)
@@ -34,8 +38,14 @@ class MockRequest(object):
     def get(self, key, default=None):
         return self.getdata.get(key, default)
 
-    def getHeader(self, header):
-        return self.headers[header.lower()]
+    def getHeader(self, header, default=None):
+        return self.headers.get(header.lower(), default)
+
+    def getURL(self):
+        return self.url
+
+    def getClientAddr(self):
+        return self.client_addr
 
 
 class MockContext(object):
@@ -48,13 +58,17 @@ class MockContext(object):
 
 
 class MockRestView(GrokRestViewMixin):
-    def __init__(self, request=None, response=MockResponse(), context=None):
+    def __init__(self, request=None, response=None, context=None):
         self.request = request
+        if response is None:
+            response = MockResponse()
         self.response = response
         self.context = context
 
 class MockRestViewWithFancyHtml(GrokRestViewWithFancyHtmlMixin):
-    def __init__(self, request=None, response=MockResponse(), context=None):
+    def __init__(self, request=None, response=None, context=None):
         self.request = request
+        if response is None:
+            response = MockResponse()
         self.response = response
         self.context = context
@@ -0,0 +1,112 @@
+import os
+import cPickle as pickle
+import threading
+import multiprocessing
+
+from contenttype import RawFragment
+
+
+def _encode_pickled(content_type, pickled):
+    return content_type.dumps(pickle.loads(pickled), None)
+
+
+class EncodingPool(object):
+    """
+    Encodes large responses in a pool of worker processes, so encoding does
+    not hold the GIL of the process serving requests. Set it as
+    ``encoding_pool`` on a :class:`restfulgrok.view.GrokRestViewMixin`::
+
+        class MyView(GrokRestViewMixin, grok.View):
+            encoding_pool = EncodingPool(processes=2)
+
+    Only content types with ``offloadable = True`` are encoded in the pool.
+    Data is only sent to the pool when :meth:`estimate_size` finds at least
+    ``min_size`` bytes in at least ``min_items`` items. Data consisting of
+    a few large strings is encoded inline, since pickling it for the pool
+    would cost about as much as encoding it. Data that can not be pickled is
+    also encoded inline.
+    """
+    def __init__(self, processes=2, min_size=1024*1024, min_items=10000):
+        """
+        :param processes: Number of worker processes.
+        :param min_size: See the class docs.
+        :param min_items: See the class docs.
+        """
+        self.processes = processes
+        self.min_size = min_size
+        self.min_items = min_items
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            # Create the pool lazily, and again after a fork, since a pool can
+            # not be shared between processes.
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = multiprocessing.Pool(self.processes)
+                self._pid = os.getpid()
+            return self._pool
+
+    def estimate_size(self, pydata):
+        """
+        Estimate the encoded size of ``pydata``. The estimate stops as soon as
+        both ``min_size`` and ``min_items`` are reached, so the cost of
+        estimating is bounded.
+
+        :return: ``(size, items)`` tuple.
+        """
+        size = 0
+        items = 0
+        stack = [pydata]
+        while stack:
+            if size >= self.min_size and items >= self.min_items:
+                break
+            obj = stack.pop()
+            items += 1
+            if isinstance(obj, basestring):
+                size += len(obj) + 2
+            elif isinstance(obj, dict):
+                stack.extend(obj.iterkeys())
+                stack.extend(obj.itervalues())
+                size += 2
+            elif isinstance(obj, (list, tuple)):
+                stack.extend(obj)
+                size += 2
+            elif isinstance(obj, RawFragment):
+                size += len(obj.json)
+            else:
+                size += 8
+        return size, items
+
+    def should_offload(self, content_type, pydata):
+        """
+        Return ``True`` if ``pydata`` should be encoded in the pool.
+        """
+        if not content_type.offloadable:
+            return False
+        size, items = self.estimate_size(pydata)
+        return size >= self.min_size and items >= self.min_items
+
+    def encode(self, content_type, pydata):
+        """
+        Encode ``pydata`` as ``content_type`` in a worker process, or inline
+        if ``pydata`` can not be pickled.
+
+        :return: The encoded data as a bytestring.
+        :raise restfulgrok.contenttype.ContentTypeDumpError: If ``pydata`` can not be encoded.
+        """
+        try:
+            pickled = pickle.dumps(pydata, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            return content_type.dumps(pydata, None)
+        return self._get_pool().apply(_encode_pickled, (content_type, pickled))
+
+    def close(self):
+        """
+        Terminate the worker processes.
+        """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
@@ -0,0 +1,315 @@
+"""
+PATCH support: `JSON Merge Patch <http://tools.ietf.org/html/rfc7386>`_ and
+`JSON Patch <http://tools.ietf.org/html/rfc6902>`_. Example::
+
+    class ItemView(GrokRestViewMixin, grok.View):
+        def handle_patch(self):
+            item = self.apply_patch(self.context.asdict())
+            self.context.update(item)
+            return item
+
+The patches are applied copy-on-write: the target is never modified, and
+only the dicts and lists on the patched paths are copied, so the cost of
+applying a patch depends on the size of the patch, not the size of the
+document.
+"""
+import copy
+
+from contenttype import JsonContentType
+from contenttype import ContentTypeLoadError
+from contenttype import ContentTypesRegistry
+
+
+class PatchError(ValueError):
+    """
+    Raised when a valid patch can not be applied to the target, for example
+    if a path does not exist, or a ``test`` operation fails.
+    :meth:`restfulgrok.view.GrokRestViewMixin.render` responds to it with
+    *409 Conflict*. Invalid patches raise
+    :exc:`restfulgrok.contenttype.ContentTypeLoadError` (*400 Bad Request*).
+    """
+
+
+def apply_merge_patch(target, patch):
+    """
+    Apply a JSON Merge Patch (RFC 7386) to ``target``.
+
+    :return: The patched document. ``target`` is not modified.
+    """
+    if not isinstance(patch, dict):
+        return patch
+    if isinstance(target, dict):
+        result = dict(target)
+    else:
+        result = {}
+    for key, value in patch.iteritems():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = apply_merge_patch(result.get(key), value)
+    return result
+
+
+def _normalize_string(value):
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+    return value
+
+
+def json_equal(a, b):
+    """
+    Compare ``a`` and ``b`` like the ``test`` operation of JSON Patch
+    (RFC 6902): the values must have the same JSON type, so ``True`` is not
+    equal to ``1``. Numbers are compared by value, ``str`` and ``unicode``
+    strings are compared as unicode, and objects and arrays are compared
+    recursively.
+    """
+    if isinstance(a, bool) or isinstance(b, bool):
+        return isinstance(a, bool) and isinstance(b, bool) and a == b
+    if isinstance(a, (int, long, float)) or isinstance(b, (int, long, float)):
+        return (isinstance(a, (int, long, float)) and isinstance(b, (int, long, float))
+                and a == b)
+    if isinstance(a, basestring) or isinstance(b, basestring):
+        return (isinstance(a, basestring) and isinstance(b, basestring)
+                and _normalize_string(a) == _normalize_string(b))
+    if isinstance(a, dict) or isinstance(b, dict):
+        if not (isinstance(a, dict) and isinstance(b, dict)) or len(a) != len(b):
+            return False
+        b = dict((_normalize_string(key), value) for key, value in b.iteritems())
+        for key, value in a.iteritems():
+            key = _normalize_string(key)
+            if key not in b or not json_equal(value, b[key]):
+                return False
+        return True
+    if isinstance(a, (list, tuple)) or isinstance(b, (list, tuple)):
+        if not (isinstance(a, (list, tuple)) and isinstance(b, (list, tuple))) \
+                or len(a) != len(b):
+            return False
+        for itema, itemb in zip(a, b):
+            if not json_equal(itema, itemb):
+                return False
+        return True
+    return a == b
+
+
+def parse_pointer(pointer):
+    """
+    Parse a JSON Pointer (RFC 6901) into a list of reference tokens.
+
+    :raise restfulgrok.contenttype.ContentTypeLoadError:
+        If ``pointer`` is not a valid JSON Pointer.
+    """
+    if pointer == '':
+        return []
+    if not isinstance(pointer, basestring) or not pointer.startswith('/'):
+        raise ContentTypeLoadError('Invalid JSON pointer: {0!r}'.format(pointer))
+    return [token.replace('~1', '/').replace('~0', '~')
+            for token in pointer[1:].split('/')]
+
+
+class _CopyOnWriteDocument(object):
+    """
+    A document that JSON Patch operations are applied to. Containers are
+    copied the first time they are modified, and each container is only
+    copied once.
+    """
+    def __init__(self, document):
+        self.document = document
+        # Maps id() to the containers we have copied. Keeps references to
+        # the copies, so their ids are not reused.
+        self._copies = {}
+
+    def _writable(self, container):
+        if id(container) in self._copies:
+            return container
+        if isinstance(container, dict):
+            container = dict(container)
+        else:
+            container = list(container)
+        self._copies[id(container)] = container
+        return container
+
+    def _get_index(self, container, token, path, allow_end=False):
+        if isinstance(container, dict):
+            return token
+        elif isinstance(container, list):
+            if allow_end and token == '-':
+                return len(container)
+            if not token.isdigit() or (token.startswith('0') and token != '0'):
+                raise ContentTypeLoadError('Invalid array index in {0}: {1!r}'.format(path, token))
+            index = int(token)
+            if index > len(container) or (index == len(container) and not allow_end):
+                raise PatchError('Array index out of range in {0}: {1}'.format(path, index))
+            return index
+        raise PatchError('Not a container in {0}'.format(path))
+
+    def get(self, tokens, path):
+        value = self.document
+        for token in tokens:
+            index = self._get_index(value, token, path)
+            try:
+                value = value[index]
+            except KeyError:
+                raise PatchError('No such path: {0}'.format(path))
+        return value
+
+    def _get_writable_parent(self, tokens, path):
+        if not isinstance(self.document, (dict, list)):
+            raise PatchError('Not a container in {0}'.format(path))
+        self.document = parent = self._writable(self.document)
+        for token in tokens[:-1]:
+            index = self._get_index(parent, token, path)
+            try:
+                child = parent[index]
+            except KeyError:
+                raise PatchError('No such path: {0}'.format(path))
+            if not isinstance(child, (dict, list)):
+                raise PatchError('Not a container in {0}'.format(path))
+            parent[index] = child = self._writable(child)
+            parent = child
+        return parent
+
+    def add(self, tokens, path, value):
+        if not tokens:
+            self.document = value
+            return
+        parent = self._get_writable_parent(tokens, path)
+        index = self._get_index(parent, tokens[-1], path, allow_end=True)
+        if isinstance(parent, list):
+            parent.insert(index, value)
+        else:
+            parent[index] = value
+
+    def remove(self, tokens, path):
+        parent = self._get_writable_parent(tokens, path)
+        index = self._get_index(parent, tokens[-1], path)
+        try:
+            return parent.pop(index)
+        except KeyError:
+            raise PatchError('No such path: {0}'.format(path))
+
+    def replace(self, tokens, path, value):
+        if not tokens:
+            self.document = value
+            return
+        parent = self._get_writable_parent(tokens, path)
+        index = self._get_index(parent, tokens[-1], path)
+        if isinstance(parent, dict) and index not in parent:
+            raise PatchError('No such path: {0}'.format(path))
+        parent[index] = value
+
+
+def validate_json_patch(patch):
+    """
+    Check that ``patch`` is a valid JSON Patch (RFC 6902), without applying
+    it: a list of operation objects with a known ``op``, valid ``path`` and
+    ``from`` pointers, and the ``value`` required by the operation.
+
+    :raise restfulgrok.contenttype.ContentTypeLoadError: If the patch is invalid.
+    """
+    if not isinstance(patch, list):
+        raise ContentTypeLoadError('A JSON Patch must be a list of operations.')
+    for operation in patch:
+        if not isinstance(operation, dict) or 'op' not in operation or 'path' not in operation:
+            raise ContentTypeLoadError('JSON Patch operations must be objects with "op" and "path".')
+        op = operation['op']
+        if op not in ('add', 'remove', 'replace', 'move', 'copy', 'test'):
+            raise ContentTypeLoadError('Invalid JSON Patch operation: {0!r}'.format(op))
+        tokens = parse_pointer(operation['path'])
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise ContentTypeLoadError('Missing "value" in {0} operation.'.format(op))
+        if op == 'remove' and not tokens:
+            raise ContentTypeLoadError('Can not remove the root of the document.')
+        if op in ('move', 'copy'):
+            if 'from' not in operation:
+                raise ContentTypeLoadError('Missing "from" in {0} operation.'.format(op))
+            fromtokens = parse_pointer(operation['from'])
+            if op == 'move' and tokens[:len(fromtokens)] == fromtokens and tokens != fromtokens:
+                raise ContentTypeLoadError('Can not move {0} into itself.'.format(operation['from']))
+
+
+def apply_json_patch(target, patch):
+    """
+    Apply a JSON Patch (RFC 6902) to ``target``. The patch is applied
+    atomically: if any of the operations fail, nothing is changed.
+
+    :param patch: List of operation dicts.
+    :return: The patched document. ``target`` is not modified.
+    :raise restfulgrok.contenttype.ContentTypeLoadError:
+        If the patch is invalid (see :func:`validate_json_patch`), or an
+        array index in a path is not a number.
+    :raise PatchError: If an operation can not be applied to ``target``.
+    """
+    validate_json_patch(patch)
+    document = _CopyOnWriteDocument(target)
+    for operation in patch:
+        op = operation['op']
+        path = operation['path']
+        tokens = parse_pointer(path)
+        if op == 'add':
+            document.add(tokens, path, operation['value'])
+        elif op == 'remove':
+            document.remove(tokens, path)
+        elif op == 'replace':
+            document.replace(tokens, path, operation['value'])
+        elif op in ('move', 'copy'):
+            frompath = operation['from']
+            fromtokens = parse_pointer(frompath)
+            if op == 'move':
+                value = document.remove(fromtokens, frompath)
+            else:
+                # The copy must not share containers with the source, since
+                # they may be modified by later operations.
+                value = copy.deepcopy(document.get(fromtokens, frompath))
+            document.add(tokens, path, value)
+        elif op == 'test':
+            if not json_equal(document.get(tokens, path), operation['value']):
+                raise PatchError('Test failed: {0}'.format(path))
+    return document.document
+
+
+class MergePatchContentType(JsonContentType):
+    """
+    ``application/merge-patch+json`` (JSON Merge Patch) request bodies for
+    PATCH requests.
+    """
+    mimetype = 'application/merge-patch+json'
+    extension = 'json'
+    description = 'JSON Merge Patch (RFC 7386).'
+
+    @classmethod
+    def apply(cls, target, patch):
+        """
+        Apply the decoded ``patch`` to ``target`` using :func:`apply_merge_patch`.
+        """
+        return apply_merge_patch(target, patch)
+
+
+class JsonPatchContentType(JsonContentType):
+    """
+    ``application/json-patch+json`` (JSON Patch) request bodies for PATCH
+    requests.
+    """
+    mimetype = 'application/json-patch+json'
+    extension = 'json'
+    description = 'JSON Patch (RFC 6902).'
+
+    @classmethod
+    def loads(cls, rawdata, view=None):
+        patch = super(JsonPatchContentType, cls).loads(rawdata, view)
+        validate_json_patch(patch)
+        return patch
+
+    @classmethod
+    def apply(cls, target, patch):
+        """
+        Apply the decoded ``patch`` to ``target`` using :func:`apply_json_patch`.
+        """
+        return apply_json_patch(target, patch)
+
+
+#: The default :obj:`restfulgrok.view.GrokRestViewMixin.patch_content_types`.
+default_patch_content_types = ContentTypesRegistry(MergePatchContentType, JsonPatchContentType)
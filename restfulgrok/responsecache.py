@@ -0,0 +1,286 @@
+"""
+Cache of encoded responses. With :class:`SqliteResponseCache`, the cache is
+shared by all the worker processes on a host, so a response encoded by one
+worker is served from the cache by all of them. Example::
+
+    from restfulgrok.responsecache import ResponseCacheViewMixin
+    from restfulgrok.responsecache import SqliteResponseCache
+
+    class ReportView(ResponseCacheViewMixin, grok.View):
+        response_cache = SqliteResponseCache('/var/cache/myapp/responses.db')
+        response_cache_ttl = 300
+
+        def handle_get(self):
+            return self.context.build_report()
+
+Only *200 OK* responses are cached. If :meth:`get_resource_metadata` returns
+an ETag, it is part of the cache key, so responses for a changed resource
+are not served from the cache.
+"""
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from view import GrokRestViewMixin
+from view import EncodedResponse
+from view import ResponseRecorder
+
+
+class ResponseCache(object):
+    """
+    Superclass for response caches. The least recently used entries are
+    evicted when the cache has more than :obj:`max_entries` entries, or the
+    bodies use more than :obj:`max_bytes` bytes.
+
+    This class does not cache anything, so subclasses must override
+    :meth:`get`, :meth:`set` and :meth:`clear`.
+    """
+    #: Max number of cached responses.
+    max_entries = 10000
+
+    #: Max total size of the cached bodies in bytes.
+    max_bytes = 64 * 1024 * 1024
+
+    def get(self, key):
+        """
+        Get the cached response for ``key``.
+
+        :return:
+            ``(response, body)`` tuple, where ``response`` is a
+            :class:`restfulgrok.view.ResponseRecorder` with the status and
+            headers, or ``None`` if ``key`` is not cached, or has expired.
+        """
+        return None
+
+    def set(self, key, response, body, ttl):
+        """
+        Cache ``body``, and the status and headers recorded in the
+        :class:`restfulgrok.view.ResponseRecorder` ``response``, for ``ttl``
+        seconds.
+        """
+
+    def clear(self):
+        """
+        Remove all the cached responses.
+        """
+
+
+class MemoryResponseCache(ResponseCache):
+    """
+    Thread-safe :class:`ResponseCache` in memory. Only shared by the threads
+    of a single process.
+    """
+    def __init__(self, max_entries=None, max_bytes=None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, status, headers, body = entry
+            if expires <= time.time():
+                self._size -= len(body)
+                return None
+            self._entries[key] = entry
+        response = ResponseRecorder()
+        response.setStatus(*status)
+        response.headers = list(headers)
+        return response, body
+
+    def set(self, key, response, body, ttl):
+        entry = (time.time() + ttl, response.status, list(response.headers), body)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[3])
+            self._entries[key] = entry
+            self._size += len(body)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._size -= len(self._entries.popitem(last=False)[1][3])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+class SqliteResponseCache(ResponseCache):
+    """
+    :class:`ResponseCache` in a SQLite database, shared by all processes
+    using the same database file. Each thread uses its own connection (and
+    processes forked after the cache is used reconnect), and the database
+    uses write-ahead logging, so reads do not block writes.
+
+    If the database stays locked for ``timeout`` seconds, :meth:`get`
+    returns ``None``, and :meth:`set` does not cache the response, so a busy
+    cache never fails a request.
+    """
+    #: Only update the last access time of an entry on cache hits if it is
+    #: older than this many seconds, so most hits do not write to the
+    #: database.
+    touch_interval = 1
+
+    def __init__(self, path, max_entries=None, max_bytes=None, timeout=5):
+        """
+        :param path: Path to the database file. Created if it does not exist.
+        :param timeout: Seconds to wait for a locked database.
+        """
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._setup()
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _setup(self):
+        connection = self._connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('CREATE TABLE IF NOT EXISTS responsecache ('
+                               'key TEXT PRIMARY KEY, status INTEGER NOT NULL, '
+                               'statusmsg TEXT NOT NULL, headers TEXT NOT NULL, '
+                               'body BLOB NOT NULL, size INTEGER NOT NULL, '
+                               'expires REAL NOT NULL, accessed REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS responsecache_accessed '
+                               'ON responsecache (accessed)')
+
+    def get(self, key):
+        now = time.time()
+        try:
+            connection = self._connect()
+            row = connection.execute('SELECT status, statusmsg, headers, body, expires, accessed '
+                                     'FROM responsecache WHERE key = ?', (key,)).fetchone()
+            if row is None or row[4] <= now:
+                return None
+            if now - row[5] >= self.touch_interval:
+                connection.execute('UPDATE responsecache SET accessed = ? WHERE key = ?',
+                                   (now, key))
+        except sqlite3.OperationalError:
+            return None
+        status, statusmsg, headers, body = row[:4]
+        response = ResponseRecorder()
+        response.setStatus(status, statusmsg)
+        response.headers = [tuple(header) for header in json.loads(headers)]
+        if isinstance(body, buffer):
+            body = str(body)
+        return response, body
+
+    def set(self, key, response, body, ttl):
+        now = time.time()
+        status, statusmsg = response.status
+        try:
+            headers = json.dumps(response.headers)
+        except (TypeError, ValueError):
+            # Headers that can not be stored, like bytes that are not UTF-8.
+            return
+        if isinstance(body, str):
+            storedbody = buffer(body)
+        else:
+            storedbody = body
+        try:
+            connection = self._connect()
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                connection.execute('INSERT OR REPLACE INTO responsecache VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (key, status, statusmsg, headers,
+                                    storedbody, len(body), now + ttl, now))
+                connection.execute('DELETE FROM responsecache WHERE expires <= ?', (now,))
+                self._evict(connection)
+        except sqlite3.OperationalError:
+            pass
+
+    def _evict(self, connection):
+        count, size = connection.execute('SELECT COUNT(*), TOTAL(size) FROM responsecache').fetchone()
+        if count <= self.max_entries and size <= self.max_bytes:
+            return
+        evict = []
+        for key, entrysize in connection.execute('SELECT key, size FROM responsecache '
+                                                 'ORDER BY accessed'):
+            if count <= self.max_entries and size <= self.max_bytes:
+                break
+            evict.append((key,))
+            count -= 1
+            size -= entrysize
+        connection.executemany('DELETE FROM responsecache WHERE key = ?', evict)
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM responsecache')
+
+
+class ResponseCacheViewMixin(GrokRestViewMixin):
+    """
+    Mix-in that caches the status, headers and encoded body of responses to
+    the :obj:`response_cache_methods` in :obj:`response_cache`.
+
+    Requests are authorized before the cache is checked, and responses are
+    only shared between requests with the same
+    :meth:`get_response_cache_user_key`.
+    """
+    #: The :class:`ResponseCache`. Use a :class:`SqliteResponseCache` to
+    #: share the cache between processes.
+    response_cache = MemoryResponseCache()
+
+    #: Seconds responses are cached.
+    response_cache_ttl = 60
+
+    #: Request methods with cached responses.
+    response_cache_methods = ['get']
+
+    def get_response_cache_user_key(self):
+        """
+        Get a string identifying the users that can share responses.
+        Defaults to the user id. Override this to share responses between
+        users with the same permissions.
+        """
+        return str(self.authorization_backend.get_userid(self))
+
+    def get_response_cache_key(self):
+        """
+        Get the :obj:`response_cache` key for the request. A hash of the
+        :meth:`get_shared_response_key` for the user key, and the ETag from
+        :meth:`get_cached_resource_metadata`.
+        """
+        key = self.get_shared_response_key(self.get_response_cache_user_key())
+        key += (self.get_cached_resource_metadata().get('etag'),)
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    def handle(self):
+        if self.get_requestmethod() not in self.response_cache_methods:
+            return super(ResponseCacheViewMixin, self).handle()
+        key = self.get_response_cache_key()
+        cached = self.response_cache.get(key)
+        if cached is None:
+            response, body = self.record_response(
+                lambda view: super(ResponseCacheViewMixin, view).handle())
+            if response.getStatus() == 200 and isinstance(body, basestring):
+                self.response_cache.set(key, response, body, self.response_cache_ttl)
+        else:
+            response, body = cached
+        response.replay(self.response)
+        return EncodedResponse(body)
@@ -0,0 +1,307 @@
+"""
+Schemas for fixed-shape request and response data. Example::
+
+    from restfulgrok.schema import Schema, Optional, SchemaViewMixin, schema
+
+    item_schema = Schema({'id': int,
+                          'title': unicode,
+                          'tags': [unicode],
+                          'score': Optional(float)})
+
+    class ItemView(SchemaViewMixin, grok.View):
+        @schema(response=item_schema)
+        def handle_get(self):
+            return {'id': 1, 'title': u'Test', 'tags': [], 'score': None}
+
+        @schema(request=item_schema, response=item_schema)
+        def handle_put(self):
+            return self.get_requestdata_dict()
+
+A field spec is one of ``str``, ``unicode`` (both accept any string),
+``int``, ``float``, ``bool``, a list containing a single spec (a list of
+items matching that spec), a :class:`Schema`, or :class:`Optional` wrapping
+any of these.
+"""
+from json.encoder import encode_basestring_ascii
+
+from view import GrokRestViewMixin
+from contenttype import JsonContentType
+from contenttype import ResponseProfile
+from contenttype import ContentTypeLoadError
+from contenttype import ContentTypeDumpError
+
+
+class SchemaError(ContentTypeLoadError):
+    """
+    Raised when decoded request data does not match a :class:`Schema`.
+    Since this is a :exc:`restfulgrok.contenttype.ContentTypeLoadError`,
+    :meth:`restfulgrok.view.GrokRestViewMixin.render` responds to it with
+    *400 Bad Request*.
+    """
+
+
+class Optional(object):
+    """
+    Marks a field spec as optional. Optional fields may be missing or
+    ``None``.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+
+
+def _float_repr(value):
+    if value != value:
+        return 'NaN'
+    elif value == float('inf'):
+        return 'Infinity'
+    elif value == float('-inf'):
+        return '-Infinity'
+    return repr(value)
+
+
+def _compile(spec, path):
+    """
+    Compile ``spec`` into an ``(encode, coerce)`` tuple of functions.
+    """
+    if isinstance(spec, Optional):
+        encode, coerce = _compile(spec.spec, path)
+        def encode_optional(value):
+            if value is None:
+                return 'null'
+            return encode(value)
+        def coerce_optional(value):
+            if value is None:
+                return None
+            return coerce(value)
+        return encode_optional, coerce_optional
+    elif isinstance(spec, Schema):
+        return spec._compile(path)
+    elif isinstance(spec, list):
+        if len(spec) != 1:
+            raise ValueError('{0}: List specs must contain exactly one item spec.'.format(path))
+        encode_item, coerce_item = _compile(spec[0], path + '[]')
+        def encode_list(value):
+            if not isinstance(value, (list, tuple)):
+                raise ContentTypeDumpError('{0}: Expected a list.'.format(path))
+            return '[' + ', '.join([encode_item(item) for item in value]) + ']'
+        def coerce_list(value):
+            if not isinstance(value, list):
+                raise SchemaError('{0}: Expected a list.'.format(path))
+            return [coerce_item(item) for item in value]
+        return encode_list, coerce_list
+    elif spec in (str, unicode):
+        def encode_string(value):
+            if not isinstance(value, basestring):
+                raise ContentTypeDumpError('{0}: Expected a string.'.format(path))
+            try:
+                return encode_basestring_ascii(value)
+            except UnicodeDecodeError:
+                raise ContentTypeDumpError('{0}: Expected UTF-8 encoded bytes.'.format(path))
+        def coerce_string(value):
+            if not isinstance(value, basestring):
+                raise SchemaError('{0}: Expected a string.'.format(path))
+            return value
+        return encode_string, coerce_string
+    elif spec is bool:
+        def encode_bool(value):
+            if value is True:
+                return 'true'
+            elif value is False:
+                return 'false'
+            raise ContentTypeDumpError('{0}: Expected a boolean.'.format(path))
+        def coerce_bool(value):
+            if not isinstance(value, bool):
+                raise SchemaError('{0}: Expected a boolean.'.format(path))
+            return value
+        return encode_bool, coerce_bool
+    elif spec in (int, long):
+        def encode_int(value):
+            if not isinstance(value, (int, long)) or isinstance(value, bool):
+                raise ContentTypeDumpError('{0}: Expected an integer.'.format(path))
+            return str(value)
+        def coerce_int(value):
+            if not isinstance(value, (int, long)) or isinstance(value, bool):
+                raise SchemaError('{0}: Expected an integer.'.format(path))
+            return value
+        return encode_int, coerce_int
+    elif spec is float:
+        def encode_float(value):
+            if isinstance(value, float):
+                return _float_repr(value)
+            elif isinstance(value, (int, long)) and not isinstance(value, bool):
+                return str(value)
+            raise ContentTypeDumpError('{0}: Expected a number.'.format(path))
+        def coerce_float(value):
+            if not isinstance(value, (int, long, float)) or isinstance(value, bool):
+                raise SchemaError('{0}: Expected a number.'.format(path))
+            return float(value)
+        return encode_float, coerce_float
+    else:
+        raise ValueError('{0}: Unsupported field spec: {1!r}'.format(path, spec))
+
+
+class Schema(object):
+    """
+    Schema for a ``dict`` with a fixed set of keys. The schema is compiled
+    into a specialized JSON encoder and a request data validator the first
+    time it is used.
+
+    Only the keys in the schema are encoded, and request data with keys
+    that are not in the schema is rejected.
+    """
+    def __init__(self, fields):
+        """
+        :param fields: Dict mapping keys to field specs.
+        """
+        self.fields = fields
+        self._compiled = None
+        self._profiles = {}
+
+    def _compile(self, path=''):
+        fields = []
+        for key in sorted(self.fields):
+            spec = self.fields[key]
+            encode, coerce = _compile(spec, '{0}.{1}'.format(path, key))
+            fields.append((key, encode_basestring_ascii(key) + ': ', encode, coerce,
+                           not isinstance(spec, Optional)))
+        known_keys = frozenset(self.fields)
+
+        def encode_object(value):
+            if not isinstance(value, dict):
+                raise ContentTypeDumpError('{0}: Expected a dict.'.format(path or '.'))
+            parts = []
+            for key, prefix, encode, coerce, required in fields:
+                if key in value:
+                    parts.append(prefix + encode(value[key]))
+                elif required:
+                    raise ContentTypeDumpError('{0}.{1}: Missing required key.'.format(path, key))
+            return '{' + ', '.join(parts) + '}'
+
+        def coerce_object(value):
+            if not isinstance(value, dict):
+                raise SchemaError('{0}: Expected a dict.'.format(path or '.'))
+            for key in value:
+                if key not in known_keys:
+                    raise SchemaError('{0}.{1}: Unknown key.'.format(path, key))
+            coerced = {}
+            for key, prefix, encode, coerce, required in fields:
+                if key in value:
+                    coerced[key] = coerce(value[key])
+                elif required:
+                    raise SchemaError('{0}.{1}: Missing required key.'.format(path, key))
+            return coerced
+        return encode_object, coerce_object
+
+    def _get_compiled(self):
+        if self._compiled is None:
+            self._compiled = self._compile()
+        return self._compiled
+
+    def encode(self, pydata):
+        """
+        Encode ``pydata`` as compact JSON.
+
+        :raise restfulgrok.contenttype.ContentTypeDumpError: If ``pydata`` does not match the schema.
+        """
+        return self._get_compiled()[0](pydata)
+
+    def coerce(self, pydata):
+        """
+        Validate decoded request data, and return a copy where numbers are
+        coerced to the types in the schema.
+
+        :raise SchemaError: If ``pydata`` does not match the schema.
+        """
+        return self._get_compiled()[1](pydata)
+
+    def get_response_profile(self, profile):
+        """
+        Get a :class:`restfulgrok.contenttype.ResponseProfile` like
+        ``profile``, the profile of a JSON content type, where successful
+        responses are encoded with :meth:`encode`. The profile is created once
+        for each content type.
+        """
+        base = profile.content_type
+        schema_profile = self._profiles.get(base)
+        if schema_profile is None:
+            schema_profile = ResponseProfile.from_content_type(_create_content_type(self, base))
+            self._profiles[base] = schema_profile
+        return schema_profile
+
+
+def _create_content_type(response_schema, base):
+    """
+    Create a subclass of the ``base`` JSON content type that encodes
+    successful responses with ``response_schema``.
+    """
+    class SchemaContentType(base):
+        # The class is created at runtime, so it can not be pickled.
+        offloadable = False
+
+        @classmethod
+        def dumps(cls, pydata, view=None):
+            if view is not None and view.response.getStatus() >= 300:
+                return base.dumps(pydata, view)
+            return response_schema.encode(pydata)
+
+        @classmethod
+        def dump(cls, pydata, fileobj, view=None):
+            fileobj.write(cls.dumps(pydata, view))
+
+        @classmethod
+        def iterdumps(cls, pydata, view):
+            return iter([cls.dumps(pydata, view)])
+    return SchemaContentType
+
+
+def schema(response=None, request=None):
+    """
+    Decorator declaring the :class:`Schema` of the response and/or request
+    data of a ``handle_<method>()`` method on a :class:`SchemaViewMixin`.
+    """
+    def decorator(method):
+        method.response_schema = response
+        method.request_schema = request
+        return method
+    return decorator
+
+
+class SchemaViewMixin(GrokRestViewMixin):
+    """
+    Uses the schemas declared with :func:`schema` on the handlers:
+
+    - Successful JSON responses are encoded with the compiled encoder of the
+      response schema (see :meth:`get_response_profile`). Note that the
+      output is compact, not indented.
+    - Request data decoded by :meth:`get_requestdata` is validated and
+      coerced using the request schema.
+    """
+    def get_schema(self, kind):
+        """
+        Get the ``'request'`` or ``'response'`` schema of the handler for the
+        current request method (see :meth:`get_handler_method`), or ``None``.
+        """
+        handler = self.get_handler(self.get_handler_method())
+        return getattr(handler, kind + '_schema', None)
+
+    def get_requestdata(self):
+        decoded = super(SchemaViewMixin, self).get_requestdata()
+        request_schema = self.get_schema('request')
+        if request_schema is not None:
+            decoded = request_schema.coerce(decoded)
+        return decoded
+
+    def get_response_profile(self):
+        """
+        Uses :meth:`Schema.get_response_profile` for JSON responses if the
+        handler has a response schema, so the response is encoded by the
+        normal :meth:`encode_output_data`.
+        """
+        if self._response_profile is not None:
+            return self._response_profile
+        profile = super(SchemaViewMixin, self).get_response_profile()
+        response_schema = self.get_schema('response')
+        if response_schema is not None and issubclass(profile.content_type, JsonContentType):
+            profile = response_schema.get_response_profile(profile)
+            self._response_profile = profile
+        return profile
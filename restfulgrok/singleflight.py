@@ -0,0 +1,97 @@
+import threading
+
+from view import GrokRestViewMixin
+from view import EncodedResponse
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key into a single call.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, timeout=None):
+        """
+        Call ``func`` and return its result, unless a call with the same
+        ``key`` is already running. In that case, wait for that call and
+        return its result instead.
+
+        If the running call fails, or does not finish within ``timeout``
+        seconds, ``func`` is called independently.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+        if is_leader:
+            try:
+                call.result = func()
+            except:
+                call.failed = True
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return call.result
+        if not call.done.wait(timeout) or call.failed:
+            return func()
+        return call.result
+
+
+class SingleFlightViewMixin(GrokRestViewMixin):
+    """
+    Mix-in that coalesces concurrent identical requests. Requests for one of
+    the :obj:`singleflight_methods` with the same key (see
+    :meth:`get_singleflight_key`) wait for a single call to the handler, and
+    share its status, headers and encoded response.
+
+    Requests are authorized separately before they are coalesced.
+    """
+    #: Request methods that are coalesced.
+    singleflight_methods = ['get']
+
+    #: Seconds to wait for a running request before handling the request
+    #: independently.
+    singleflight_timeout = 30
+
+    #: The :class:`SingleFlight` coalescing the requests.
+    singleflight = SingleFlight()
+
+    def get_singleflight_user_key(self):
+        """
+        Get a string identifying the users that can share responses.
+        Defaults to the user id, so responses are only shared between
+        requests from the same user. Override this to share responses
+        between users with the same permissions.
+        """
+        return str(self.authorization_backend.get_userid(self))
+
+    def get_singleflight_key(self):
+        """
+        Get the key identifying requests that can share a response. The
+        :meth:`get_shared_response_key` for the user key.
+        """
+        return self.get_shared_response_key(self.get_singleflight_user_key())
+
+    def handle(self):
+        if self.get_requestmethod() not in self.singleflight_methods:
+            return super(SingleFlightViewMixin, self).handle()
+        response, body = self.singleflight.do(self.get_singleflight_key(),
+                                              self._handle_and_encode,
+                                              self.singleflight_timeout)
+        response.replay(self.response)
+        return EncodedResponse(body)
+
+    def _handle_and_encode(self):
+        return self.record_response(lambda view: super(SingleFlightViewMixin, view).handle())
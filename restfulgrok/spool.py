@@ -0,0 +1,65 @@
+from tempfile import SpooledTemporaryFile
+
+
+class SpooledBody(object):
+    """
+    Iterable response body that reads an encoded response from a spooled
+    temporary file in chunks, so the full response never has to be in memory.
+
+    Implements ``next()`` and ``__len__()`` as required by
+    ``ZPublisher.Iterators.IStreamIterator``, and ``close()`` as required for
+    WSGI response iterables.
+    """
+    def __init__(self, fileobj, chunksize=65536):
+        """
+        :param fileobj: The file containing the encoded response.
+        :param chunksize: Number of bytes to read for each iteration.
+        """
+        self.fileobj = fileobj
+        self.chunksize = chunksize
+        self.fileobj.seek(0, 2)
+        self.size = self.fileobj.tell()
+        self.fileobj.seek(0)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        chunk = self.fileobj.read(self.chunksize)
+        if not chunk:
+            self.close()
+            raise StopIteration()
+        return chunk
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        """
+        Close (and remove) the spool file.
+        """
+        self.fileobj.close()
+
+
+def spool_encode(content_type, pydata, view, threshold, chunksize=65536):
+    """
+    Encode ``pydata`` using :meth:`restfulgrok.contenttype.ContentType.dump`
+    into a ``tempfile.SpooledTemporaryFile`` that is kept in memory until it
+    grows beyond ``threshold`` bytes.
+
+    :return:
+        The encoded string if the output is ``threshold`` bytes or less,
+        and a :class:`SpooledBody` if the output was spooled to disk.
+    """
+    spoolfile = SpooledTemporaryFile(max_size=threshold)
+    try:
+        content_type.dump(pydata, spoolfile, view)
+    except:
+        spoolfile.close()
+        raise
+    if spoolfile.tell() <= threshold:
+        spoolfile.seek(0)
+        encoded = spoolfile.read()
+        spoolfile.close()
+        return encoded
+    return SpooledBody(spoolfile, chunksize)
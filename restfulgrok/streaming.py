@@ -0,0 +1,320 @@
+"""
+Server-sent events (``text/event-stream``), so clients can hold one
+connection open instead of polling. Example::
+
+    from restfulgrok.streaming import StreamingViewMixin, Event
+
+    class DashboardView(StreamingViewMixin, grok.View):
+        def handle_get(self):
+            return self.context.get_stats()
+
+        def handle_stream(self):
+            for change in self.context.wait_for_changes(timeout=5):
+                if change is None:
+                    yield None # Nothing happened, but heartbeats keep going
+                else:
+                    yield Event(change.asdict(), event='change', id=change.id)
+
+Without a custom :meth:`StreamingViewMixin.handle_stream`, the stream polls
+``handle_get()`` and sends its response each time it changes.
+"""
+import time
+
+from view import GrokRestViewMixin
+from view import EncodedResponse
+from contenttype import ContentType
+from contenttype import ContentTypesRegistry
+from contenttype import JsonContentType
+from throttle import MemoryThrottleBackend
+
+
+class Event(object):
+    """
+    An event in an event stream.
+    """
+    def __init__(self, data, event=None, id=None, retry=None):
+        """
+        :param data: The data of the event, encoded with the event data content type.
+        :param event: The event type. Clients default to ``message``.
+        :param id: The event id. Clients send the last id they got in the
+            ``Last-Event-ID`` header when they reconnect.
+
+        Line breaks and NUL characters are removed from ``event`` and ``id``
+        when they are sent, since they would end the field.
+        :param retry: Milliseconds clients should wait before reconnecting.
+        """
+        self.data = data
+        self.event = event
+        self.id = id
+        self.retry = retry
+
+
+def _format_field(name, value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    # A line break would start a new field (or event) with data from value.
+    return '{0}: {1}'.format(name, value.translate(None, '\r\n\x00'))
+
+
+class EventStreamContentType(ContentType):
+    """
+    ``text/event-stream`` content type. The data of each event is encoded
+    with the :meth:`StreamingViewMixin.get_event_data_content_type` of the
+    view (JSON by default). :meth:`dumps` encodes a single event, which is
+    used for responses that are not streamed, such as errors.
+    """
+    mimetype = 'text/event-stream'
+    extension = 'txt'
+    description = ('Server-sent events. The response is streamed, with an event '
+                   'each time the data changes.')
+
+    #: The comment sent as heartbeat.
+    heartbeat = ':\n\n'
+
+    @classmethod
+    def format_event(cls, event, data_content_type, view=None):
+        """
+        Encode ``event`` as a string.
+
+        :param event: An :class:`Event`, or data that is sent as the data of an event.
+        :param data_content_type: The content type used to encode the event data.
+        """
+        if not isinstance(event, Event):
+            event = Event(event)
+        lines = []
+        if event.id is not None:
+            lines.append(_format_field('id', event.id))
+        if event.event is not None:
+            lines.append(_format_field('event', event.event))
+        if event.retry is not None:
+            lines.append('retry: {0}'.format(int(event.retry)))
+        data = data_content_type.dumps(event.data, view)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        for line in data.splitlines() or ['']:
+            lines.append('data: ' + line)
+        return '\n'.join(lines) + '\n\n'
+
+    @classmethod
+    def dumps(cls, pydata, view=None):
+        get_data_content_type = getattr(view, 'get_event_data_content_type', None)
+        if get_data_content_type is None:
+            data_content_type = JsonContentType
+        else:
+            data_content_type = get_data_content_type()
+        event = None
+        if view is not None and view.response.getStatus() >= 400:
+            event = 'error'
+        return cls.format_event(Event(pydata, event=event), data_content_type, view)
+
+
+class EventStream(object):
+    """
+    Iterable response body for an event stream. Releases the stream slot
+    acquired from a :class:`restfulgrok.throttle.ThrottleBackend` when it is
+    closed, exhausted or garbage collected, even if iteration never started.
+    """
+    def __init__(self, chunks, backend=None, slot=None):
+        """
+        :param chunks: Iterator yielding the encoded chunks of the stream.
+        :param backend: The backend ``slot`` was acquired from.
+        :param slot: The acquired slot, or ``None``.
+        """
+        self.chunks = chunks
+        self.backend = backend
+        self.slot = slot
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self.chunks.next()
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        End the stream, and release the slot.
+        """
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+        slot, self.slot = self.slot, None
+        if slot is not None:
+            self.backend.release(slot)
+
+    def __del__(self):
+        self.close()
+
+
+class StreamingViewMixin(GrokRestViewMixin):
+    """
+    Mix-in that adds :class:`EventStreamContentType` to ``content_types``,
+    and responds to GET requests for ``text/event-stream`` with a stream of
+    the events from :meth:`handle_stream`.
+
+    A heartbeat comment is sent when nothing has been sent for
+    :obj:`stream_heartbeat_interval` seconds, and the stream ends when no
+    events have been sent for :obj:`stream_idle_timeout` seconds (clients
+    reconnect automatically). Both are checked each time
+    :meth:`handle_stream` yields ``None``, so it must yield ``None``
+    regularly while there are no events. The number of concurrent streams for each
+    view class is limited to :obj:`max_concurrent_streams`. Requests over
+    the limit are responded to with *429 Too Many Requests*.
+
+    The response body is an :class:`EventStream` iterator, which works with
+    :class:`restfulgrok.wsgi.WsgiApplication`, and other servers that
+    stream iterable responses. Set :obj:`stream_with_response_write` to
+    write the events using ``response.write()`` instead (for Zope).
+    Note that each stream holds a worker thread while it is open.
+    """
+    content_types = GrokRestViewMixin.content_types + ContentTypesRegistry(EventStreamContentType)
+
+    #: The content type used to encode the data of the events.
+    event_data_content_type = JsonContentType
+
+    #: Seconds between polls of ``handle_get()`` in the default
+    #: :meth:`handle_stream`.
+    stream_poll_interval = 2
+
+    #: Send a heartbeat when nothing has been sent for this many seconds.
+    stream_heartbeat_interval = 15
+
+    #: End the stream when no events have been sent for this many seconds.
+    #: ``None`` means no timeout. Only checked when :meth:`handle_stream`
+    #: yields ``None``.
+    stream_idle_timeout = 300
+
+    #: Max number of concurrent streams for the view class. ``None`` means
+    #: no limit.
+    max_concurrent_streams = 100
+
+    #: Milliseconds clients should wait before reconnecting. Sent at the
+    #: start of the stream if it is not ``None``.
+    stream_retry = None
+
+    #: Write the stream using ``response.write()``, and return an empty body.
+    stream_with_response_write = False
+
+    #: The :class:`restfulgrok.throttle.ThrottleBackend` counting the streams.
+    stream_backend = MemoryThrottleBackend()
+
+    def get_event_data_content_type(self):
+        """
+        Get the content type used to encode the data of the events.
+        Defaults to :obj:`event_data_content_type`.
+        """
+        return self.event_data_content_type
+
+    def is_stream_request(self):
+        """
+        Return ``True`` if the request is a GET request for an event stream.
+        """
+        return (self.get_requestmethod() == 'get'
+                and issubclass(self.get_content_type(), EventStreamContentType))
+
+    def get_handler(self, method):
+        if method == 'get' and self.is_stream_request():
+            return self.handle_event_stream
+        return super(StreamingViewMixin, self).get_handler(method)
+
+    def get_resource_metadata(self):
+        if self.is_stream_request():
+            return None
+        return super(StreamingViewMixin, self).get_resource_metadata()
+
+    def handle_stream(self):
+        """
+        Generator yielding the events of the stream, as :class:`Event`
+        objects or as event data. Yield ``None`` when there is nothing to
+        send, at least every :obj:`stream_heartbeat_interval` seconds, since
+        heartbeats and the idle timeout are only handled when the generator
+        yields. The generator is closed when the stream ends.
+
+        Defaults to polling ``handle_get()`` every :obj:`stream_poll_interval`
+        seconds, and sending its response when it changes. If ``handle_get()``
+        responds with an error, the error is sent as an ``error`` event, and
+        the stream ends.
+        """
+        previous = None
+        first = True
+        while True:
+            self.response.setStatus(200, 'OK')
+            data = self.handle_get()
+            if self.response.getStatus() >= 400:
+                yield Event(data, event='error')
+                return
+            if first or data != previous:
+                first = False
+                previous = data
+                yield data
+            else:
+                yield None
+            time.sleep(self.stream_poll_interval)
+
+    def handle_event_stream(self):
+        """
+        Respond to a stream request with the events from :meth:`handle_stream`.
+        """
+        slot = None
+        if self.max_concurrent_streams is not None:
+            slot = self.get_stream_key()
+            if not self.stream_backend.acquire(slot, self.max_concurrent_streams):
+                return self.response_429_too_many_streams()
+        self.response.setHeader('Cache-Control', 'no-cache')
+        self.response.setHeader('X-Accel-Buffering', 'no')
+        stream = EventStream(self.generate_event_stream(), self.stream_backend, slot)
+        if self.stream_with_response_write:
+            try:
+                for chunk in stream:
+                    self.response.write(chunk)
+            finally:
+                stream.close()
+            return EncodedResponse('')
+        return EncodedResponse(stream)
+
+    def get_stream_key(self):
+        """
+        Get the key used to count the concurrent streams of this view class.
+        """
+        cls = self.__class__
+        return 'stream:{0}.{1}'.format(cls.__module__, cls.__name__)
+
+    def generate_event_stream(self):
+        """
+        Generate the encoded event stream from :meth:`handle_stream`.
+        """
+        events = self.handle_stream()
+        data_content_type = self.get_event_data_content_type()
+        content_type = self.get_content_type()
+        try:
+            if self.stream_retry is not None:
+                yield 'retry: {0}\n\n'.format(int(self.stream_retry))
+            last_write = last_event = time.time()
+            for event in events:
+                now = time.time()
+                if event is None:
+                    if self.stream_idle_timeout is not None \
+                            and now - last_event >= self.stream_idle_timeout:
+                        break
+                    if now - last_write >= self.stream_heartbeat_interval:
+                        last_write = now
+                        yield content_type.heartbeat
+                    continue
+                last_write = last_event = now
+                yield content_type.format_event(event, data_content_type, self)
+        finally:
+            if hasattr(events, 'close'):
+                events.close()
+
+    def response_429_too_many_streams(self):
+        """
+        Respond with 429 Too Many Requests and a Retry-After header when
+        there are :obj:`max_concurrent_streams` open streams.
+        """
+        self.response.setHeader('Retry-After', str(self.stream_poll_interval))
+        return self.create_response(429, 'Too Many Requests',
+                                    {'error': 'Too many concurrent streams.'})
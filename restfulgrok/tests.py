@@ -1,14 +1,76 @@
 import json
 from unittest import TestCase
+from unittest import skipUnless
 
 from mock import MockRequest
+from mock import MockResponse
 from mock import MockRestView
 from mock import MockRestViewWithFancyHtml
+from mock import MockContext
+from view import ResponseRecorder
+from view import EncodedErrorCache
 from contenttype import JsonContentType
 from contenttype import YamlContentType
 from contenttype import ContentTypesRegistry
 from contenttype import ContentTypeLoadError
 from contenttype import ContentTypeDumpError
+from contenttype import InputLimits
+from contenttype import InputLimitExceeded
+from contenttype import RequestEntityTooLarge
+from contenttype import normalize_accept_header
+from contenttype import parse_accept_header
+from contenttype import RawFragment
+from contenttype import CsvContentType
+from contenttype import TsvContentType
+from spool import SpooledBody
+from jobs import BackgroundJobViewMixin
+from jobs import JobPool
+from jobs import JobResultStore
+from jobs import Job
+from wsgi import WsgiApplication
+from wsgi import WsgiRestView
+from authorization import AllowAllAuthorizationBackend
+from authorization import CallbackAuthorizationBackend
+from offload import EncodingPool
+from schema import Schema
+from schema import SchemaError
+from schema import SchemaViewMixin
+from schema import Optional
+from schema import schema
+from typeadapters import TypeAdapterRegistry
+from throttle import ThrottleBackend
+from throttle import MemoryThrottleBackend
+from throttle import ThrottledViewMixin
+from singleflight import SingleFlight
+from singleflight import SingleFlightViewMixin
+from fancyhtmlview import HtmlContentType
+from changefeed import ChangeFeedViewMixin
+from changefeed import ChangeLogStore
+from changefeed import MemoryChangeLogStore
+from changefeed import SqliteChangeLogStore
+from changefeed import SyncTokenExpired
+from changefeed import InvalidSyncToken
+from changefeed import coalesce_changes
+from patch import PatchError
+from patch import apply_merge_patch
+from patch import apply_json_patch
+from patch import json_equal
+from streaming import StreamingViewMixin
+from streaming import EventStreamContentType
+from streaming import Event
+from responsecache import ResponseCacheViewMixin
+from responsecache import ResponseCache
+from responsecache import MemoryResponseCache
+from responsecache import SqliteResponseCache
+from memprofile import MemoryProfilingViewMixin
+from memprofile import RssTracer
+from memprofile import TracemallocTracer
+from memprofile import get_memory_tracer
+from columnar import ArrowStreamContentType
+from columnar import ParquetContentType
+from columnar import columnar_content_types
+from columnar import iter_column_batches
+from columnar import pyarrow_available
 
 
 class MockRestViewAllImpl(MockRestView):
@@ -36,9 +98,8 @@ class TestContentType(TestCase):
             JsonContentType.loads(jsondata)
 
     def test_json_dumps(self):
-        from datetime import date
         with self.assertRaises(ContentTypeDumpError):
-            JsonContentType.dumps(date(2010, 1, 1))
+            JsonContentType.dumps(object())
 
     def test_yaml_loads(self):
         yamldata = """
@@ -55,15 +116,397 @@ attributes:
         with self.assertRaises(ContentTypeDumpError):
             YamlContentType.dumps(Tst())
 
+class TestCsvContentType(TestCase):
+    def test_dumps(self):
+        from datetime import date
+        rows = [{'name': u'J\u00e6ne', 'age': 30, 'tags': ['a', 'b']},
+                {'name': 'Joe, Jr.', 'born': date(2000, 1, 2), 'extra': 1}]
+        self.assertEquals(CsvContentType.dumps(rows),
+                          'age,name,tags\r\n'
+                          '30,J\xc3\xa6ne,"[""a"", ""b""]"\r\n'
+                          ',"Joe, Jr.",\r\n')
+        self.assertEquals(TsvContentType.dumps({'a': 1, 'b': None}), 'a\tb\r\n1\t\r\n')
+
+    def test_dumps_escapes_formulas(self):
+        rows = [{'a': '=1+2', 'b': u'@SUM(A1)', 'c': -1},
+                {'a': '+1', 'b': '-x', 'c': 'a=b'}]
+        self.assertEquals(CsvContentType.dumps(rows),
+                          "a,b,c\r\n'=1+2,'@SUM(A1),-1\r\n'+1,'-x,a=b\r\n")
+        class UnescapedCsvContentType(CsvContentType):
+            escape_formulas = False
+        self.assertEquals(UnescapedCsvContentType.dumps([{'a': '=1'}]), 'a\r\n=1\r\n')
+
+    def test_iterdumps(self):
+        class SmallChunksCsvContentType(CsvContentType):
+            chunk_size = 10
+        rows = ({'name': 'row{0}'.format(index)} for index in xrange(5))
+        chunks = list(SmallChunksCsvContentType.iterdumps(rows))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEquals(''.join(chunks),
+                          'name\r\nrow0\r\nrow1\r\nrow2\r\nrow3\r\nrow4\r\n')
+        with self.assertRaises(ContentTypeDumpError):
+            list(CsvContentType.iterdumps([{'a': 1}, 2]))
+
+    def test_iterloads_limits_long_lines(self):
+        from StringIO import StringIO
+        class View(object):
+            input_limits = InputLimits(max_body_bytes=100)
+        fileobj = StringIO('a\r\n' + 'x' * 1000000)
+        with self.assertRaises(RequestEntityTooLarge):
+            list(CsvContentType.iterloads(fileobj, View()))
+        self.assertTrue(fileobj.tell() <= 65536)
+        rows = list(CsvContentType.iterloads(StringIO('a,b\r\n"1\r\n2",3\r\n4,5'), View()))
+        self.assertEquals(rows, [{'a': u'1\r\n2', 'b': u'3'}, {'a': u'4', 'b': u'5'}])
+
+    def test_dumps_string_rows(self):
+        self.assertEquals(CsvContentType.dumps(['abc', u'd,e']), 'abc\r\n"d,e"\r\n')
+        self.assertEquals(CsvContentType.dumps([['a', 'b'], 'cd']), 'a,b\r\ncd\r\n')
+        with self.assertRaises(ContentTypeDumpError):
+            CsvContentType.dumps(['abc', {'a': 1}])
+
+    def test_dump_generator_with_column_hint(self):
+        from StringIO import StringIO
+        class View(object):
+            csv_columns = ['name', 'born']
+        rows = ({'name': 'row{0}'.format(index), 'born': index} for index in xrange(3))
+        fileobj = StringIO()
+        CsvContentType.dump(rows, fileobj, View())
+        self.assertEquals(fileobj.getvalue(), 'name,born\r\nrow0,0\r\nrow1,1\r\nrow2,2\r\n')
+
+    def test_loads(self):
+        self.assertEquals(CsvContentType.loads('name,age\r\nJ\xc3\xa6ne,30\r\n"Joe, Jr.",\r\n'),
+                          [{'name': u'J\u00e6ne', 'age': u'30'}, {'name': u'Joe, Jr.', 'age': u''}])
+        with self.assertRaises(ContentTypeLoadError):
+            CsvContentType.loads('a,b\r\n1\r\n')
+        with self.assertRaises(ContentTypeLoadError):
+            CsvContentType.loads('a\r\n\xff\r\n')
+        class View(object):
+            input_limits = InputLimits(max_elements=3)
+        with self.assertRaises(InputLimitExceeded):
+            CsvContentType.loads('a,b\r\n1,2\r\n', View())
+
+    def test_iter_requestdata(self):
+        class View(MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            content_types = MockRestView.content_types + ContentTypesRegistry(CsvContentType)
+            input_limits = InputLimits(max_body_bytes=100)
+            def handle_post(self):
+                return {'count': sum(1 for row in self.iter_requestdata())}
+        body = 'a,b\r\n' + '1,2\r\n' * 10
+        view = View(request=MockRequest('POST', body, headers={'Accept': 'text/csv'}),
+                    response=MockResponse())
+        self.assertEquals(view.render(), 'count\r\n10\r\n')
+        view = View(request=MockRequest('POST', body * 10, headers={'Accept': 'text/csv'}),
+                    response=MockResponse())
+        view.render()
+        self.assertEquals(view.response.getStatus(), 413)
+
+
+class TestColumnar(TestCase):
+    def test_iter_column_batches(self):
+        rows = ({'a': index, 'b': str(index)} for index in xrange(5))
+        self.assertEquals(list(iter_column_batches(rows, 2)),
+                          [(['a', 'b'], [[0, 1], ['0', '1']]),
+                           (['a', 'b'], [[2, 3], ['2', '3']]),
+                           (['a', 'b'], [[4], ['4']])])
+        self.assertEquals(list(iter_column_batches({'x': [1, 2, 3], 'y': (4, 5, 6)}, 2, ['y', 'x'])),
+                          [(['y', 'x'], [[4, 5], [1, 2]]),
+                           (['y', 'x'], [[6], [3]])])
+        self.assertEquals(list(iter_column_batches({'error': 'Not found'}, 2)),
+                          [(['error'], [['Not found']])])
+        self.assertEquals(list(iter_column_batches([], 2)), [])
+        with self.assertRaises(ContentTypeDumpError):
+            list(iter_column_batches([{'a': 1}, [1]], 2))
+
+    def test_dumps_with_fake_pyarrow(self):
+        # Tests the encoding without pyarrow, using a fake module that
+        # records the written batches.
+        import sys
+        import types
+        written = []
+        class Field(object):
+            type = None
+        class RecordBatch(object):
+            def __init__(self, arrays, names):
+                self.arrays = arrays
+                self.schema = [Field() for name in names]
+            from_arrays = classmethod(lambda cls, arrays, names: cls(arrays, names))
+        class RecordBatchStreamWriter(object):
+            def __init__(self, fileobj, schema):
+                pass
+            def write_batch(self, batch):
+                written.append(batch.arrays)
+            def close(self):
+                written.append('closed')
+        pyarrow = types.ModuleType('pyarrow')
+        pyarrow.ArrowException = type('ArrowException', (Exception,), {})
+        pyarrow.array = lambda values, type=None: list(values)
+        pyarrow.schema = lambda fields: []
+        pyarrow.RecordBatch = RecordBatch
+        pyarrow.RecordBatchStreamWriter = RecordBatchStreamWriter
+        class View(MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            content_types = ContentTypesRegistry(ArrowStreamContentType)
+            rows = [{'a': 1}, {'a': 2}]
+            def handle_get(self):
+                return self.rows
+        original = sys.modules.get('pyarrow')
+        sys.modules['pyarrow'] = pyarrow
+        try:
+            ArrowStreamContentType.dumps([{'a': 1, 'b': 'x'}, {'a': 2}])
+            self.assertEquals(written, [[[1, 2], ['x', None]], 'closed'])
+            view = View(request=MockRequest('GET', headers={'Accept': ArrowStreamContentType.mimetype}),
+                        response=MockResponse())
+            view.rows = [{'a': 1}, 'invalid']
+            view.render()
+            self.assertEquals(view.response.getStatus(), 400)
+        finally:
+            if original is None:
+                del sys.modules['pyarrow']
+            else:
+                sys.modules['pyarrow'] = original
+
+    def test_registration(self):
+        self.assertEquals(ArrowStreamContentType.mimetype in columnar_content_types,
+                          pyarrow_available())
+        self.assertEquals(ParquetContentType.mimetype in columnar_content_types,
+                          pyarrow_available())
+
+    def test_contenttype_header(self):
+        class View(MockRestView):
+            content_types = MockRestView.content_types + ContentTypesRegistry(ArrowStreamContentType)
+        view = View(request=MockRequest('GET', headers={'Accept': 'application/vnd.apache.arrow.stream'}),
+                    response=MockResponse())
+        view.set_contenttype_header()
+        self.assertEquals(dict(view.response.headers)['Content-Type'],
+                          'application/vnd.apache.arrow.stream')
+        view.set_contenttype_header(ParquetContentType.mimetype)
+        self.assertEquals(dict(view.response.headers)['Content-Type'],
+                          'application/vnd.apache.parquet; charset=UTF-8')
+        view.set_contenttype_header(ArrowStreamContentType.mimetype)
+        self.assertEquals(dict(view.response.headers)['Content-Type'],
+                          'application/vnd.apache.arrow.stream')
+
+    @skipUnless(pyarrow_available(), 'pyarrow is not installed')
+    def test_dumps_loads(self):
+        class View(object):
+            columnar_columns = ['name', 'value']
+        rows = [{'name': u'row{0}'.format(index), 'value': index} for index in xrange(5)]
+        for content_type in (ArrowStreamContentType, ParquetContentType):
+            class BatchedContentType(content_type):
+                batch_size = 2
+            rawdata = BatchedContentType.dumps(iter(rows), View())
+            self.assertEquals(content_type.loads(rawdata), rows)
+            with self.assertRaises(ContentTypeLoadError):
+                content_type.loads('not columnar data')
+
+
+class TestInputLimits(TestCase):
+    class View(MockRestView):
+        authorization_backend = AllowAllAuthorizationBackend()
+        input_limits = InputLimits(max_body_bytes=100, max_depth=3, max_elements=20,
+                                   max_yaml_aliases=2)
+
+    def loads(self, content_type, rawdata):
+        return content_type.loads(rawdata, self.View())
+
+    def test_json(self):
+        self.assertEquals(self.loads(JsonContentType, '{"a": [[1, "[[[[,,,,"]]}'),
+                          {'a': [[1, '[[[[,,,,']]})
+        with self.assertRaises(InputLimitExceeded):
+            self.loads(JsonContentType, '[[[[1]]]]')
+        with self.assertRaises(InputLimitExceeded):
+            self.loads(JsonContentType, json.dumps(range(30)))
+        with self.assertRaises(RequestEntityTooLarge):
+            self.loads(JsonContentType, json.dumps('x' * 100))
+
+    def test_json_escapes(self):
+        self.assertEquals(self.loads(JsonContentType, r'["\\", "\"]]]]", [1]]'),
+                          ['\\', '"]]]]', [1]])
+        with self.assertRaises(InputLimitExceeded):
+            self.loads(JsonContentType, r'["\\", [[[1]]]]')
+
+    def test_json_unterminated_string_is_linear(self):
+        import time
+        # Scanning strings by backtracking takes quadratic time on this
+        rawdata = '"' + '\\"' * 200000
+        start = time.time()
+        with self.assertRaises(ContentTypeLoadError):
+            JsonContentType.loads(rawdata)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_yaml(self):
+        self.assertEquals(self.loads(YamlContentType, 'a: [[1, 2]]'),
+                          {'a': [[1, 2]]})
+        with self.assertRaises(InputLimitExceeded):
+            self.loads(YamlContentType, '[[[[1]]]]')
+        with self.assertRaises(InputLimitExceeded):
+            self.loads(YamlContentType, YamlContentType.dumps(range(30)))
+
+    def test_yaml_aliases(self):
+        self.assertEquals(self.loads(YamlContentType, 'a: &x [1, 2]\nb: *x'),
+                          {'a': [1, 2], 'b': [1, 2]})
+        with self.assertRaises(InputLimitExceeded):
+            self.loads(YamlContentType, 'a: &x 1\nb: [*x, *x, *x]')
+        # Alias expansion counts as elements
+        laughs = 'a: &a [1, 2, 3, 4]\nb: &b [*a, *a]\n'
+        with self.assertRaises(InputLimitExceeded):
+            self.loads(YamlContentType, laughs + 'c: [*b, *b]')
+
+    def test_render(self):
+        class View(self.View):
+            def handle_post(self):
+                return self.get_requestdata()
+        view = View(request=MockRequest('POST', body='[' + '1,' * 200 + '1]'),
+                    response=MockResponse())
+        view.render()
+        self.assertEquals(view.response.status, (413, 'Request Entity Too Large'))
+        view = View(request=MockRequest('POST', body='[[[[1]]]]'),
+                    response=MockResponse())
+        view.render()
+        self.assertEquals(view.response.status, (400, 'Bad Request'))
+
+
+class TestRawFragment(TestCase):
+    pydata = {'items': [RawFragment('{"id": 1, "tags": ["a"]}'), RawFragment(u'"\u00e6"')],
+              'text': u'\x00rawfragment-0-0'}
+    expected = {'items': [{'id': 1, 'tags': ['a']}, u'\u00e6'],
+                'text': u'\x00rawfragment-0-0'}
+
+    def test_json(self):
+        encoded = JsonContentType.dumps(self.pydata)
+        self.assertTrue('{"id": 1, "tags": ["a"]}' in encoded)
+        self.assertEquals(json.loads(encoded), self.expected)
+
+    def test_json_dump(self):
+        from StringIO import StringIO
+        fileobj = StringIO()
+        JsonContentType.dump(self.pydata, fileobj)
+        self.assertTrue('{"id": 1, "tags": ["a"]}' in fileobj.getvalue())
+        self.assertEquals(json.loads(fileobj.getvalue()), self.expected)
+
+    def test_yaml(self):
+        import yaml
+        self.assertEquals(yaml.safe_load(YamlContentType.dumps(self.pydata)), self.expected)
+
+
+class TestTypeAdapterRegistry(TestCase):
+    def test_default_adapters(self):
+        from datetime import date, datetime
+        from decimal import Decimal
+        pydata = {'date': date(2010, 1, 2),
+                  'datetime': datetime(2010, 1, 2, 3, 4, 5),
+                  'decimal': Decimal('1.10'),
+                  'set': set([1])}
+        expected = {'date': '2010-01-02',
+                    'datetime': '2010-01-02T03:04:05',
+                    'decimal': '1.10',
+                    'set': [1]}
+        self.assertEquals(json.loads(JsonContentType.dumps(pydata)), expected)
+        yamldata = YamlContentType.loads(YamlContentType.dumps(pydata))
+        self.assertEquals(yamldata['decimal'], '1.10')
+
+    def test_mro_lookup(self):
+        class Base(object):
+            pass
+        class Sub(Base):
+            pass
+        registry = TypeAdapterRegistry()
+        registry.register(Base, lambda obj: 'base')
+        self.assertEquals(registry.adapt(Sub()), 'base')
+        registry.register(Sub, lambda obj: 'sub')
+        self.assertEquals(registry.adapt(Sub()), 'sub')
+        with self.assertRaises(TypeError):
+            registry.adapt(object())
+
+    def test_yaml_dumper(self):
+        class Point(object):
+            def __init__(self, x, y):
+                self.x, self.y = x, y
+        registry = TypeAdapterRegistry()
+        registry.register(Point, lambda obj: [obj.x, obj.y])
+        import yaml
+        output = yaml.dump({'p': Point(1, 2)}, Dumper=registry.get_yaml_dumper())
+        self.assertEquals(yaml.safe_load(output), {'p': [1, 2]})
+
+
 class TestGrokRestViewMixin(TestCase):
     def test_handle_unsupported(self):
-        for method in ('GET', 'POST', 'PUT', 'DELELTE', 'OPTIONS', 'HEAD'):
+        for method in ('GET', 'POST', 'PUT', 'DELELTE', 'HEAD', 'PATCH'):
             view = MockRestView(request=MockRequest(method))
             responsedata = view.handle()
             errormsg = 'Method Not Allowed: {0}'.format(method)
             self.assertEquals(view.response.status, (405, errormsg))
             self.assertEquals(responsedata, {'error': errormsg})
 
+    def test_error_cache(self):
+        dumps_calls = []
+        class CountingJsonContentType(JsonContentType):
+            @classmethod
+            def dumps(cls, pydata, view=None):
+                dumps_calls.append(pydata)
+                return super(CountingJsonContentType, cls).dumps(pydata, view)
+        class View(MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            content_types = ContentTypesRegistry(CountingJsonContentType)
+            error_cache = EncodedErrorCache()
+            def handle_get(self):
+                return {'error': 'Not found'}
+        for index in xrange(3):
+            view = View(request=MockRequest('POST'))
+            self.assertEquals(view.render(), JsonContentType.dumps({'error': 'Method Not Allowed: POST'}))
+            self.assertEquals(view.response.status, (405, 'Method Not Allowed: POST'))
+        self.assertEquals(len(dumps_calls), 1)
+
+        # Other bodies and successful responses are not served from the cache
+        view = View(request=MockRequest('PUT'))
+        self.assertEquals(view.render(), JsonContentType.dumps({'error': 'Method Not Allowed: PUT'}))
+        self.assertEquals(len(dumps_calls), 2)
+        for index in xrange(2):
+            view = View(request=MockRequest('GET'))
+            self.assertEquals(view.render(), JsonContentType.dumps({'error': 'Not found'}))
+        self.assertEquals(len(dumps_calls), 4)
+
+        View.error_cache = None
+        View(request=MockRequest('POST')).render()
+        self.assertEquals(len(dumps_calls), 5)
+
+    def test_error_cache_html(self):
+        class View(MockRestViewWithFancyHtml):
+            authorization_backend = AllowAllAuthorizationBackend()
+            error_cache = EncodedErrorCache()
+        output = View(request=MockRequest('POST', headers={'Accept': 'text/html'})).render()
+        self.assertTrue('405' in output)
+        self.assertEquals(View.error_cache.get((View, HtmlContentType, 405, 'Method Not Allowed: POST',
+                                                frozenset([('error', 'Method Not Allowed: POST')]))),
+                          output)
+        self.assertEquals(View(request=MockRequest('POST', headers={'Accept': 'text/html'})).render(),
+                          output)
+        self.assertEquals(len(View.error_cache), 1)
+
+        # Not cached when errorview may use the view
+        class ViewHtmlContentType(HtmlContentType):
+            error_cacheable = False
+        class OtherView(View):
+            content_types = ContentTypesRegistry(ViewHtmlContentType)
+            error_cache = EncodedErrorCache()
+        OtherView(request=MockRequest('POST', headers={'Accept': 'text/html'})).render()
+        self.assertEquals(len(OtherView.error_cache), 0)
+
+    def test_not_acceptable(self):
+        class View(MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            error_cache = EncodedErrorCache()
+        for index in xrange(2):
+            view = View(request=MockRequest('GET', headers={'Accept': 'image/png'}),
+                        response=MockResponse())
+            output = view.render()
+            self.assertEquals(view.response.status, (406, 'Not Acceptable'))
+            self.assertTrue(('Content-Type', 'application/json; charset=UTF-8') in view.response.headers)
+            self.assertEquals(sorted(json.loads(output)['acceptable_mimetypes']),
+                              ['application/json', 'application/x-yaml'])
+        self.assertEquals(len(View.error_cache), 1)
+
     def test_handle_override(self):
         self.assertEquals(MockRestViewAllImpl(request=MockRequest('GET')).handle(), {'msg': 'GET called'})
         self.assertEquals(MockRestViewAllImpl(request=MockRequest('POST')).handle(), {'msg': 'POST called'})
@@ -72,6 +515,71 @@ class TestGrokRestViewMixin(TestCase):
         self.assertEquals(MockRestViewAllImpl(request=MockRequest('OPTIONS')).handle(), {'msg': 'OPTIONS called'})
         self.assertEquals(MockRestViewAllImpl(request=MockRequest('HEAD')).handle(), {'msg': 'HEAD called'})
 
+    def test_handle_options(self):
+        class View(MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            def handle_get(self):
+                calls.append('get')
+            def handle_put(self):
+                calls.append('put')
+        calls = []
+        view = View(request=MockRequest('OPTIONS'), response=MockResponse())
+        self.assertEquals(view.render(), '')
+        self.assertEquals(view.response.status, (200, 'OK'))
+        self.assertTrue(('Allow', 'GET, PUT, OPTIONS, HEAD') in view.response.headers)
+        self.assertEquals(calls, [])
+
+        view = MockRestView(request=MockRequest('OPTIONS'), response=MockResponse())
+        view.handle()
+        self.assertTrue(('Allow', 'OPTIONS') in view.response.headers)
+
+    def test_head_and_options_with_view_permission(self):
+        class View(MockRestView):
+            authorization_backend = CallbackAuthorizationBackend(
+                lambda permission, view: permission == 'View')
+            def handle_get(self):
+                return {'hello': 'world'}
+        for method in ('GET', 'HEAD', 'OPTIONS'):
+            view = View(request=MockRequest(method), response=MockResponse())
+            view.render()
+            self.assertEquals(view.response.getStatus(), 200)
+        view = View(request=MockRequest('PUT'), response=MockResponse())
+        view.render()
+        self.assertEquals(view.response.getStatus(), 401)
+
+    def test_handle_head(self):
+        class View(MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            def handle_get(self):
+                calls.append('get')
+                return {'hello': 'world'}
+        calls = []
+        expected_length = str(len(JsonContentType.dumps({'hello': 'world'})))
+        view = View(request=MockRequest('HEAD'), response=MockResponse())
+        self.assertEquals(view.render(), '')
+        self.assertEquals(view.response.status, (200, 'OK'))
+        self.assertTrue(('Content-Length', expected_length) in view.response.headers)
+        self.assertEquals(calls, ['get'])
+
+    def test_handle_head_cached_length(self):
+        from view import EncodedLengthCache
+        class View(MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            encoded_length_cache = EncodedLengthCache()
+            def get_resource_metadata(self):
+                return {'etag': '"v1"'}
+            def handle_get(self):
+                calls.append('get')
+                return {'hello': 'world'}
+        calls = []
+        expected_length = str(len(JsonContentType.dumps({'hello': 'world'})))
+        View(request=MockRequest('GET'), response=MockResponse()).render()
+        view = View(request=MockRequest('HEAD'), response=MockResponse())
+        self.assertEquals(view.render(), '')
+        self.assertTrue(('ETag', '"v1"') in view.response.headers)
+        self.assertTrue(('Content-Length', expected_length) in view.response.headers)
+        self.assertEquals(calls, ['get'])
+
     def test_get_requestdata(self):
         pydata = {'hello': 'world'}
         rawdata = json.dumps({'hello': 'world'})
@@ -95,6 +603,29 @@ class TestGrokRestViewMixin(TestCase):
         self.assertEquals(MockRestView(request=MockRequest('GET', getdata={'mimetype': 'application/x-yaml'})).get_content_type(),
                           YamlContentType)
 
+    def test_get_content_type_querystring_list(self):
+        view = MockRestView(request=MockRequest('GET', getdata={'mimetype': ['application/json', 'application/x-yaml']},
+                                                headers={'Accept': 'application/x-yaml'}))
+        self.assertEquals(view.get_content_type(), YamlContentType)
+
+    def test_get_response_profile(self):
+        view = MockRestView(request=MockRequest('GET', headers={'Accept': 'application/x-yaml'}))
+        profile = view.get_response_profile()
+        self.assertTrue(profile is view.content_types.get_profile('application/x-yaml'))
+        self.assertTrue(profile is view.get_response_profile())
+        self.assertEquals(profile.contenttype_header, 'application/x-yaml; charset=UTF-8')
+        self.assertEquals(view.get_content_type(), YamlContentType)
+        self.assertTrue(view.content_types.negotiate_profile('text/x-unknown') is None)
+
+    def test_encode_output_data_uses_response_profile(self):
+        class View(MockRestView):
+            def get_response_profile(self):
+                profile = super(View, self).get_response_profile()
+                return profile._replace(dumps=lambda pydata, view: 'encoded')
+        view = View(request=MockRequest('GET', headers={'Accept': 'application/json'}),
+                    response=MockResponse())
+        self.assertEquals(view.encode_output_data({'a': 1}), 'encoded')
+
     def test_response_400_bad_request(self):
         view = MockRestView(request=MockRequest('GET'))
         data = {'hello': 'world'}
@@ -127,6 +658,1032 @@ class TestGrokRestViewMixin(TestCase):
         self.assertEquals(outdata, ['a', ['b.1', 'b.2'], 'c'])
 
 
+    def test_encode_output_data_spooled(self):
+        pydata = {'items': range(1000)}
+        view = MockRestView(request=MockRequest('GET'))
+        view.spool_threshold = 100
+        view.spool_chunksize = 512
+        output = view.encode_output_data(pydata)
+        self.assertTrue(isinstance(output, SpooledBody))
+        expected = JsonContentType.dumps(pydata)
+        self.assertEquals(len(output), len(expected))
+        self.assertEquals(''.join(output), expected)
+        self.assertTrue(('Content-Length', str(len(expected))) in view.response.headers)
+
+    def test_encode_output_data_below_spool_threshold(self):
+        view = MockRestView(request=MockRequest('GET'))
+        view.spool_threshold = 1000
+        self.assertEquals(view.encode_output_data({'hello': 'world'}),
+                          JsonContentType.dumps({'hello': 'world'}))
+
+
+
+class TestBackgroundJobViewMixin(TestCase):
+    class View(BackgroundJobViewMixin, MockRestView):
+        authorization_backend = AllowAllAuthorizationBackend()
+        job_pool = JobPool(workers=1)
+        job_store = JobResultStore()
+        def get_background_job(self):
+            return lambda: {'hello': 'world'}
+        def handle_get(self):
+            return {'hello': 'world'}
+
+    def test_background_job(self):
+        view = self.View(request=MockRequest('GET', getdata={'background': 'true'}),
+                         response=MockResponse())
+        responsedata = view.handle()
+        self.assertEquals(view.response.status, (202, 'Accepted'))
+        self.assertEquals(responsedata['status'], 'pending')
+        self.assertEquals(responsedata['url'],
+                          'http://localhost/?mimetype=application%2Fjson&job=' + responsedata['job'])
+        self.assertTrue(view.job_store.get(responsedata['job'], view.get_job_owner()).wait(5))
+
+        pollview = self.View(request=MockRequest('GET', getdata={'job': responsedata['job']}),
+                             response=MockResponse())
+        output = pollview.encode_output_data(pollview.handle())
+        self.assertEquals(pollview.response.status, (200, 'OK'))
+        self.assertEquals(json.loads(output), {'hello': 'world'})
+
+    def test_job_from_other_view(self):
+        view = self.View(request=MockRequest('GET', getdata={'background': 'true'}),
+                         response=MockResponse())
+        jobid = view.handle()['job']
+        self.assertTrue(view.job_store.get(jobid, view.get_job_owner()).wait(5))
+        class OtherView(self.View):
+            pass
+        for pollview in (OtherView(request=MockRequest('GET', getdata={'job': jobid}),
+                                   response=MockResponse()),
+                         self.View(request=MockRequest('GET', getdata={'job': jobid}),
+                                   response=MockResponse(), context=MockContext(id='other'))):
+            pollview.handle()
+            self.assertEquals(pollview.response.status, (404, 'Not Found'))
+
+    def test_job_from_other_user(self):
+        class View(self.View):
+            authorization_backend = CallbackAuthorizationBackend(
+                lambda permission, view: True,
+                lambda view: view.request.get('user'))
+        view = View(request=MockRequest('GET', getdata={'background': 'true', 'user': 'a'}),
+                    response=MockResponse())
+        jobid = view.handle()['job']
+        self.assertTrue(view.job_store.get(jobid, view.get_job_owner()).wait(5))
+        pollview = View(request=MockRequest('GET', getdata={'job': jobid, 'user': 'b'}),
+                        response=MockResponse())
+        pollview.handle()
+        self.assertEquals(pollview.response.status, (404, 'Not Found'))
+        pollview = View(request=MockRequest('GET', getdata={'job': jobid, 'user': 'a'}),
+                        response=MockResponse())
+        pollview.handle()
+        self.assertEquals(pollview.response.status, (200, 'OK'))
+
+    def test_failed_job(self):
+        def fail():
+            raise ValueError('secret internal details')
+        class View(self.View):
+            def get_background_job(self):
+                return fail
+        view = View(request=MockRequest('GET', getdata={'background': 'true'}),
+                    response=MockResponse())
+        jobid = view.handle()['job']
+        self.assertTrue(view.job_store.get(jobid, view.get_job_owner()).wait(5))
+        pollview = View(request=MockRequest('GET', getdata={'job': jobid}),
+                        response=MockResponse())
+        responsedata = pollview.handle()
+        self.assertEquals(pollview.response.status, (500, 'Internal Server Error'))
+        self.assertEquals(responsedata['error'], Job.failed_message)
+
+    def test_pending_jobs_expire(self):
+        store = JobResultStore(pending_ttl=0)
+        job = store.create('owner')
+        job.created -= 1
+        self.assertEquals(store.get(job.jobid, 'owner'), None)
+
+    def test_not_background_job(self):
+        class View(self.View):
+            def get_background_job(self):
+                return None
+        view = View(request=MockRequest('GET', getdata={'background': 'true'}),
+                    response=MockResponse())
+        self.assertEquals(view.handle(), {'hello': 'world'})
+
+    def test_unknown_job(self):
+        view = self.View(request=MockRequest('GET', getdata={'job': 'unknown'}),
+                         response=MockResponse())
+        view.handle()
+        self.assertEquals(view.response.status, (404, 'Not Found'))
+
+    def test_not_background_request(self):
+        view = self.View(request=MockRequest('GET'), response=MockResponse())
+        self.assertEquals(view.handle(), {'hello': 'world'})
+
+
+class TestWsgiApplication(TestCase):
+    class View(WsgiRestView):
+        authorization_backend = AllowAllAuthorizationBackend()
+        def handle_get(self):
+            return {'hello': 'world'}
+        def handle_post(self):
+            return self.response_201_created(self.get_requestdata_dict())
+
+    def call(self, app, **environ):
+        from wsgiref.util import setup_testing_defaults
+        setup_testing_defaults(environ)
+        started = []
+        def start_response(status, headers):
+            started.append((status, dict(headers)))
+        body = ''.join(app(environ, start_response))
+        return started[0][0], started[0][1], body
+
+    def test_get(self):
+        status, headers, body = self.call(WsgiApplication(self.View),
+                                          QUERY_STRING='mimetype=application/x-yaml')
+        self.assertEquals(status, '200 OK')
+        self.assertEquals(headers['Content-Type'], 'application/x-yaml; charset=UTF-8')
+        self.assertEquals(headers['Content-Length'], str(len(body)))
+        self.assertEquals(YamlContentType.loads(body), {'hello': 'world'})
+
+    def test_post(self):
+        from StringIO import StringIO
+        rawdata = json.dumps({'a': 'test'})
+        status, headers, body = self.call(WsgiApplication(self.View),
+                                          REQUEST_METHOD='POST',
+                                          HTTP_ACCEPT='application/json',
+                                          CONTENT_LENGTH=str(len(rawdata)),
+                                          **{'wsgi.input': StringIO(rawdata)})
+        self.assertEquals(status, '201 Created')
+        self.assertEquals(json.loads(body), {'a': 'test'})
+
+    def test_unauthorized(self):
+        class View(self.View):
+            authorization_backend = CallbackAuthorizationBackend(
+                lambda permission, view: permission == 'View')
+        status, headers, body = self.call(WsgiApplication(View),
+                                          REQUEST_METHOD='PUT',
+                                          HTTP_ACCEPT='application/json')
+        self.assertEquals(status, '401 Unauthorized')
+        self.assertEquals(json.loads(body)['error'],
+                          'Not authorized for: PUT requests. '
+                          'Required permission: Modify portal content')
+
+    def test_querystring_does_not_override_environ(self):
+        class View(self.View):
+            authorization_backend = CallbackAuthorizationBackend(
+                lambda permission, view: view.request.get('REMOTE_USER') == 'admin')
+        app = WsgiApplication(View)
+        status, headers, body = self.call(app, QUERY_STRING='REMOTE_USER=admin',
+                                          HTTP_ACCEPT='application/json')
+        self.assertEquals(status, '401 Unauthorized')
+        status, headers, body = self.call(app, QUERY_STRING='REMOTE_USER=other',
+                                          REMOTE_USER='admin', HTTP_ACCEPT='application/json')
+        self.assertEquals(status, '200 OK')
+
+    def test_body_limit(self):
+        from StringIO import StringIO
+        class View(self.View):
+            input_limits = InputLimits(max_body_bytes=10)
+        rawdata = json.dumps({'a': 'x' * 100})
+        wsgi_input = StringIO(rawdata)
+        status, headers, body = self.call(WsgiApplication(View),
+                                          REQUEST_METHOD='POST',
+                                          HTTP_ACCEPT='application/json',
+                                          CONTENT_LENGTH=str(len(rawdata)),
+                                          **{'wsgi.input': wsgi_input})
+        self.assertEquals(status, '413 Request Entity Too Large')
+        self.assertEquals(wsgi_input.tell(), 11)
+
+    def test_not_acceptable(self):
+        status, headers, body = self.call(WsgiApplication(self.View), HTTP_ACCEPT='image/png')
+        self.assertEquals(status, '406 Not Acceptable')
+        self.assertEquals(headers['Content-Type'], 'application/json; charset=UTF-8')
+        self.assertEquals(sorted(json.loads(body)['acceptable_mimetypes']),
+                          ['application/json', 'application/x-yaml'])
+
+    def test_streaming(self):
+        class View(self.View):
+            spool_threshold = 10
+        app = WsgiApplication(View)
+        status, headers, body = self.call(app, HTTP_ACCEPT='application/json')
+        self.assertEquals(headers['Content-Length'], str(len(body)))
+        self.assertEquals(json.loads(body), {'hello': 'world'})
+
+
+class TestEncodingPool(TestCase):
+    def test_should_offload(self):
+        pool = EncodingPool(min_size=1000, min_items=100)
+        self.assertFalse(pool.should_offload(JsonContentType, range(10)))
+        self.assertTrue(pool.should_offload(JsonContentType, range(1000)))
+        # A few large strings are not worth offloading
+        self.assertFalse(pool.should_offload(JsonContentType, ['x' * 10000]))
+
+    def test_encode_output_data(self):
+        pydata = [{'id': i, 'title': 'Item {0}'.format(i)} for i in xrange(1000)]
+        view = MockRestView(request=MockRequest('GET'))
+        view.encoding_pool = EncodingPool(processes=1, min_size=1000, min_items=100)
+        try:
+            self.assertEquals(view.encode_output_data(pydata),
+                              JsonContentType.dumps(pydata))
+            with self.assertRaises(ContentTypeDumpError):
+                view.encode_output_data([object()] * 1000)
+        finally:
+            view.encoding_pool.close()
+
+    def test_encode_unpicklable(self):
+        pool = EncodingPool(min_size=0, min_items=0)
+        with self.assertRaises(ContentTypeDumpError):
+            pool.encode(JsonContentType, [lambda: None])
+        self.assertTrue(pool._pool is None)
+
+
+class TestLazyImports(TestCase):
+    def test_lazy_imports(self):
+        from benchmark import benchmark_importtime
+        results = benchmark_importtime(['restfulgrok.view', 'restfulgrok.fancyhtmlview'],
+                                       repeat=1)
+        for module, seconds, imported in results:
+            self.assertEquals(imported, [])
+
+
+class TestLoadHarness(TestCase):
+    def test_mock_views_do_not_share_responses(self):
+        self.assertFalse(MockRestView().response is MockRestView().response)
+        self.assertFalse(MockRestViewWithFancyHtml().response is MockRestViewWithFancyHtml().response)
+
+    def test_run_load_threads(self):
+        from benchmark import run_load_threads
+        latencies, problems, seconds = run_load_threads(4, 15)
+        self.assertEquals(len(latencies), 60)
+        self.assertEquals(problems, [])
+
+    def test_check_load_response(self):
+        from benchmark import check_load_response
+        view = MockRestView()
+        view.response.setStatus(200, 'OK')
+        view.response.setHeader('X-Request-Id', 'other')
+        view.response.setHeader('Content-Type', 'text/html; charset=UTF-8')
+        self.assertEquals(len(check_load_response(view, 'mine', '{"requestid": "other"}',
+                                                  'application/json')), 3)
+
+
+class TestSchema(TestCase):
+    item_schema = Schema({'id': int,
+                          'title': unicode,
+                          'tags': [unicode],
+                          'score': Optional(float),
+                          'owner': Schema({'name': str})})
+
+    def test_encode(self):
+        pydata = {'id': 1, 'title': u'Hello \u00e6', 'tags': ['a', 'b'],
+                  'score': 1.5, 'owner': {'name': 'Jane'}}
+        self.assertEquals(json.loads(self.item_schema.encode(pydata)), pydata)
+        del pydata['score']
+        self.assertEquals(json.loads(self.item_schema.encode(pydata)), pydata)
+
+    def test_encode_invalid(self):
+        with self.assertRaises(ContentTypeDumpError):
+            self.item_schema.encode({'id': '1', 'title': u'', 'tags': [],
+                                     'owner': {'name': 'Jane'}})
+        with self.assertRaises(ContentTypeDumpError):
+            self.item_schema.encode({'id': 1})
+
+    def test_coerce(self):
+        pydata = {'id': 1, 'title': u'x', 'tags': [], 'score': 2, 'owner': {'name': u'Jane'}}
+        coerced = self.item_schema.coerce(pydata)
+        self.assertTrue(isinstance(coerced['score'], float))
+        with self.assertRaises(SchemaError):
+            self.item_schema.coerce(dict(pydata, id=True))
+        with self.assertRaises(SchemaError):
+            self.item_schema.coerce(dict(pydata, unknown=1))
+        with self.assertRaises(SchemaError):
+            self.item_schema.coerce({'id': 1})
+
+    def test_view(self):
+        item_schema = self.item_schema
+        class View(SchemaViewMixin, MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            @schema(request=item_schema, response=item_schema)
+            def handle_put(self):
+                return self.get_requestdata_dict()
+        pydata = {'id': 1, 'title': u'x', 'tags': [], 'owner': {'name': u'Jane'}}
+        view = View(request=MockRequest('PUT', body=json.dumps(pydata)),
+                    response=MockResponse())
+        self.assertEquals(view.render(), item_schema.encode(pydata))
+
+        view = View(request=MockRequest('PUT', body=json.dumps({'id': 'x'})),
+                    response=MockResponse())
+        output = view.render()
+        self.assertEquals(view.response.status, (400, 'Bad Request'))
+        self.assertEquals(json.loads(output), {'error': '.id: Expected an integer.'})
+
+    def test_head(self):
+        item_schema = self.item_schema
+        class View(SchemaViewMixin, MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            @schema(response=item_schema)
+            def handle_get(self):
+                return {'id': 1, 'title': u'x', 'tags': ['a'], 'owner': {'name': 'Jane'}}
+        body = View(request=MockRequest('GET'), response=MockResponse()).render()
+        view = View(request=MockRequest('HEAD'), response=MockResponse())
+        self.assertEquals(view.render(), '')
+        self.assertTrue(('Content-Length', str(len(body))) in view.response.headers)
+
+    def test_head_uses_encoded_length_cache(self):
+        from view import EncodedLengthCache
+        item_schema = self.item_schema
+        calls = []
+        class View(SchemaViewMixin, MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            encoded_length_cache = EncodedLengthCache()
+            def get_resource_metadata(self):
+                return {'etag': '"v1"'}
+            @schema(response=item_schema)
+            def handle_get(self):
+                calls.append('get')
+                return {'id': 1, 'title': u'x', 'tags': [], 'owner': {'name': 'Jane'}}
+        body = View(request=MockRequest('GET'), response=MockResponse()).render()
+        self.assertEquals(body, item_schema.encode({'id': 1, 'title': u'x', 'tags': [],
+                                                    'owner': {'name': 'Jane'}}))
+        view = View(request=MockRequest('HEAD'), response=MockResponse())
+        self.assertEquals(view.render(), '')
+        self.assertTrue(('Content-Length', str(len(body))) in view.response.headers)
+        self.assertEquals(calls, ['get'])
+
+    def test_invalid_utf8(self):
+        item_schema = self.item_schema
+        pydata = {'id': 1, 'title': '\xff', 'tags': [], 'owner': {'name': 'Jane'}}
+        with self.assertRaises(ContentTypeDumpError):
+            item_schema.encode(pydata)
+        class View(SchemaViewMixin, MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            @schema(response=item_schema)
+            def handle_get(self):
+                return pydata
+        view = View(request=MockRequest('GET'), response=MockResponse())
+        output = view.render()
+        self.assertEquals(view.response.status, (400, 'Bad Request'))
+        self.assertTrue('.title: Expected UTF-8 encoded bytes.' in output)
+
+
+class TestThrottledViewMixin(TestCase):
+    class View(ThrottledViewMixin, MockRestView):
+        authorization_backend = AllowAllAuthorizationBackend()
+        throttle_rates = {'get': (1, 2)}
+        def handle_get(self):
+            return {'hello': 'world'}
+
+    def render(self, view_class, client_addr='10.0.0.1'):
+        view = view_class(request=MockRequest('GET', client_addr=client_addr),
+                          response=MockResponse())
+        return view, view.render()
+
+    def test_memory_backend(self):
+        now = [0]
+        backend = MemoryThrottleBackend(clock=lambda: now[0])
+        self.assertEquals(backend.consume('a', 2, 2), 0)
+        self.assertEquals(backend.consume('a', 2, 2), 0)
+        self.assertEquals(backend.consume('a', 2, 2), 0.5)
+        now[0] = 0.5
+        self.assertEquals(backend.consume('a', 2, 2), 0)
+        self.assertTrue(backend.acquire('b', 1))
+        self.assertFalse(backend.acquire('b', 1))
+        backend.release('b')
+        self.assertTrue(backend.acquire('b', 1))
+        with self.assertRaises(ValueError):
+            backend.consume('c', 0, 2)
+
+    def test_default_backend(self):
+        backend = ThrottleBackend()
+        self.assertEquals(backend.consume('a', 1, 1), 0)
+        self.assertEquals(backend.consume('a', 1, 1), 0)
+        self.assertTrue(backend.acquire('b', 1))
+        self.assertTrue(backend.acquire('b', 1))
+        backend.release('b')
+
+    def test_rate_limit(self):
+        now = [0]
+        class View(self.View):
+            throttle_backend = MemoryThrottleBackend(clock=lambda: now[0])
+        for index in xrange(2):
+            view, output = self.render(View)
+            self.assertEquals(view.response.status, (200, 'OK'))
+        view, output = self.render(View)
+        self.assertEquals(view.response.status, (429, 'Too Many Requests'))
+        self.assertTrue(('Retry-After', '1') in view.response.headers)
+        self.assertEquals(json.loads(output), {'error': 'Too Many Requests',
+                                               'retry_after': 1})
+        view, output = self.render(View, client_addr='10.0.0.2')
+        self.assertEquals(view.response.status, (200, 'OK'))
+
+    def test_concurrency_limit(self):
+        class FullBackend(ThrottleBackend):
+            def acquire(self, key, limit):
+                return False
+        class View(self.View):
+            throttle_rates = {}
+            max_concurrent_requests = 1
+            throttle_backend = FullBackend()
+        view, output = self.render(View)
+        self.assertEquals(view.response.status, (429, 'Too Many Requests'))
+
+    def test_concurrency_slot_released(self):
+        class View(self.View):
+            throttle_rates = {}
+            max_concurrent_requests = 1
+            throttle_backend = MemoryThrottleBackend()
+        for index in xrange(3):
+            view, output = self.render(View)
+            self.assertEquals(view.response.status, (200, 'OK'))
+
+
+class TestChangeFeed(TestCase):
+    def test_coalesce_changes(self):
+        self.assertEquals(coalesce_changes([('a', 'created'), ('b', 'modified'), ('a', 'modified'),
+                                            ('c', 'created'), ('c', 'deleted'),
+                                            ('d', 'deleted'), ('d', 'created'), ('b', 'deleted')]),
+                          [('a', 'created'), ('d', 'modified'), ('b', 'deleted')])
+
+    def _test_store(self, store):
+        token = store.get_token('items')
+        store.record('items', 'a', 'created')
+        token2 = store.record('items', 'b', 'created')
+        store.record('other', 'x', 'created')
+        store.record('items', 'a', 'modified')
+        changes, token3 = store.get_changes('items', token)
+        self.assertEquals(changes, [('b', 'created'), ('a', 'created')])
+        self.assertEquals(store.get_changes('items', token2)[0], [('a', 'modified')])
+        self.assertEquals(store.get_changes('items', token3), ([], token3))
+        store.record('items', 'c', 'created')
+        store.record('items', 'c', 'modified')
+        with self.assertRaises(SyncTokenExpired):
+            store.get_changes('items', token)
+        self.assertEquals(store.get_changes('items', token2)[0],
+                          [('a', 'modified'), ('c', 'created')])
+        with self.assertRaises(SyncTokenExpired):
+            store.get_changes('items', 'expired.1')
+        with self.assertRaises(InvalidSyncToken):
+            store.get_changes('items', 'invalid')
+        with self.assertRaises(ValueError):
+            store.record('items', 'a', 'invalid')
+
+    def test_memory_store(self):
+        self._test_store(MemoryChangeLogStore(max_entries=3))
+
+    def test_default_store(self):
+        store = ChangeLogStore()
+        token = store.record('items', 'a', 'created')
+        self.assertEquals(token, store.get_token('items'))
+        with self.assertRaises(SyncTokenExpired):
+            store.get_changes('items', token)
+        with self.assertRaises(InvalidSyncToken):
+            store.get_changes('items', 'invalid')
+        with self.assertRaises(ValueError):
+            store.record('items', 'a', 'invalid')
+
+    def test_sqlite_store(self):
+        import os
+        import shutil
+        import tempfile
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'changelog.db')
+            store = SqliteChangeLogStore(path, max_entries=3)
+            self._test_store(store)
+            # Another process (or store) using the same database shares the log
+            token = store.get_token('items')
+            store.record('items', 'd', 'created')
+            self.assertEquals(SqliteChangeLogStore(path).get_changes('items', token)[0],
+                              [(u'd', u'created')])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_view(self):
+        items = {'a': {'title': 'A'}}
+        class View(ChangeFeedViewMixin, MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            changelog_store = MemoryChangeLogStore(max_entries=3)
+            def handle_get(self):
+                return items
+            def handle_put(self):
+                itemid, item = self.get_requestdata().items()[0]
+                items[itemid] = item
+                self.record_change(itemid, 'modified')
+                return item
+            def get_sync_items(self, itemids):
+                return dict((itemid, items[itemid]) for itemid in itemids)
+        def get(**getdata):
+            view = View(request=MockRequest('GET', getdata=dict(getdata, mimetype='application/json')),
+                        response=MockResponse())
+            return view, json.loads(view.render())
+
+        view, responsedata = get()
+        self.assertEquals(responsedata, items)
+        token = dict(view.response.headers)['X-Sync-Token']
+        View(request=MockRequest('PUT', json.dumps({'b': {'title': 'B'}}),
+                                 getdata={'mimetype': 'application/json'}),
+             response=MockResponse()).render()
+        view, responsedata = get(since=token)
+        self.assertEquals(responsedata['changes'],
+                          [{'id': 'b', 'change': 'modified', 'item': {'title': 'B'}}])
+        self.assertEquals(dict(view.response.headers)['X-Sync-Token'], responsedata['sync_token'])
+        self.assertNotEquals(responsedata['sync_token'], token)
+
+        view, responsedata = get(since='invalid')
+        self.assertEquals(view.response.getStatus(), 400)
+        view, responsedata = get(since='expired.1')
+        self.assertEquals(view.response.getStatus(), 410)
+
+
+class TestPatch(TestCase):
+    def test_merge_patch(self):
+        target = {'title': 'Hello', 'author': {'name': 'Jane', 'email': 'jane@example.com'},
+                  'tags': ['a', 'b'], 'other': {'x': 1}}
+        patched = apply_merge_patch(target, {'title': 'Hi', 'author': {'email': None},
+                                             'tags': ['c'], 'new': {'a': None, 'b': 1}})
+        self.assertEquals(patched, {'title': 'Hi', 'author': {'name': 'Jane'}, 'tags': ['c'],
+                                    'other': {'x': 1}, 'new': {'b': 1}})
+        self.assertEquals(target['author'], {'name': 'Jane', 'email': 'jane@example.com'})
+        self.assertTrue(patched['other'] is target['other']) # Not copied
+        self.assertEquals(apply_merge_patch(target, [1]), [1])
+
+    def test_json_patch(self):
+        target = {'a': {'b': [1, 2, 3]}, 'c': {'d': 1}, 'e': 'x'}
+        patched = apply_json_patch(target, [
+            {'op': 'add', 'path': '/a/b/-', 'value': 4},
+            {'op': 'add', 'path': '/a/b/0', 'value': 0},
+            {'op': 'remove', 'path': '/a/b/1'},
+            {'op': 'replace', 'path': '/e', 'value': 'y'},
+            {'op': 'copy', 'from': '/a', 'path': '/f'},
+            {'op': 'add', 'path': '/f/b/-', 'value': 5},
+            {'op': 'move', 'from': '/e', 'path': '/g~1h'},
+            {'op': 'test', 'path': '/g~1h', 'value': 'y'}])
+        self.assertEquals(patched, {'a': {'b': [0, 2, 3, 4]}, 'c': {'d': 1},
+                                    'f': {'b': [0, 2, 3, 4, 5]}, 'g/h': 'y'})
+        self.assertEquals(target, {'a': {'b': [1, 2, 3]}, 'c': {'d': 1}, 'e': 'x'})
+        self.assertTrue(patched['c'] is target['c']) # Not copied
+        self.assertEquals(apply_json_patch(target, [{'op': 'replace', 'path': '', 'value': 1}]), 1)
+
+    def test_json_patch_errors(self):
+        target = {'a': [1], 'b': 'x'}
+        for operation in ({'op': 'test', 'path': '/b', 'value': 'y'},
+                          {'op': 'remove', 'path': '/missing'},
+                          {'op': 'replace', 'path': '/missing', 'value': 1},
+                          {'op': 'add', 'path': '/a/2', 'value': 1},
+                          {'op': 'add', 'path': '/b/c', 'value': 1},
+                          {'op': 'copy', 'from': '/missing', 'path': '/c'}):
+            with self.assertRaises(PatchError):
+                apply_json_patch(target, [{'op': 'add', 'path': '/new', 'value': 1}, operation])
+        self.assertEquals(target, {'a': [1], 'b': 'x'})
+
+    def test_json_patch_test_types(self):
+        target = {'flag': True, 'count': 1, 'name': 'caf\xc3\xa9', 'items': [{'a': 1.0}]}
+        for path, value in (('/flag', True), ('/count', 1.0), ('/name', u'caf\xe9'),
+                            ('/items', [{u'a': 1}])):
+            apply_json_patch(target, [{'op': 'test', 'path': path, 'value': value}])
+        for path, value in (('/flag', 1), ('/count', True), ('/count', '1'),
+                            ('/items', [{'a': False}]), ('/items', {'a': 1})):
+            with self.assertRaises(PatchError):
+                apply_json_patch(target, [{'op': 'test', 'path': path, 'value': value}])
+        self.assertFalse(json_equal(None, 0))
+        self.assertFalse(json_equal([1], [1, 2]))
+
+    def test_json_patch_invalid(self):
+        target = {'a': [1], 'b': 'x'}
+        for operation in ({'op': 'add', 'path': '/a/01', 'value': 1},
+                          {'op': 'add', 'path': '/a/x', 'value': 1},
+                          {'op': 'add', 'path': 'a', 'value': 1},
+                          {'op': 'add', 'path': '/a'},
+                          {'op': 'copy', 'path': '/c'},
+                          {'op': 'remove', 'path': ''},
+                          {'op': 'move', 'from': '/a', 'path': '/a/0'},
+                          {'op': 'invalid', 'path': '/a'},
+                          {'path': '/a'},
+                          'add'):
+            with self.assertRaises(ContentTypeLoadError):
+                apply_json_patch(target, [{'op': 'add', 'path': '/new', 'value': 1}, operation])
+        self.assertEquals(target, {'a': [1], 'b': 'x'})
+
+    def _patch(self, body, contenttype):
+        items = {'1': {'title': 'Hello', 'tags': ['a']}}
+        class View(MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            def handle_patch(self):
+                items['1'] = self.apply_patch(items['1'])
+                return items['1']
+        view = View(request=MockRequest('PATCH', body, headers={'Accept': 'application/json',
+                                                                'Content-Type': contenttype}),
+                    response=MockResponse())
+        return view, json.loads(view.render())
+
+    def test_view(self):
+        view, responsedata = self._patch('{"title": "Hi"}', 'application/merge-patch+json')
+        self.assertEquals(responsedata, {'title': 'Hi', 'tags': ['a']})
+        view, responsedata = self._patch('[{"op": "add", "path": "/tags/-", "value": "b"}]',
+                                         'application/json-patch+json; charset=UTF-8')
+        self.assertEquals(responsedata, {'title': 'Hello', 'tags': ['a', 'b']})
+
+    def test_view_errors(self):
+        view, responsedata = self._patch('{"title": "Hi"}', 'application/json')
+        self.assertEquals(view.response.getStatus(), 415)
+        view, responsedata = self._patch('{"op": "add"}', 'application/json-patch+json')
+        self.assertEquals(view.response.getStatus(), 400)
+        view, responsedata = self._patch('[{"op": "remove", "path": "/missing"}]',
+                                         'application/json-patch+json')
+        self.assertEquals(view.response.getStatus(), 409)
+        view, responsedata = self._patch('[{"op": "remove", "path": "missing"}]',
+                                         'application/json-patch+json')
+        self.assertEquals(view.response.getStatus(), 400)
+        view, responsedata = self._patch('[{"op": "add", "path": "/tags/x", "value": "b"}]',
+                                         'application/json-patch+json')
+        self.assertEquals(view.response.getStatus(), 400)
+
+    def test_options(self):
+        class View(MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            def handle_patch(self):
+                pass
+        view = View(request=MockRequest('OPTIONS'), response=MockResponse())
+        view.render()
+        headers = dict(view.response.headers)
+        self.assertEquals(headers['Allow'], 'OPTIONS, PATCH')
+        self.assertEquals(sorted(headers['Accept-Patch'].split(', ')),
+                          ['application/json-patch+json', 'application/merge-patch+json'])
+
+
+class TestStreamingViewMixin(TestCase):
+    def _create_view(self, view_class, accept='text/event-stream'):
+        return view_class(request=MockRequest('GET', headers={'Accept': accept}),
+                          response=MockResponse())
+
+    def test_format_event(self):
+        self.assertEquals(EventStreamContentType.format_event({'a': 1}, JsonContentType),
+                          'data: {\ndata:   "a": 1\ndata: }\n\n')
+        self.assertEquals(EventStreamContentType.format_event(Event('x', event='change', id=10, retry=1000),
+                                                              JsonContentType),
+                          'id: 10\nevent: change\nretry: 1000\ndata: "x"\n\n')
+        # Line breaks in the id and event type can not inject fields
+        self.assertEquals(EventStreamContentType.format_event(Event('x', event='a\r\ndata: y',
+                                                                    id=u'1\n\nid: \xe6'),
+                                                              JsonContentType),
+                          'id: 1id: \xc3\xa6\nevent: adata: y\ndata: "x"\n\n')
+
+    def test_stream(self):
+        closed = []
+        class View(StreamingViewMixin, MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            stream_heartbeat_interval = 0
+            def handle_stream(self):
+                try:
+                    yield 'a'
+                    yield None
+                    yield Event('b', event='change')
+                finally:
+                    closed.append(True)
+        view = self._create_view(View)
+        stream = view.render()
+        self.assertTrue(('Content-Type', 'text/event-stream; charset=UTF-8') in view.response.headers)
+        self.assertEquals(list(stream), ['data: "a"\n\n', ':\n\n', 'event: change\ndata: "b"\n\n'])
+        self.assertEquals(closed, [True])
+
+        view = self._create_view(View, accept='application/json')
+        view.handle_get = lambda: {'hello': 'world'}
+        self.assertEquals(json.loads(view.render()), {'hello': 'world'})
+
+    def test_idle_timeout(self):
+        closed = []
+        class View(StreamingViewMixin, MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            stream_idle_timeout = 0
+            def handle_stream(self):
+                try:
+                    yield 'a'
+                    while True:
+                        yield None
+                finally:
+                    closed.append(True)
+        self.assertEquals(list(self._create_view(View).render()), ['data: "a"\n\n'])
+        self.assertEquals(closed, [True])
+
+    def test_poll_handle_get(self):
+        from itertools import islice
+        calls = []
+        class View(StreamingViewMixin, MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            stream_poll_interval = 0
+            def handle_get(self):
+                calls.append(1)
+                return {'count': len(calls) // 3}
+        stream = self._create_view(View).render()
+        self.assertEquals(list(islice(stream, 3)),
+                          ['data: {\ndata:   "count": 0\ndata: }\n\n',
+                           'data: {\ndata:   "count": 1\ndata: }\n\n',
+                           'data: {\ndata:   "count": 2\ndata: }\n\n'])
+        self.assertEquals(len(calls), 6)
+        stream.close()
+
+    def test_max_concurrent_streams(self):
+        from throttle import MemoryThrottleBackend
+        class View(StreamingViewMixin, MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            max_concurrent_streams = 1
+            stream_backend = MemoryThrottleBackend()
+            def handle_stream(self):
+                yield 'a'
+        stream = self._create_view(View).render()
+        view = self._create_view(View)
+        self.assertEquals(view.render(), 'event: error\ndata: {\ndata:   "error": "Too many concurrent streams."\ndata: }\n\n')
+        self.assertEquals(view.response.getStatus(), 429)
+        stream.close() # Releases the slot, even if the stream was never iterated
+        self.assertEquals(list(self._create_view(View).render()), ['data: "a"\n\n'])
+        self.assertEquals(View.stream_backend._slots, {})
+
+
+class TestSingleFlight(TestCase):
+    def test_coalesce(self):
+        import threading
+        import time
+        release = threading.Event()
+        calls = []
+        class View(SingleFlightViewMixin, MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            singleflight = SingleFlight()
+            def handle_get(self):
+                calls.append(1)
+                release.wait(5)
+                self.response.setHeader('ETag', '"1"')
+                return {'hello': 'world'}
+        views = [View(request=MockRequest('GET'), response=MockResponse())
+                 for index in xrange(5)]
+        outputs = []
+        threads = [threading.Thread(target=lambda view=view: outputs.append(view.render()))
+                   for view in views]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.02)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(outputs, [JsonContentType.dumps({'hello': 'world'})] * 5)
+        for view in views:
+            self.assertEquals(view.response.status, (200, 'OK'))
+            self.assertTrue(('ETag', '"1"') in view.response.headers)
+
+    def test_leader_failure(self):
+        import threading
+        group = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        def fail():
+            started.set()
+            release.wait(5)
+            raise ValueError()
+        results = []
+        leader = threading.Thread(target=lambda: self.assertRaises(ValueError, group.do, 'key', fail))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: results.append(group.do('key', lambda: 'independent')))
+        follower.start()
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEquals(results, ['independent'])
+
+    def test_timeout(self):
+        import threading
+        group = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        def slow():
+            started.set()
+            release.wait(5)
+            return 'leader'
+        leader = threading.Thread(target=lambda: group.do('key', slow))
+        leader.start()
+        started.wait(5)
+        self.assertEquals(group.do('key', lambda: 'independent', timeout=0.01), 'independent')
+        release.set()
+        leader.join()
+
+
+class TestResponseCache(TestCase):
+    def _set(self, cache, key, body, ttl=60):
+        response = ResponseRecorder()
+        response.setHeader('Content-Type', 'text/plain; charset=UTF-8')
+        cache.set(key, response, body, ttl)
+
+    def _test_cache(self, cache):
+        self.assertEquals(cache.get('a'), None)
+        self._set(cache, 'a', 'x' * 5)
+        response, body = cache.get('a')
+        self.assertEquals(body, 'x' * 5)
+        self.assertEquals(response.status, (200, 'OK'))
+        self.assertEquals(response.headers, [('Content-Type', 'text/plain; charset=UTF-8')])
+        self._set(cache, 'b', u'\xe6' * 5)
+        self.assertEquals(cache.get('b')[1], u'\xe6' * 5)
+
+        # Expired
+        self._set(cache, 'c', 'x', ttl=0)
+        self.assertEquals(cache.get('c'), None)
+
+        # max_entries=3 evicts the least recently used entry
+        self._set(cache, 'd', 'x')
+        self._set(cache, 'e', 'x')
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.get('b')[1], u'\xe6' * 5)
+
+        # max_bytes=20 evicts until the bodies fit
+        self._set(cache, 'f', 'x' * 14)
+        self.assertEquals(cache.get('d'), None)
+        self.assertEquals(cache.get('e')[1], 'x')
+        self.assertEquals(cache.get('b')[1], u'\xe6' * 5)
+        self.assertEquals(cache.get('f')[1], 'x' * 14)
+
+        cache.clear()
+        self.assertEquals(cache.get('f'), None)
+
+    def test_memory_cache(self):
+        self._test_cache(MemoryResponseCache(max_entries=3, max_bytes=20))
+
+    def test_default_cache(self):
+        cache = ResponseCache()
+        self._set(cache, 'a', 'x')
+        self.assertEquals(cache.get('a'), None)
+        cache.clear()
+
+    def test_sqlite_cache(self):
+        import os
+        import shutil
+        import tempfile
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'responsecache.db')
+            cache = SqliteResponseCache(path, max_entries=3, max_bytes=20)
+            cache.touch_interval = 0
+            self._test_cache(cache)
+            # Another process (or cache) using the same database shares the cache
+            self._set(cache, 'a', 'shared')
+            self.assertEquals(SqliteResponseCache(path).get('a')[1], 'shared')
+            # Headers that can not be stored are not cached
+            response = ResponseRecorder()
+            response.setHeader('X-Name', '\xff')
+            cache.set('invalid', response, 'x', 60)
+            self.assertEquals(cache.get('invalid'), None)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_view(self):
+        calls = []
+        class View(ResponseCacheViewMixin, MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            response_cache = MemoryResponseCache()
+            def handle_get(self):
+                calls.append(1)
+                self.response.setHeader('X-Calls', str(len(calls)))
+                if self.request.get('missing'):
+                    return self.create_response(404, 'Not Found', {'error': 'Not found'})
+                return {'hello': 'world'}
+        for index in xrange(3):
+            view = View(request=MockRequest('GET'), response=MockResponse())
+            self.assertEquals(view.render(), JsonContentType.dumps({'hello': 'world'}))
+            self.assertEquals(view.response.getStatus(), 200)
+            self.assertEquals(dict(view.response.headers)['X-Calls'], '1')
+        self.assertEquals(len(calls), 1)
+
+        # Another content type is cached separately
+        view = View(request=MockRequest('GET', headers={'Accept': 'application/x-yaml'}),
+                    response=MockResponse())
+        view.render()
+        self.assertEquals(len(calls), 2)
+
+        # Errors are not cached
+        for index in xrange(2):
+            view = View(request=MockRequest('GET', getdata={'missing': '1',
+                                                            'QUERY_STRING': 'missing=1'}),
+                        response=MockResponse())
+            view.render()
+            self.assertEquals(view.response.getStatus(), 404)
+        self.assertEquals(len(calls), 4)
+
+    def test_etag(self):
+        metadata_calls = []
+        class View(ResponseCacheViewMixin, MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            response_cache = MemoryResponseCache()
+            def get_resource_metadata(self):
+                metadata_calls.append(1)
+                return {'etag': '"v1"'}
+            def handle_get(self):
+                return {'hello': 'world'}
+        for index in xrange(2):
+            view = View(request=MockRequest('GET'), response=MockResponse())
+            view.render()
+            self.assertTrue(('ETag', '"v1"') in view.response.headers)
+        self.assertEquals(len(metadata_calls), 2)
+
+
+class TestMemoryProfilingViewMixin(TestCase):
+    def test_tracemalloc_peak(self):
+        # Uses a fake tracemalloc module, so it runs on all Python versions.
+        import sys
+        import types
+        resets = []
+        tracemalloc = types.ModuleType('tracemalloc')
+        tracemalloc.get_traced_memory = lambda: (100, 500)
+        original = sys.modules.get('tracemalloc')
+        sys.modules['tracemalloc'] = tracemalloc
+        try:
+            tracer = TracemallocTracer()
+            self.assertFalse(tracer.can_reset_peak)
+            tracer.reset_peak()
+            self.assertEquals(tracer.get_memory(), (100, None))
+            tracemalloc.reset_peak = lambda: resets.append(1)
+            tracer = TracemallocTracer()
+            tracer.reset_peak()
+            self.assertEquals(tracer.get_memory(), (100, 500))
+            self.assertEquals(resets, [1])
+        finally:
+            if original is None:
+                del sys.modules['tracemalloc']
+            else:
+                sys.modules['tracemalloc'] = original
+
+    def test_profile(self):
+        reports = []
+        class View(MemoryProfilingViewMixin, MockRestView):
+            authorization_backend = AllowAllAuthorizationBackend()
+            memory_profile_rate = 1
+            memory_profile_threshold = 0
+            def handle_post(self):
+                data = self.get_requestdata()
+                return {'items': [data] * 1000}
+            def report_memory_profile(self, profile, top_sites):
+                reports.append((profile, top_sites))
+        view = View(request=MockRequest('POST', '{"a": 1}'), response=MockResponse())
+        view.render()
+        self.assertEquals(view.response.getStatus(), 200)
+        profile, top_sites = reports[0]
+        self.assertEquals(profile.keys(), ['decode', 'handler', 'encode', 'total'])
+        tracer = get_memory_tracer()
+        rss = isinstance(tracer, RssTracer)
+        for stats in profile.itervalues():
+            if rss or not tracer.can_reset_peak:
+                self.assertEquals(stats['peak'], None)
+            else:
+                self.assertTrue(stats['peak'] >= 0)
+                self.assertTrue(stats['peak'] >= stats['net'])
+        self.assertEquals(rss, not top_sites)
+
+        View.memory_profile_rate = 0
+        view = View(request=MockRequest('POST', '{"a": 1}'), response=MockResponse())
+        view.render()
+        self.assertEquals(view.memory_profile, None)
+        self.assertEquals(len(reports), 1)
+
+    def test_nested_phases(self):
+        class Tracer(object):
+            def __init__(self):
+                self.current = self.peak = 0
+            def allocate(self, size):
+                self.current += size
+                self.peak = max(self.peak, self.current)
+            def get_memory(self):
+                return self.current, self.peak
+            def reset_peak(self):
+                self.peak = self.current
+        tracer = Tracer()
+        view = MemoryProfilingViewMixin()
+        view._memory_tracer = tracer
+        view._memory_frames = []
+        view.memory_profile = {}
+        with view.memory_phase('outer'):
+            tracer.allocate(100)
+            tracer.allocate(-100)
+            with view.memory_phase('inner'):
+                tracer.allocate(30)
+            tracer.allocate(20)
+        self.assertEquals(view.memory_profile, {'outer': {'net': 50, 'peak': 100},
+                                                'inner': {'net': 30, 'peak': 30}})
+
+    def test_rss_tracer_has_no_peak(self):
+        class Tracer(RssTracer):
+            current = 0
+            def get_memory(self):
+                return self.current, None
+        tracer = Tracer()
+        view = MemoryProfilingViewMixin()
+        view._memory_tracer = tracer
+        view._memory_frames = []
+        view.memory_profile = {}
+        with view.memory_phase('outer'):
+            with view.memory_phase('inner'):
+                tracer.current = 30
+            tracer.current = 20
+        self.assertEquals(view.memory_profile, {'outer': {'net': 20, 'peak': None},
+                                                'inner': {'net': 30, 'peak': None}})
+        if RssTracer.is_available():
+            current, peak = RssTracer().get_memory()
+            self.assertTrue(current > 0)
+            self.assertEquals(peak, None)
+
 
 class TestGrokRestViewWithFancyHtmlMixin(TestCase):
     def test_handle_html(self):
@@ -138,8 +1695,117 @@ class TestGrokRestViewWithFancyHtmlMixin(TestCase):
         output = View(request=MockRequest('GET', getdata={'mimetype': 'text/html'})).render()
         self.assertTrue('?mimetype=text/html' in output)
 
+    def _render_html(self, view_class, pydata):
+        view = view_class(request=MockRequest('GET', getdata={'mimetype': 'text/html'}),
+                          response=MockResponse())
+        view.authorize = lambda: None # Skip authorization
+        view.handle_get = lambda: pydata
+        return view.render()
+
+    def test_static_html_cached(self):
+        class UncachedHtmlContentType(HtmlContentType):
+            cache_static_html = False
+        class UncachedView(MockRestViewWithFancyHtml):
+            content_types = MockRestViewWithFancyHtml.content_types + \
+                    ContentTypesRegistry(UncachedHtmlContentType)
+        pydata = {'hello': '<world> & "friends"'}
+        expected = self._render_html(UncachedView, pydata)
+        self.assertTrue('&lt;world&gt; &amp;' in expected)
+        self.assertEquals(self._render_html(MockRestViewWithFancyHtml, pydata), expected)
+        self.assertEquals(self._render_html(MockRestViewWithFancyHtml, pydata), expected)
+        view = MockRestViewWithFancyHtml(request=MockRequest('GET'), response=MockResponse())
+        key = HtmlContentType.get_static_html_key(view)
+        self.assertEquals(len(HtmlContentType._static_html_cache.get(key)), 3)
+
+    def test_static_html_cache_is_bounded(self):
+        class View(MockRestViewWithFancyHtml):
+            pass
+        cache = HtmlContentType._static_html_cache
+        for index in xrange(cache.maxsize + 1):
+            self._render_html(type('View{0}'.format(index), (View,), {}), {})
+        self.assertEquals(len(cache), cache.maxsize)
+
+    def test_static_html_custom_previewdata_block(self):
+        from jinja2 import Environment, DictLoader, PrefixLoader, PackageLoader
+        environment = Environment(loader=PrefixLoader({
+            'restfulgrok': PackageLoader('restfulgrok'),
+            'custom': DictLoader({'view.html': (
+                '{% extends "restfulgrok/fancyhtmlview.jinja.html" %}'
+                '{% block previewdata %}{{ previewdata|shout|e }}{% endblock %}')})
+        }))
+        environment.filters['shout'] = lambda value: value.upper()
+        class CustomHtmlContentType(HtmlContentType):
+            template_environment = environment
+            template_name = 'custom/view.html'
+        class View(MockRestViewWithFancyHtml):
+            content_types = MockRestViewWithFancyHtml.content_types + \
+                    ContentTypesRegistry(CustomHtmlContentType)
+        view = View(request=MockRequest('GET'), response=MockResponse())
+        self.assertEquals(len(CustomHtmlContentType.get_static_html(view)), 3)
+        output = self._render_html(View, {'hello': '<world>'})
+        self.assertTrue('&#34;HELLO&#34;: &#34;&lt;WORLD&gt;&#34;' in output)
+        self.assertFalse('hello' in output)
+
+    def test_static_html_not_cached_with_custom_template_data(self):
+        class CustomHtmlContentType(HtmlContentType):
+            @classmethod
+            def get_template_data(cls, pydata, view):
+                templatedata = super(CustomHtmlContentType, cls).get_template_data(pydata, view)
+                templatedata['heading'] = 'Custom heading'
+                return templatedata
+        class View(MockRestViewWithFancyHtml):
+            content_types = MockRestViewWithFancyHtml.content_types + \
+                    ContentTypesRegistry(CustomHtmlContentType)
+        self.assertTrue('Custom heading' in self._render_html(View, {'hello': 'world'}))
+
+    def test_stream_responses(self):
+        class View(MockRestViewWithFancyHtml):
+            authorization_backend = AllowAllAuthorizationBackend()
+            stream_responses = True
+            def handle_get(self):
+                return {'hello': 'world'}
+        request = MockRequest('GET', getdata={'mimetype': 'text/html'})
+        body = View(request=request, response=MockResponse()).render()
+        self.assertFalse(isinstance(body, basestring))
+        chunks = list(body)
+        self.assertEquals(len(chunks), 3)
+        view = View(request=MockRequest('GET', getdata={'mimetype': 'text/html'}),
+                    response=MockResponse())
+        view.stream_responses = False
+        self.assertEquals(view.render(), ''.join(chunks))
+        view = View(request=MockRequest('HEAD', getdata={'mimetype': 'text/html'}),
+                    response=MockResponse())
+        self.assertEquals(view.render(), '')
+        self.assertTrue(('Content-Length', str(len(''.join(chunks)))) in view.response.headers)
+
+        # Errors and other content types are not streamed
+        view = View(request=MockRequest('POST', getdata={'mimetype': 'text/html'}),
+                    response=MockResponse())
+        self.assertTrue(isinstance(view.render(), basestring))
+        self.assertTrue(isinstance(View(request=MockRequest('GET'), response=MockResponse()).render(),
+                                   basestring))
+
+    def test_dump_streams_chunks(self):
+        view = MockRestViewWithFancyHtml(request=MockRequest('GET'), response=MockResponse())
+        view.response.setStatus(200, 'OK')
+        chunks = list(HtmlContentType.generate({'hello': 'world'}, view))
+        self.assertEquals(len(chunks), 3)
+        self.assertTrue('&#34;hello&#34;' in chunks[1])
+        from StringIO import StringIO
+        fileobj = StringIO()
+        HtmlContentType.dump({'hello': 'world'}, fileobj, view)
+        self.assertEquals(fileobj.getvalue(), ''.join(chunks))
+        self.assertEquals(HtmlContentType.dumps({'hello': 'world'}, view), ''.join(chunks))
+
 
 class TestContentTypesRegistry(TestCase):
+    def test_get_mimetypelist(self):
+        registry = ContentTypesRegistry(JsonContentType)
+        self.assertEquals(registry.get_mimetypelist(), ('application/json',))
+        self.assertTrue(registry.get_mimetypelist() is registry.get_mimetypelist())
+        registry.add(YamlContentType)
+        self.assertEquals(sorted(registry.get_mimetypelist()), ['application/json', 'application/x-yaml'])
+
     def test_negotiate_accept_header(self):
         registry = ContentTypesRegistry(JsonContentType, YamlContentType)
         self.assertEquals(registry.negotiate_accept_header('application/x-yaml,application/json'),
@@ -158,6 +1824,64 @@ class TestContentTypesRegistry(TestCase):
         self.assertEquals(registry.negotiate_accept_header('application/html'),
                           None)
 
+    def test_negotiate_accept_header_exclusions(self):
+        registry = ContentTypesRegistry(JsonContentType, YamlContentType)
+        self.assertEquals(registry.negotiate_accept_header(
+            'application/json;q=0,application/x-yaml;q=0,text/html;q=0,*/*'), None)
+        self.assertEquals(registry.negotiate_accept_header('application/json;q=0,*/*'),
+                          'application/x-yaml')
+        self.assertEquals(registry.negotiate_accept_header('application/x-yaml;q=0.0,application/*'),
+                          'application/json')
+        self.assertEquals(registry.negotiate_accept_header('*/*;q=0,application/x-yaml'),
+                          'application/x-yaml')
+        self.assertEquals(registry.negotiate_accept_header('application/*;q=0,*/*'), None)
+        self.assertEquals(registry.get_excluded_mimetypes(parse_accept_header(
+            'application/*;q=0,application/json;q=0.5')), set(['application/x-yaml']))
+
+    def test_negotiate_malformed_accept_header(self):
+        registry = ContentTypesRegistry(JsonContentType, YamlContentType)
+        for acceptheader in ('', ',', ';', '*', '/', 'application/json;q=', '*/*;q=x',
+                             'application/json;q=0', 'application/json;charset=utf-8;q=0.5;x=y',
+                             u'\xe6/\xf8', ','.join(['a/b'] * 10000)):
+            self.assertTrue(registry.negotiate_accept_header(acceptheader)
+                            in (None, 'application/json', 'application/x-yaml'))
+        self.assertEquals(registry.negotiate_accept_header('APPLICATION/JSON'), 'application/json')
+        self.assertEquals(registry.negotiate_accept_header('application/json;charset=utf-8;q=0.5'),
+                          'application/json')
+
+    def test_negotiate_accept_header_fuzz(self):
+        from benchmark import generate_accept_headers
+        registry = ContentTypesRegistry(JsonContentType, YamlContentType)
+        for acceptheader in generate_accept_headers(500, seed=1):
+            self.assertTrue(registry.negotiate_accept_header(acceptheader)
+                            in (None, 'application/json', 'application/x-yaml'))
+            normalized = normalize_accept_header(acceptheader)
+            if normalized:
+                self.assertEquals(normalize_accept_header(normalized), normalized)
+                registry._get_negotiator().negotiate(normalized)
+
+    def test_normalize_accept_header(self):
+        self.assertEquals(normalize_accept_header('Text/HTML;level=1, application/json;Q=0.5;q=0.8,*/*;q=0.001'),
+                          'text/html,application/json;q=0.8,*/*;q=0.001')
+        self.assertEquals(normalize_accept_header('a/b;q=0, c/d;q=x, e, f/g;q=1.5'), 'f/g;q=1')
+        self.assertEquals(parse_accept_header('a/b;q=0.00, c/d;q=x, e, f/g;q=1.5, h/i'),
+                          [('a/b', '0'), ('f/g', '1'), ('h/i', None)])
+        self.assertEquals(normalize_accept_header(';;'), None)
+        self.assertEquals(normalize_accept_header('a/b,c/d,e/f', max_length=8), 'a/b,c/d')
+        self.assertEquals(normalize_accept_header('a/bcdefgh', max_length=8), None)
+        self.assertEquals(normalize_accept_header('a/b,c/d,e/f', max_entries=2), 'a/b,c/d')
+
+    def test_negotiation_cache(self):
+        registry = ContentTypesRegistry(JsonContentType)
+        registry.max_cached_acceptheaders = 2
+        self.assertEquals(registry.negotiate_accept_header('application/x-yaml'), None)
+        self.assertEquals(registry.negotiate_accept_header('application/json'), 'application/json')
+        self.assertEquals(len(registry._negotiation_cache), 2)
+        registry.negotiate_accept_header('*/*')
+        self.assertEquals(registry._negotiation_cache, {'*/*': 'application/json'})
+        registry.add(YamlContentType)
+        self.assertEquals(registry.negotiate_accept_header('application/x-yaml'), 'application/x-yaml')
+
 
 from example_tests import TestExampleRestMixin
 
@@ -0,0 +1,185 @@
+import math
+import time
+import threading
+
+from view import GrokRestViewMixin
+
+
+class ThrottleBackend(object):
+    """
+    Superclass for the state used by :class:`ThrottledViewMixin`.
+
+    This class never throttles, so subclasses must override :meth:`consume`
+    to limit the request rate, and :meth:`acquire` and :meth:`release` to
+    limit concurrent requests.
+    """
+    def consume(self, key, rate, burst):
+        """
+        Take a token from the token bucket identified by ``key``.
+
+        :param rate: Number of tokens added to the bucket per second.
+        :param burst: Max number of tokens in the bucket.
+        :return:
+            ``0`` if a token was available, or the number of seconds until a
+            token is available.
+        """
+        return 0
+
+    def acquire(self, key, limit):
+        """
+        Acquire one of ``limit`` slots identified by ``key``.
+
+        :return: ``True`` if a slot was acquired.
+        """
+        return True
+
+    def release(self, key):
+        """
+        Release a slot acquired with :meth:`acquire`.
+        """
+
+
+class MemoryThrottleBackend(ThrottleBackend):
+    """
+    Thread-safe in-memory :class:`ThrottleBackend`. The state is local to
+    the process, so each worker process throttles separately.
+    :meth:`consume` raises :exc:`ValueError` if the rate is not positive.
+    """
+    def __init__(self, max_buckets=100000, clock=time.time):
+        """
+        :param max_buckets:
+            When there are more buckets than this, full buckets are removed
+            (they are equal to new buckets).
+        :param clock: Function returning the current time in seconds.
+        """
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self._buckets = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, burst):
+        if rate <= 0:
+            raise ValueError('The rate must be positive, not {0!r}.'.format(rate))
+        with self._lock:
+            now = self.clock()
+            tokens, updated = self._buckets.get(key, (burst, now, rate, burst))[:2]
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / float(rate)
+            self._buckets[key] = (tokens, now, rate, burst)
+            if len(self._buckets) > self.max_buckets:
+                self._prune(now)
+            return wait
+
+    def _prune(self, now):
+        for key, (tokens, updated, rate, burst) in self._buckets.items():
+            if tokens + (now - updated) * rate >= burst:
+                del self._buckets[key]
+
+    def acquire(self, key, limit):
+        with self._lock:
+            count = self._slots.get(key, 0)
+            if count >= limit:
+                return False
+            self._slots[key] = count + 1
+            return True
+
+    def release(self, key):
+        with self._lock:
+            count = self._slots.get(key, 0) - 1
+            if count > 0:
+                self._slots[key] = count
+            else:
+                self._slots.pop(key, None)
+
+
+class ThrottledViewMixin(GrokRestViewMixin):
+    """
+    Mix-in that limits the request rate for each client, and the number of
+    concurrent requests for each view class. Requests over the limits are
+    responded to with *429 Too Many Requests* and a Retry-After header,
+    encoded in the negotiated content type.
+
+    Clients are identified by user id (from the ``authorization_backend``),
+    or by IP address for anonymous users.
+    """
+    #: Map of request method to ``(rate, burst)`` tuples, where ``rate`` is
+    #: the number of requests per second allowed for each client (must be
+    #: positive), and
+    #: ``burst`` is the number of requests allowed at once. May have a
+    #: ``'default'`` key. Methods without a rate are not rate limited.
+    throttle_rates = {}
+
+    #: Max number of concurrent requests for the view class. ``None`` means
+    #: no limit.
+    max_concurrent_requests = None
+
+    #: The :class:`ThrottleBackend`.
+    throttle_backend = MemoryThrottleBackend()
+
+    def get_throttle_rate(self):
+        """
+        Get the ``(rate, burst)`` tuple for the current request method, or
+        ``None``.
+        """
+        method = self.get_requestmethod()
+        return self.throttle_rates.get(method, self.throttle_rates.get('default'))
+
+    def get_client_id(self):
+        """
+        Get a string identifying the client.
+        """
+        userid = self.authorization_backend.get_userid(self)
+        if userid:
+            return 'user:{0}'.format(userid)
+        return 'ip:{0}'.format(self.request.getClientAddr())
+
+    def get_view_key(self):
+        cls = self.__class__
+        return '{0}.{1}'.format(cls.__module__, cls.__name__)
+
+    def get_throttle_key(self):
+        """
+        Get the key of the token bucket for the current request.
+        """
+        return '{0}:{1}:{2}'.format(self.get_view_key(), self.get_requestmethod(),
+                                    self.get_client_id())
+
+    def before_handle(self):
+        rate = self.get_throttle_rate()
+        if rate:
+            wait = self.throttle_backend.consume(self.get_throttle_key(), *rate)
+            if wait:
+                return self.response_429_too_many_requests(wait)
+        if self.max_concurrent_requests is not None:
+            key = self.get_view_key()
+            if not self.throttle_backend.acquire(key, self.max_concurrent_requests):
+                return self.response_429_too_many_requests(1)
+            self._throttle_slot = key
+        return super(ThrottledViewMixin, self).before_handle()
+
+    def render(self):
+        try:
+            return super(ThrottledViewMixin, self).render()
+        finally:
+            slot = getattr(self, '_throttle_slot', None)
+            if slot is not None:
+                self._throttle_slot = None
+                self.throttle_backend.release(slot)
+
+    def response_429_too_many_requests(self, retry_after):
+        """
+        Respond with 429 Too Many Requests, and a Retry-After header.
+
+        :param retry_after: Seconds until the client should retry.
+        """
+        retry_after = int(math.ceil(retry_after))
+        self.set_contenttype_header()
+        self.response.setHeader('Retry-After', str(retry_after))
+        return self.create_response(429, 'Too Many Requests',
+                                    {'error': 'Too Many Requests',
+                                     'retry_after': retry_after})
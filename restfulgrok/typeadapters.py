@@ -0,0 +1,127 @@
+import datetime
+from inspect import getmro
+
+
+class TypeAdapterRegistry(object):
+    """
+    Registry of adapters that convert objects the encoders do not support
+    into objects they do support. Used by
+    :class:`restfulgrok.contenttype.JsonContentType` and
+    :class:`restfulgrok.contenttype.YamlContentType` (and therefore also by
+    the HTML data preview), so types are converted while encoding, in the
+    same pass over the data.
+
+    Adapters are looked up by the class of the object, and then by the
+    classes in its MRO. The result of the lookup is cached for each class.
+    Example::
+
+        from restfulgrok.typeadapters import default_type_adapters
+        default_type_adapters.register(MyType, lambda obj: obj.asdict())
+    """
+    def __init__(self):
+        self._adapters = {}
+        self._named_adapters = {}
+        self._cache = {}
+        self._yaml_dumper = None
+
+    def register(self, cls, adapter):
+        """
+        Register ``adapter`` for ``cls`` and its subclasses.
+
+        :param cls: A class.
+        :param adapter:
+            Callable taking an instance of ``cls`` as argument, and returning
+            an object that can be encoded. The returned object is adapted
+            again if it contains unsupported objects.
+        """
+        self._adapters[cls] = adapter
+        self._cache.clear()
+
+    def register_by_name(self, module, name, adapter):
+        """
+        Just like :meth:`register`, but the class is given by its module and
+        name. Use this for classes from optional or expensive to import
+        modules.
+        """
+        self._named_adapters[(module, name)] = adapter
+        self._cache.clear()
+
+    def get_adapter(self, cls):
+        """
+        Get the adapter for ``cls``, or ``None`` if no adapter is registered
+        for ``cls`` or any of its superclasses.
+        """
+        try:
+            return self._cache[cls]
+        except KeyError:
+            pass
+        adapter = None
+        for supercls in getmro(cls):
+            adapter = self._adapters.get(supercls)
+            if adapter is None:
+                adapter = self._named_adapters.get((supercls.__module__, supercls.__name__))
+            if adapter is not None:
+                break
+        self._cache[cls] = adapter
+        return adapter
+
+    def adapt(self, obj):
+        """
+        Adapt ``obj`` using the registered adapter for its class. Suitable as
+        the ``default`` argument for ``json.dumps``.
+
+        :raise TypeError: If no adapter is registered for the class of ``obj``.
+        """
+        adapter = self.get_adapter(obj.__class__)
+        if adapter is None:
+            raise TypeError('{0!r} is not JSON serializable'.format(obj))
+        return adapter(obj)
+
+    def get_yaml_dumper(self):
+        """
+        Get a ``yaml.SafeDumper`` subclass that adapts objects using this
+        registry when they are not supported by ``yaml.SafeDumper``.
+        """
+        if self._yaml_dumper is None:
+            import yaml
+            registry = self
+
+            class AdaptingSafeDumper(yaml.SafeDumper):
+                pass
+
+            def represent_adapted(dumper, data):
+                adapter = registry.get_adapter(data.__class__)
+                if adapter is None:
+                    return dumper.represent_undefined(data)
+                return dumper.represent_data(adapter(data))
+            AdaptingSafeDumper.add_representer(None, represent_adapted)
+            self._yaml_dumper = AdaptingSafeDumper
+        return self._yaml_dumper
+
+
+def _isoformat(obj):
+    return obj.isoformat()
+
+def _catalogbrain_asdict(brain):
+    return dict((name, brain[name]) for name in brain.__record_schema__)
+
+
+#: The :class:`TypeAdapterRegistry` used by the content types in
+#: :mod:`restfulgrok.contenttype`. Adapts ``datetime``, ``date`` and ``time``
+#: to ISO 8601 strings, ``Decimal`` to strings, ``set`` and ``frozenset``
+#: to lists, Zope ``DateTime`` to ISO 8601 strings, and ZCatalog brains to
+#: dicts of their metadata. :class:`restfulgrok.contenttype.RawFragment` is
+#: registered by :mod:`restfulgrok.contenttype`, and adapted to the decoded
+#: JSON.
+default_type_adapters = TypeAdapterRegistry()
+default_type_adapters.register(datetime.datetime, _isoformat)
+default_type_adapters.register(datetime.date, _isoformat)
+default_type_adapters.register(datetime.time, _isoformat)
+default_type_adapters.register(set, list)
+default_type_adapters.register(frozenset, list)
+default_type_adapters.register_by_name('decimal', 'Decimal', str)
+default_type_adapters.register_by_name('DateTime.DateTime', 'DateTime',
+                                       lambda obj: obj.ISO8601())
+default_type_adapters.register_by_name('Products.ZCatalog.CatalogBrains',
+                                       'AbstractCatalogBrain',
+                                       _catalogbrain_asdict)
@@ -1,7 +1,19 @@
+import copy
+import threading
+from collections import OrderedDict
+
 from contenttype import YamlContentType
 from contenttype import JsonContentType
 from contenttype import ContentTypesRegistry
 from contenttype import ContentTypeError
+from contenttype import RequestEntityTooLarge
+from contenttype import UnsupportedMediaType
+from contenttype import default_input_limits
+from authorization import NotAuthorized
+from authorization import ZopeAuthorizationBackend
+from patch import PatchError
+from patch import default_patch_content_types
+from spool import spool_encode
 
 
 class CouldNotDetermineContentType(Exception):
@@ -15,62 +27,222 @@ class CouldNotDetermineContentType(Exception):
         self.acceptable_mimetypes = acceptable_mimetypes
 
     def __str__(self):
-        error = ('{querystring_error}. {acceptheader_error}. '
-                 'Acceptable acceptable_mimetypes: '
-                 '{acceptable_mimetypes}').format(**self.__dict__)
+        error = ('{0}. {1}. Acceptable acceptable_mimetypes: '
+                 '{2}').format(self.querystring_error, self.acceptheader_error,
+                               list(self.acceptable_mimetypes))
         return error
 
     def asdict(self):
         return dict(error=str(self),
                     querystring_error=self.querystring_error,
                     acceptheader_error=self.acceptheader_error,
-                    acceptable_mimetypes=self.acceptable_mimetypes)
+                    acceptable_mimetypes=list(self.acceptable_mimetypes))
+
+class EncodedResponse(object):
+    """
+    Wraps an already encoded response body. :meth:`GrokRestViewMixin.encode_output_data`
+    returns the wrapped body as it is, so handlers can return this to respond
+    with pre-encoded data.
+    """
+    def __init__(self, body):
+        self.body = body
+
+
+class ResponseRecorder(object):
+    """
+    Response object that records the status and headers set on it, so they
+    can be replayed on another response object using :meth:`replay`.
+    """
+    def __init__(self):
+        self.headers = []
+        self.status = (200, 'OK')
+        self.errmsg = 'OK'
+
+    def setHeader(self, header, value):
+        self.headers.append((header, value))
+
+    def setStatus(self, code, msg):
+        self.errmsg = msg
+        self.status = (code, msg)
+
+    def getStatus(self):
+        return self.status[0]
+
+    def replay(self, response):
+        """
+        Set the recorded status and headers on ``response``.
+        """
+        response.setStatus(*self.status)
+        for header, value in self.headers:
+            response.setHeader(header, value)
+
+
+class LRUCache(object):
+    """
+    Thread-safe cache that removes the least recently used values when it
+    has more than ``maxsize`` values. ``None`` can not be cached.
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get the value stored for ``key``, or ``None``.
+        """
+        with self._lock:
+            value = self._values.pop(key, None)
+            if value is not None:
+                self._values[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._values.pop(key, None)
+            self._values[key] = value
+            while len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+
+    def __len__(self):
+        return len(self._values)
+
+
+class EncodedLengthCache(LRUCache):
+    """
+    Thread-safe LRU cache of encoded response lengths. Used by
+    :meth:`GrokRestViewMixin.handle_head` to respond to HEAD requests
+    without encoding the response.
+    """
+
+
+class EncodedErrorCache(LRUCache):
+    """
+    Thread-safe LRU cache of encoded error responses. Used by
+    :meth:`GrokRestViewMixin.encode_output_data` to encode each error
+    response only once per view class and content type.
+    """
+    def __init__(self, maxsize=1000, max_body_size=16384):
+        """
+        :param maxsize: Max number of cached responses.
+        :param max_body_size: Larger responses are not cached.
+        """
+        super(EncodedErrorCache, self).__init__(maxsize)
+        self.max_body_size = max_body_size
+
+    def set(self, key, encoded):
+        if len(encoded) <= self.max_body_size:
+            super(EncodedErrorCache, self).set(key, encoded)
+
 
 class GrokRestViewMixin(object):
     """
     Mix-in class for ``five.grok.View``.
     """
     #: List of supported HTTP request methods in lowercase.
-    #: Defaults to ``['get', 'post', 'put', 'delete', 'options', 'head']``.
+    #: Defaults to ``['get', 'post', 'put', 'delete', 'options', 'head', 'patch']``.
     #: You do not have to override this to disallow any of
     #: those request methods since their default ``handle_<method>()``
     #: implementations responds with *405 Method Not Allowed*. However,
     #: if you implement other methods, such as TRACE, you need to add them to
     #: the list.
-    supported_methods = ['get', 'post', 'put', 'delete', 'options', 'head']
+    supported_methods = ['get', 'post', 'put', 'delete', 'options', 'head', 'patch']
 
     #: A :class:`ContentTypesRegistry` object containing all content-types supported by the API.
     content_types = ContentTypesRegistry(JsonContentType, YamlContentType)
 
+    #: A :class:`ContentTypesRegistry` with the content types supported for
+    #: the body of PATCH requests (see :meth:`apply_patch`). The content type
+    #: is chosen by the Content-Type header of the request. Each content
+    #: type must have an ``apply(target, patch)`` classmethod. Defaults to
+    #: :class:`restfulgrok.patch.MergePatchContentType` and
+    #: :class:`restfulgrok.patch.JsonPatchContentType`.
+    patch_content_types = default_patch_content_types
+
 
     #: Map of request method to permission.
     #: You should have one (lowercase) key for each request method in
     #: :obj:`.supported_methods`, or a "default" key defining a default
-    #: permission.
+    #: permission. HEAD requests use the ``get`` permission unless there is
+    #: a ``head`` key, since they are answered with the response of GET.
     permissions = {'get': 'View',
+                   'options': 'View',
                    'post': 'Add portal content',
                    'put': 'Modify portal content',
                    'default': 'Modify portal content'}
 
+    #: The :class:`restfulgrok.contenttype.InputLimits` enforced when
+    #: decoding the request body.
+    input_limits = default_input_limits
+
+    #: The :class:`restfulgrok.authorization.AuthorizationBackend` used by
+    #: :meth:`authorize` to check :obj:`permissions`.
+    authorization_backend = ZopeAuthorizationBackend()
+
+    #: Encoded responses larger than this number of bytes are spooled to a
+    #: temporary file by :meth:`encode_output_data`, and returned as a
+    #: :class:`restfulgrok.spool.SpooledBody` instead of as a string.
+    #: Defaults to ``None``, which disables spooling.
+    spool_threshold = None
+
+    #: Number of bytes read for each chunk of a spooled response.
+    spool_chunksize = 65536
+
+    #: Return successful responses with a
+    #: :obj:`restfulgrok.contenttype.ContentType.streamable` content type
+    #: from :meth:`encode_output_data` as an iterator of encoded chunks
+    #: (see :meth:`restfulgrok.contenttype.ContentType.iterdumps`), so they
+    #: are sent while they are encoded. Only enable this for publishers that
+    #: stream iterable response bodies, like
+    #: :class:`restfulgrok.wsgi.WsgiApplication`. Note that the status is
+    #: sent before the data is encoded, so encoding errors abort the
+    #: response instead of responding with *400 Bad Request*.
+    stream_responses = False
+
+    #: The negotiated :class:`restfulgrok.contenttype.ResponseProfile`. Set
+    #: by :meth:`get_response_profile`.
+    _response_profile = None
+
+    #: The metadata from :meth:`get_resource_metadata`. Set by
+    #: :meth:`get_cached_resource_metadata`.
+    _resource_metadata = None
+
+    #: The :class:`EncodedLengthCache` storing the length of encoded GET
+    #: responses with an ETag (see :meth:`get_resource_metadata`).
+    encoded_length_cache = EncodedLengthCache()
+
+    #: The :class:`EncodedErrorCache` storing encoded error responses (see
+    #: :meth:`get_error_cache_key`). Set to ``None`` to encode every error
+    #: response.
+    error_cache = EncodedErrorCache()
+
+    #: A :class:`restfulgrok.offload.EncodingPool` used by
+    #: :meth:`encode_output_data` to encode large responses in worker
+    #: processes. Defaults to ``None``, which encodes everything inline.
+    encoding_pool = None
+
     def authorize(self):
         """
         Called by :meth:`.render` to authorize the user before calling :meth:`.handle`.
 
-        The permissions required for each method is defined in :obj:`permissions`.
+        The permissions required for each method is defined in
+        :obj:`permissions`, and they are checked using
+        :obj:`authorization_backend`.
 
-        :raise AccessControl.Unauthorized:
+        :raise restfulgrok.authorization.NotAuthorized:
             If the current user do not have
             permission to perform the requested method.
         """
-        from AccessControl import Unauthorized, getSecurityManager
         method = self.get_requestmethod()
         permission = self.permissions.get(method)
+        if not permission and method == 'head':
+            permission = self.permissions.get('get')
         if not permission:
             permission = self.permissions['default']
-        if not getSecurityManager().checkPermission(permission, self):
-            raise Unauthorized('Not authorized for: {0} requests. '
-                               'Required permission: {1}'.format(method.upper(),
-                                                                 permission))
+        if not self.authorization_backend.check_permission(permission, self):
+            raise NotAuthorized('Not authorized for: {0} requests. '
+                                'Required permission: {1}'.format(method.upper(),
+                                                                  permission))
 
     def render(self):
         """
@@ -78,14 +250,25 @@ class GrokRestViewMixin(object):
         and :meth:`encode_output_data` to encode the response from
         :meth:`handle`.
         """
-        from AccessControl.unauthorized import Unauthorized
+        unauthorized_exceptions = self.authorization_backend.get_unauthorized_exceptions()
         try:
             try:
                 self.authorize()
-                responsedata = self.handle()
-            except Unauthorized, e:
+                responsedata = self.before_handle()
+                if responsedata is None:
+                    responsedata = self.handle()
+            except unauthorized_exceptions, e:
                 self.set_contenttype_header()
                 responsedata = self.response_401_unauthorized(str(e))
+            except RequestEntityTooLarge, e:
+                self.set_contenttype_header()
+                responsedata = self.response_413_request_entity_too_large({'error': str(e)})
+            except UnsupportedMediaType, e:
+                self.set_contenttype_header()
+                responsedata = self.response_415_unsupported_media_type({'error': str(e)})
+            except PatchError, e:
+                self.set_contenttype_header()
+                responsedata = self.response_409_conflict({'error': str(e)})
             except ContentTypeError, e:
                 self.set_contenttype_header()
                 responsedata = self.response_400_bad_request({'error': str(e)})
@@ -99,32 +282,93 @@ class GrokRestViewMixin(object):
         except CouldNotDetermineContentType, e:
             # Note that we need to wrap both because set_contenttype_header
             # uses get_content_type, which can raise CouldNotDetermineContentType.
-            return self.create_response(406, 'Not Acceptable', e.asdict())
+            return self.response_406_not_acceptable(e)
+
+    def before_handle(self):
+        """
+        Called by :meth:`render` after :meth:`authorize` and before
+        :meth:`handle`. Return response data to respond without calling
+        :meth:`handle`, or ``None`` (the default) to continue.
+        """
+        return None
 
     def get_content_type(self):
         """
-        Detect input/output content type.
+        Detect input/output content type. This is the content type of the
+        profile from :meth:`get_response_profile`.
         """
-        if hasattr(self, '_content_type'):
-            return self._content_type
-        mimetype = None
-        querystring_mimetype = self.request.get('mimetype')
-        acceptheader = self.request.getHeader('Accept')
+        return self.get_response_profile().content_type
+
+    def get_response_profile(self):
+        """
+        Negotiate the :class:`restfulgrok.contenttype.ResponseProfile` of the
+        response. Uses the ``mimetype`` in the querystring if it is in
+        :obj:`content_types`, and the Accept header otherwise. The profile is
+        negotiated once for each request.
 
-        if querystring_mimetype and querystring_mimetype in self.content_types:
-            mimetype = querystring_mimetype
+        :raise CouldNotDetermineContentType: If no content type is acceptable.
+        """
+        profile = self._response_profile
+        if profile is not None:
+            return profile
+        querystring_mimetype = self.request.get('mimetype')
+        if isinstance(querystring_mimetype, basestring) and querystring_mimetype in self.content_types:
+            profile = self.content_types.get_profile(querystring_mimetype)
         else:
-            querystring_error = 'No acceptable mimetype in QUERY_STRING: {0}'.format(querystring_mimetype)
+            acceptheader = self.request.getHeader('Accept')
             if acceptheader:
-                mimetype = self.content_types.negotiate_accept_header(acceptheader)
-            if not mimetype:
+                profile = self.content_types.negotiate_profile(acceptheader)
+            if profile is None:
+                querystring_error = 'No acceptable mimetype in QUERY_STRING: {0}'.format(querystring_mimetype)
                 acceptheader_error = 'No acceptable mimetype in ACCEPT header: {0}'.format(acceptheader)
                 raise CouldNotDetermineContentType(querystring_error=querystring_error,
                                                    acceptheader_error=acceptheader_error,
                                                    acceptable_mimetypes=self.content_types.get_mimetypelist())
-        content_type = self.content_types[mimetype]
-        self._content_type = content_type
-        return content_type
+        self._response_profile = profile
+        return profile
+
+    def get_context_key(self):
+        """
+        Get a string identifying :obj:`context`. Uses ``getPhysicalPath()``
+        if the context has it, and the ``id`` attribute of the context
+        otherwise.
+        """
+        if hasattr(self.context, 'getPhysicalPath'):
+            return '/'.join(self.context.getPhysicalPath())
+        return str(getattr(self.context, 'id', None))
+
+    def get_shared_response_key(self, user_key):
+        """
+        Get a tuple identifying the requests that can share a response: The
+        view class, the context (see :meth:`get_context_key`), the negotiated
+        mimetype, the query string and ``user_key``.
+
+        :param user_key: String identifying the users that can share the response.
+        """
+        cls = self.__class__
+        return (cls.__module__, cls.__name__,
+                self.get_context_key(),
+                self.get_content_type().mimetype,
+                self.request.get('QUERY_STRING', ''),
+                user_key)
+
+    def record_response(self, handle):
+        """
+        Create a response that can be shared with other requests. Calls
+        ``handle(view)``, where ``view`` is a copy of this view with a
+        :class:`ResponseRecorder` as response, and encodes the result in
+        memory (it is not spooled or streamed).
+
+        :return:
+            ``(response, body)`` tuple, where ``response`` is the
+            :class:`ResponseRecorder` with the status and headers.
+        """
+        view = copy.copy(self)
+        view.response = ResponseRecorder()
+        view.spool_threshold = None
+        view.stream_responses = False
+        body = view.encode_output_data(handle(view))
+        return view.response, body
 
     def add_attachment_header(self):
         """
@@ -138,10 +382,19 @@ class GrokRestViewMixin(object):
     def set_contenttype_header(self, mimetype=None):
         """
         Set the content type header. Called by :meth:`handle`, and may be overridden.
+
+        :param mimetype:
+            Use this mimetype instead of the mimetype of :meth:`get_content_type`.
+            The charset of the content type is used if it is in ``content_types``
+            (binary content types have no charset), and ``UTF-8`` otherwise.
         """
-        mimetype = mimetype or self.get_content_type().mimetype
-        self.response.setHeader('Content-Type',
-                                '{0}; charset=UTF-8'.format(mimetype))
+        if mimetype in self.content_types:
+            contenttype_header = self.content_types.get_profile(mimetype).contenttype_header
+        elif mimetype:
+            contenttype_header = '{0}; charset=UTF-8'.format(mimetype)
+        else:
+            contenttype_header = self.get_response_profile().contenttype_header
+        self.response.setHeader('Content-Type', contenttype_header)
 
     def handle(self):
         """
@@ -153,11 +406,116 @@ class GrokRestViewMixin(object):
         self.set_contenttype_header()
         self.add_attachment_header()
         self.response.setStatus(200, 'OK')
-        if self.get_requestmethod() in self.supported_methods:
-            return getattr(self, 'handle_' + self.get_requestmethod())()
+        method = self.get_requestmethod()
+        if method == 'get' or method == 'head':
+            self.set_resource_metadata_headers()
+        handler = self.get_handler(method)
+        if handler:
+            return handler()
         else:
             return self.response_405_method_not_allowed()
 
+    def get_handler(self, method):
+        """
+        Get the ``handle_<method>()`` method for the given lowercase request
+        ``method``, or ``None`` if ``method`` is not in :obj:`supported_methods`.
+        Override this to customize how requests are dispatched.
+        """
+        if method in self.supported_methods:
+            return getattr(self, 'handle_' + method)
+        return None
+
+    def get_handler_method(self):
+        """
+        Get the lowercase request method whose handler creates the response
+        data. Same as :meth:`get_requestmethod`, except for HEAD requests to
+        views using the default :meth:`handle_head`, which are answered with
+        the response of the GET handler.
+        """
+        method = self.get_requestmethod()
+        if method == 'head' and not self.is_implemented('head'):
+            return 'get'
+        return method
+
+    def is_implemented(self, method):
+        """
+        Return ``True`` if the ``handle_<method>()`` method for the given
+        lowercase request ``method`` is in :obj:`supported_methods`, and
+        overrides the default implementation.
+        """
+        if method not in self.supported_methods:
+            return False
+        handler = getattr(self.__class__, 'handle_' + method, None)
+        default = getattr(GrokRestViewMixin, 'handle_' + method, None)
+        if handler is None:
+            return False
+        elif default is None:
+            return True
+        return handler.im_func is not default.im_func
+
+    def get_allowed_methods(self):
+        """
+        Get the uppercase request methods allowed by this view. HEAD is
+        allowed when GET is, and OPTIONS is always allowed.
+        """
+        allowed = []
+        for method in self.supported_methods:
+            if (self.is_implemented(method)
+                    or method == 'options'
+                    or (method == 'head' and self.is_implemented('get'))):
+                allowed.append(method.upper())
+        return allowed
+
+    def get_resource_metadata(self):
+        """
+        Override this to make HEAD requests cheap. Should return a dict with
+        any of the following keys, or ``None`` (the default):
+
+        - ``etag``: ETag of the GET response. When this is given, the length
+          of the encoded GET response is stored in :obj:`encoded_length_cache`,
+          and HEAD requests use the stored length.
+        - ``last_modified``: Value for the Last-Modified header.
+        - ``content_length``: Length of the encoded GET response.
+
+        Must not compute the response body. The ETag and Last-Modified headers
+        are set for both GET and HEAD requests.
+        """
+        return None
+
+    def get_cached_resource_metadata(self):
+        """
+        Get the :meth:`get_resource_metadata` of the request. It is only
+        computed once for each request.
+
+        :return: The metadata, or an empty dict if there is no metadata.
+        """
+        metadata = self._resource_metadata
+        if metadata is None:
+            metadata = self._resource_metadata = self.get_resource_metadata() or {}
+        return metadata
+
+    def set_resource_metadata_headers(self):
+        """
+        Set the headers from :meth:`get_cached_resource_metadata`.
+
+        :return: The metadata.
+        """
+        metadata = self.get_cached_resource_metadata()
+        if metadata:
+            if metadata.get('etag'):
+                self.response.setHeader('ETag', metadata['etag'])
+            if metadata.get('last_modified'):
+                self.response.setHeader('Last-Modified', metadata['last_modified'])
+        return metadata
+
+    def get_encoded_length_key(self, etag):
+        """
+        Get the :obj:`encoded_length_cache` key for the given ``etag``.
+        """
+        cls = self.__class__
+        return (cls.__module__, cls.__name__, self.get_context_key(),
+                self.get_content_type().mimetype, etag)
+
     def get_requestmethod(self):
         """
         Get the request method as lowercase string.
@@ -179,12 +537,66 @@ class GrokRestViewMixin(object):
         errormsg = 'Method Not Allowed: {0}'.format(self.request.method)
         return self.create_response(405, errormsg, body={'error': errormsg})
 
+    def response_406_not_acceptable(self, error):
+        """
+        Respond with 406 Not Acceptable, and the
+        :meth:`CouldNotDetermineContentType.asdict` of ``error`` as the
+        response body. No content type was negotiated, so the body is
+        encoded with the content type from :meth:`get_not_acceptable_profile`.
+        The encoded body is cached in :obj:`error_cache` for each view class
+        and error.
+
+        :return: The encoded body.
+        """
+        self.response.setStatus(406, 'Not Acceptable')
+        profile = self.get_not_acceptable_profile()
+        self.response.setHeader('Content-Type', profile.contenttype_header)
+        key = None
+        if self.error_cache is not None and profile.content_type.error_cacheable:
+            key = (self.__class__, profile.content_type, 406, error.querystring_error,
+                   error.acceptheader_error, tuple(error.acceptable_mimetypes))
+            encoded = self.error_cache.get(key)
+            if encoded is not None:
+                return encoded
+        encoded = profile.dumps(error.asdict(), self)
+        if key is not None:
+            self.error_cache.set(key, encoded)
+        return encoded
+
+    def get_not_acceptable_profile(self):
+        """
+        Get the :class:`restfulgrok.contenttype.ResponseProfile` used by
+        :meth:`response_406_not_acceptable`. JSON if :obj:`content_types`
+        supports it, and the first of the :obj:`content_types` otherwise.
+        """
+        if 'application/json' in self.content_types:
+            return self.content_types.get_profile('application/json')
+        return self.content_types.get_profile(sorted(self.content_types.get_mimetypelist())[0])
+
     def response_400_bad_request(self, body):
         """
         Respond with 400 Bad Request, and the ``body`` parameter as response body.
         """
         return self.create_response(400, 'Bad Request', body)
 
+    def response_413_request_entity_too_large(self, body):
+        """
+        Respond with 413 Request Entity Too Large, and the ``body`` parameter as response body.
+        """
+        return self.create_response(413, 'Request Entity Too Large', body)
+
+    def response_409_conflict(self, body):
+        """
+        Respond with 409 Conflict, and the ``body`` parameter as response body.
+        """
+        return self.create_response(409, 'Conflict', body)
+
+    def response_415_unsupported_media_type(self, body):
+        """
+        Respond with 415 Unsupported Media Type, and the ``body`` parameter as response body.
+        """
+        return self.create_response(415, 'Unsupported Media Type', body)
+
     def response_401_unauthorized(self, error='Unauthorized'):
         """
         Respond with 401 Unauthorized, and ``{'error': 'Unauthorized'}`` as body.
@@ -197,16 +609,75 @@ class GrokRestViewMixin(object):
         """
         return self.create_response(201, 'Created', body)
 
+    def get_raw_requestdata(self):
+        """
+        Read the body of the request. If :obj:`input_limits` has a
+        ``max_body_bytes`` limit, at most one byte more than the limit is
+        read.
+        """
+        self.request.stdin.seek(0)
+        max_body_bytes = self.input_limits.max_body_bytes
+        if max_body_bytes is None:
+            return self.request.stdin.read()
+        else:
+            # Read one byte more than the limit, so we do not read huge
+            # bodies into memory just to reject them.
+            return self.request.stdin.read(max_body_bytes + 1)
+
     def get_requestdata(self):
         """
         Decode the body of the request using :meth:`decode_input_data`, and return the
         decoded data.
         """
-        self.request.stdin.seek(0)
-        raw_request_body = self.request.stdin.read()
-        decoded = self.decode_input_data(raw_request_body)
+        decoded = self.decode_input_data(self.get_raw_requestdata())
         return decoded
 
+    def iter_requestdata(self):
+        """
+        Iterate over the items in the body of the request. If the content
+        type has an ``iterloads()`` method, like
+        :class:`restfulgrok.contenttype.CsvContentType`, the items are
+        decoded from ``request.stdin`` one at a time, so large bodies are not
+        read into memory. Otherwise, this iterates over :meth:`get_requestdata`.
+        """
+        iterloads = getattr(self.get_content_type(), 'iterloads', None)
+        if iterloads is None:
+            return iter(self.get_requestdata())
+        self.request.stdin.seek(0)
+        return iterloads(self.request.stdin, self)
+
+    def get_patch_content_type(self):
+        """
+        Get the content type of the body of a PATCH request from
+        :obj:`patch_content_types`, using the Content-Type header.
+
+        :raise restfulgrok.contenttype.UnsupportedMediaType:
+            If the Content-Type is not in :obj:`patch_content_types`.
+        """
+        contenttype = self.request.getHeader('Content-Type') or ''
+        mimetype = contenttype.split(';')[0].strip().lower()
+        if mimetype not in self.patch_content_types:
+            raise UnsupportedMediaType('Unsupported patch content type: {0!r}. '
+                                       'Supported: {1}'.format(mimetype,
+                                                               ', '.join(self.patch_content_types.get_mimetypelist())))
+        return self.patch_content_types[mimetype]
+
+    def apply_patch(self, target):
+        """
+        Decode the body of a PATCH request, and apply it to ``target``. The
+        patch is applied copy-on-write, so ``target`` is not modified, and
+        only the containers on the patched paths are copied.
+
+        :return: The patched copy of ``target``.
+        :raise restfulgrok.contenttype.UnsupportedMediaType:
+            If the patch content type is not supported (see :meth:`get_patch_content_type`).
+        :raise restfulgrok.contenttype.ContentTypeLoadError: If the patch is invalid.
+        :raise restfulgrok.patch.PatchError: If the patch can not be applied to ``target``.
+        """
+        content_type = self.get_patch_content_type()
+        patch = content_type.loads(self.get_raw_requestdata(), self)
+        return content_type.apply(target, patch)
+
     def get_requestdata_dict(self):
         """
         Just like :meth:`get_requestdata`, however, the :exc:`ValueError` is raised
@@ -221,9 +692,68 @@ class GrokRestViewMixin(object):
         """
         Encode the given python datastructure.
 
+        If :obj:`stream_responses` is set, and the response is successful,
+        streamable content types return an iterator of encoded chunks.
+        Otherwise, if :obj:`spool_threshold` is set, and the encoded data is larger than
+        the threshold, the data is spooled to a temporary file, the
+        Content-Length header is set, and a
+        :class:`restfulgrok.spool.SpooledBody` is returned. Otherwise, if
+        :obj:`encoding_pool` is set, large responses are encoded in its
+        worker processes.
+
         :raise restfulgrok.contenttype.ContentTypeDumpError: If ``pydata`` can not be encoded.
         """
-        return self.get_content_type().dumps(pydata, self)
+        if isinstance(pydata, EncodedResponse):
+            return pydata.body
+        profile = self.get_response_profile()
+        content_type = profile.content_type
+        errorkey = self.get_error_cache_key(content_type, pydata)
+        if errorkey is not None:
+            encoded = self.error_cache.get(errorkey)
+            if encoded is not None:
+                return encoded
+        if self.stream_responses and content_type.streamable \
+                and self.response.getStatus() < 300:
+            return profile.iterdumps(pydata, self)
+        if self.spool_threshold is not None:
+            encoded = spool_encode(content_type, pydata, self,
+                                   self.spool_threshold, self.spool_chunksize)
+            if not isinstance(encoded, basestring):
+                self.response.setHeader('Content-Length', str(len(encoded)))
+        elif self.encoding_pool and self.encoding_pool.should_offload(content_type, pydata):
+            encoded = self.encoding_pool.encode(content_type, pydata)
+        else:
+            encoded = profile.dumps(pydata, self)
+        metadata = self._resource_metadata
+        if metadata and metadata.get('etag') and self.response.getStatus() == 200:
+            self.encoded_length_cache.set(self.get_encoded_length_key(metadata['etag']),
+                                          len(encoded))
+        if errorkey is not None and isinstance(encoded, basestring):
+            self.error_cache.set(errorkey, encoded)
+        return encoded
+
+    def get_error_cache_key(self, content_type, pydata):
+        """
+        Get the :obj:`error_cache` key for encoding ``pydata`` with
+        ``content_type``, or ``None`` if the response should not be cached.
+
+        Error responses (status 400 or above) with a dict of strings as body,
+        like ``{'error': 'Unauthorized'}``, are cached by view class, content
+        type, status, status message and body if
+        :obj:`restfulgrok.contenttype.ContentType.error_cacheable` is ``True``
+        for the content type.
+        """
+        if self.error_cache is None or not isinstance(pydata, dict) \
+                or not content_type.error_cacheable:
+            return None
+        status = self.response.getStatus()
+        if status < 400:
+            return None
+        for value in pydata.itervalues():
+            if not isinstance(value, basestring):
+                return None
+        return (self.__class__, content_type, status,
+                getattr(self.response, 'errmsg', None), frozenset(pydata.iteritems()))
 
     def decode_input_data(self, rawdata):
         """
@@ -257,14 +787,53 @@ class GrokRestViewMixin(object):
         """
         return self.response_405_method_not_allowed()
 
-    def handle_options(self):
+    def handle_patch(self):
         """
-        Override in subclasses. Defaults to :meth:`response_405_method_not_allowed`.
+        Override in subclasses, and use :meth:`apply_patch`. Defaults to
+        :meth:`response_405_method_not_allowed`.
         """
         return self.response_405_method_not_allowed()
 
+    def handle_options(self):
+        """
+        Responds with an empty body and the Allow header set to
+        :meth:`get_allowed_methods`. No handlers are called. If
+        :meth:`handle_patch` is implemented, the Accept-Patch header is set to
+        the :obj:`patch_content_types`.
+        """
+        self.response.setHeader('Allow', ', '.join(self.get_allowed_methods()))
+        if self.is_implemented('patch'):
+            self.response.setHeader('Accept-Patch',
+                                    ', '.join(self.patch_content_types.get_mimetypelist()))
+        self.response.setHeader('Content-Length', '0')
+        return EncodedResponse('')
+
     def handle_head(self):
         """
-        Override in subclasses. Defaults to :meth:`response_405_method_not_allowed`.
+        Defaults to :meth:`response_405_method_not_allowed` if
+        :meth:`handle_get` is not implemented. Otherwise, responds with an
+        empty body and the headers of a GET request. The Content-Length
+        header is taken from :meth:`get_resource_metadata`, or from
+        :obj:`encoded_length_cache`. If neither has it, the GET handler from
+        :meth:`get_handler` is called, and its response is encoded with
+        :meth:`encode_output_data` to find the length.
         """
-        return self.response_405_method_not_allowed()
+        if not self.is_implemented('get'):
+            return self.response_405_method_not_allowed()
+        metadata = self._resource_metadata or {}
+        length = metadata.get('content_length')
+        if length is None and metadata.get('etag'):
+            length = self.encoded_length_cache.get(self.get_encoded_length_key(metadata['etag']))
+        if length is None:
+            encoded = self.encode_output_data(self.get_handler('get')())
+            if hasattr(encoded, '__len__'):
+                length = len(encoded)
+            else:
+                length = sum(len(chunk) for chunk in encoded)
+                if metadata.get('etag'):
+                    self.encoded_length_cache.set(self.get_encoded_length_key(metadata['etag']),
+                                                  length)
+            if hasattr(encoded, 'close'):
+                encoded.close()
+        self.response.setHeader('Content-Length', str(length))
+        return EncodedResponse('')
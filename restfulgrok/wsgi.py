@@ -0,0 +1,209 @@
+"""
+Run restfulgrok views as WSGI applications, without Zope. Example::
+
+    from restfulgrok.wsgi import WsgiRestView, WsgiApplication
+    from restfulgrok.authorization import AllowAllAuthorizationBackend
+
+    class HelloView(WsgiRestView):
+        authorization_backend = AllowAllAuthorizationBackend()
+        def handle_get(self):
+            return {'hello': 'world'}
+
+    application = WsgiApplication(HelloView)
+"""
+from urlparse import parse_qsl
+from StringIO import StringIO
+from wsgiref.util import request_uri
+
+from view import GrokRestViewMixin
+from authorization import AuthorizationBackend
+
+
+class WsgiResponse(object):
+    """
+    Response object with the same interface as a Zope response, as used by
+    :class:`restfulgrok.view.GrokRestViewMixin`.
+    """
+    def __init__(self):
+        self.headers = []
+        self.status = (200, 'OK')
+        self.errmsg = 'OK'
+
+    def setHeader(self, header, value):
+        """
+        Set ``header`` to ``value``, replacing any existing value.
+        """
+        name = header.lower()
+        self.headers = [(h, v) for h, v in self.headers if h.lower() != name]
+        self.headers.append((header, value))
+
+    def getHeader(self, header, default=None):
+        name = header.lower()
+        for h, value in self.headers:
+            if h.lower() == name:
+                return value
+        return default
+
+    def setStatus(self, code, msg):
+        self.errmsg = msg
+        self.status = (code, msg)
+
+    def getStatus(self):
+        return self.status[0]
+
+    def get_status_line(self):
+        """
+        Get the status formatted for ``start_response``.
+        """
+        return '{0} {1}'.format(*self.status)
+
+
+class WsgiRequest(object):
+    """
+    Request object with the same interface as a Zope request, as used by
+    :class:`restfulgrok.view.GrokRestViewMixin`, created from a WSGI
+    ``environ``.
+    """
+    def __init__(self, environ):
+        self.environ = environ
+        self.method = environ['REQUEST_METHOD']
+        self.form = dict(parse_qsl(environ.get('QUERY_STRING', ''),
+                                   keep_blank_values=True))
+        self.response = WsgiResponse()
+        self._stdin = None
+
+        #: Read at most one byte more than this from ``wsgi.input``. Set by
+        #: :class:`WsgiRestView` from its ``input_limits``, so bodies larger
+        #: than the limit are not read into memory. ``None`` means no limit.
+        self.max_body_bytes = None
+
+    def get(self, key, default=None):
+        """
+        Get ``key`` from the ``environ``, falling back to the querystring.
+        Uppercase keys, like ``REMOTE_USER`` and other server and CGI
+        variables, are only looked up in the ``environ``, so they can not be
+        set in the querystring.
+        """
+        if key in self.environ:
+            return self.environ[key]
+        if key.isupper():
+            return default
+        return self.form.get(key, default)
+
+    def getHeader(self, header, default=None):
+        name = header.upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        return self.environ.get(name, default)
+
+    def getURL(self):
+        return request_uri(self.environ, include_query=False)
+
+    def getClientAddr(self):
+        return self.environ.get('REMOTE_ADDR')
+
+    @property
+    def stdin(self):
+        """
+        The request body as a seekable file-like object. The body is read
+        from ``wsgi.input`` the first time this is used. At most
+        :obj:`max_body_bytes` + 1 bytes are read.
+        """
+        if self._stdin is None:
+            try:
+                length = int(self.environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+            if self.max_body_bytes is not None:
+                length = min(length, self.max_body_bytes + 1)
+            body = ''
+            if length > 0:
+                body = self.environ['wsgi.input'].read(length)
+            self._stdin = StringIO(body)
+        return self._stdin
+
+
+class WsgiRestView(GrokRestViewMixin):
+    """
+    Base class for views served by :class:`WsgiApplication`. Created with the
+    same arguments as ``grok.View``.
+
+    :obj:`authorization_backend` denies everything by default, so you must
+    set it to a :class:`restfulgrok.authorization.AuthorizationBackend`
+    suitable for your application.
+    """
+    authorization_backend = AuthorizationBackend()
+
+    #: :class:`WsgiApplication` streams iterable responses.
+    stream_responses = True
+
+    def __init__(self, context, request):
+        self.context = context
+        self.request = request
+        self.response = request.response
+        request.max_body_bytes = self.input_limits.max_body_bytes
+
+
+class WsgiApplication(object):
+    """
+    WSGI application rendering a :class:`WsgiRestView`.
+
+    String responses are sent with a Content-Length header, while iterable
+    responses, such as :class:`restfulgrok.spool.SpooledBody`, are streamed.
+    """
+    def __init__(self, view_class, get_context=None):
+        """
+        :param view_class: A :class:`WsgiRestView` subclass.
+        :param get_context:
+            Optional callable taking a :class:`WsgiRequest` as argument and
+            returning the context object for the view. The context is
+            ``None`` if this is not specified.
+        """
+        self.view_class = view_class
+        self._get_context = get_context
+
+    def get_context(self, request):
+        if self._get_context:
+            return self._get_context(request)
+        return None
+
+    def get_body_iterable(self, body, response):
+        """
+        Get ``body`` as an iterable of byte strings.
+        """
+        if hasattr(body, 'next'):
+            return body
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        elif not isinstance(body, str):
+            body = str(body)
+        if response.getHeader('Content-Length') is None:
+            response.setHeader('Content-Length', str(len(body)))
+        return [body]
+
+    def encode_error_body(self, view, body):
+        """
+        Encode a dict or list that the ``render()`` method of the view
+        returned without encoding it, for example from a custom ``render()``.
+        Encoded as JSON if the view supports it, and with the first of the
+        ``content_types`` of the view otherwise.
+        """
+        content_types = view.content_types
+        if 'application/json' in content_types:
+            mimetype = 'application/json'
+        else:
+            mimetype = sorted(content_types.get_mimetypelist())[0]
+        view.response.setHeader('Content-Type',
+                                content_types.get_profile(mimetype).contenttype_header)
+        return content_types[mimetype].dumps(body, view)
+
+    def __call__(self, environ, start_response):
+        request = WsgiRequest(environ)
+        view = self.view_class(self.get_context(request), request)
+        body = view.render()
+        if isinstance(body, (dict, list)):
+            body = self.encode_error_body(view, body)
+        body = self.get_body_iterable(body, request.response)
+        start_response(request.response.get_status_line(),
+                       [(str(h), str(v)) for h, v in request.response.headers])
+        return body